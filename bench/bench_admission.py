@@ -0,0 +1,175 @@
+# bench_admission.py
+# What one misbehaving client and a reconnect storm do to everyone else,
+# with the admission limits (server/admission.py) off and on.
+#
+#   python bench/bench_admission.py --talkers 20 --storm 2000 --max-connections 500
+#
+# --talkers well-behaved clients share a room and each send --msg-rate
+# timestamped messages a second; their delivery latency is what we report.
+# Meanwhile one flooder writes chat into the same room as fast as its socket
+# takes it, and halfway through --storm extra clients connect at once. Every
+# client connects from 127.0.0.1, so the per-address limits stay off here and
+# the per-connection ones do the work.
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+import urllib.request
+
+import benchutil
+
+sys.path.insert(0, benchutil.SERVER_DIR)
+import protocol  # noqa: E402
+
+COUNTERS = ('chat_connections_refused_full_total', 'chat_messages_rate_limited_total',
+            'chat_reads_throttled_total')
+
+
+class Client(asyncio.Protocol):
+    """Framed client recording talker latencies, flood deliveries and rejections."""
+
+    def __init__(self, name, stats=None):
+        self.name = name
+        self.stats = stats
+        self.transport = None
+        self.decoder = protocol.FrameDecoder()
+        self.welcomed = self.rejected = False
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(protocol.encode_json(protocol.HELLO, {'name': self.name, 'version': 1}))
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+        for ftype, payload in self.decoder.frames():
+            if ftype == protocol.WELCOME:
+                self.welcomed = True
+            elif ftype == protocol.REJECT:
+                self.rejected = True
+            elif ftype == protocol.MESSAGE and self.stats is not None:
+                text = json.loads(bytes(payload))['text']
+                if text.startswith('@'):
+                    self.stats['latency'].append((time.monotonic_ns() - int(text[1:text.index('@', 1)])) / 1e6)
+                else:
+                    self.stats['flood_delivered'] += 1
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+
+
+def scrape(port):
+    values = {}
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+        for line in response.read().decode('utf-8').splitlines():
+            name, _, value = line.partition(' ')
+            if name in COUNTERS:
+                values[name] = float(value)
+    return values
+
+
+async def connect(loop, port, name, stats=None):
+    _, client = await loop.create_connection(lambda: Client(name, stats), '127.0.0.1', port)
+    return client
+
+
+async def run(mode, limited, args):
+    port, metrics_port = benchutil.free_port(), benchutil.free_port()
+    env = {'METRICS_PORT': str(metrics_port), 'LOG_LEVEL': 'error'}
+    if limited:
+        env.update({'MAX_CONNECTIONS': str(args.max_connections), 'MESSAGE_RATE': str(args.message_rate),
+                    'MESSAGE_BURST': str(2 * args.message_rate), 'BYTE_RATE': str(args.byte_rate)})
+    proc = benchutil.start_server(mode, port, env=env)
+    loop = asyncio.get_running_loop()
+    stats = {'latency': [], 'flood_delivered': 0}
+    clients, storm = [], []
+    try:
+        observer = await connect(loop, port, 'observer', stats)
+        talkers = [await connect(loop, port, f"talker-{i}") for i in range(args.talkers)]
+        flooder = await connect(loop, port, 'flooder')
+        clients = [observer, flooder] + talkers
+        await asyncio.sleep(1.0)
+        before = scrape(metrics_port)
+        stop_at = time.monotonic() + args.seconds
+
+        async def talk(client):
+            while time.monotonic() < stop_at:
+                text = f"@{time.monotonic_ns()}@ hello"
+                client.transport.write(protocol.encode_frame(protocol.CHAT, text.encode('utf-8')))
+                await asyncio.sleep(1.0 / args.msg_rate)
+
+        async def flood():
+            frame = protocol.encode_frame(protocol.CHAT, b'spam ' + b'x' * 100)
+            while time.monotonic() < stop_at:
+                if not flooder.paused:
+                    flooder.transport.write(frame * 100)
+                await asyncio.sleep(0)
+
+        async def reconnect_storm():
+            await asyncio.sleep(args.seconds / 2)
+            results = await asyncio.gather(*(connect(loop, port, f"storm-{i}") for i in range(args.storm)),
+                                           return_exceptions=True)
+            storm.extend(c for c in results if isinstance(c, Client))
+
+        await asyncio.gather(flood(), reconnect_storm(), *(talk(c) for c in talkers))
+        await asyncio.sleep(1.0)
+        after = scrape(metrics_port)
+    finally:
+        for c in clients + storm:
+            c.transport.abort()
+        benchutil.stop_server(proc)
+
+    latency = sorted(stats['latency'])
+    delta = {name: after.get(name, 0) - before.get(name, 0) for name in COUNTERS}
+    return {
+        'mode': mode,
+        'limits': 'on' if limited else 'off',
+        'talker_messages': len(latency),
+        'talker_p50_ms': round(benchutil.percentile(latency, 50), 2),
+        'talker_p99_ms': round(benchutil.percentile(latency, 99), 2),
+        'talker_max_ms': round(latency[-1], 2) if latency else float('nan'),
+        'flood_delivered_per_s': round(stats['flood_delivered'] / args.seconds),
+        'storm_admitted': sum(c.welcomed for c in storm),
+        'storm_rejected': sum(c.rejected for c in storm),
+        'storm_failed': args.storm - len(storm),
+        'refused': int(delta['chat_connections_refused_full_total']),
+        'rate_limited': int(delta['chat_messages_rate_limited_total']),
+        'reads_throttled': int(delta['chat_reads_throttled_total']),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark latency under a flooding client and a reconnect storm.")
+    parser.add_argument('--modes', default='asyncio,threaded')
+    parser.add_argument('--talkers', type=int, default=20)
+    parser.add_argument('--msg-rate', type=float, default=2.0, help="messages per second per talker")
+    parser.add_argument('--storm', type=int, default=1000, help="clients connecting at once mid-run")
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--max-connections', type=int, default=200)
+    parser.add_argument('--message-rate', type=float, default=10.0)
+    parser.add_argument('--byte-rate', type=float, default=65536)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.modes.split(','):
+        for limited in (False, True):
+            result = asyncio.run(run(mode, limited, args))
+            results.append(result)
+            print(f"{mode:>9} limits {result['limits']:>3}: talkers p50 {result['talker_p50_ms']:8.2f} ms  "
+                  f"p99 {result['talker_p99_ms']:8.2f} ms  max {result['talker_max_ms']:8.2f} ms  "
+                  f"({result['talker_messages']} msgs)  flood {result['flood_delivered_per_s']:6d}/s  "
+                  f"storm {result['storm_admitted']} in / {result['storm_rejected']} rejected / "
+                  f"{result['storm_failed']} failed")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
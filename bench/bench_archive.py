@@ -0,0 +1,168 @@
+# bench_archive.py
+# History retention (server/archive.py): how fast the archiver moves aged
+# messages out of the history store into compressed segments, how small they
+# get, and how long a page of archived history takes to read back.
+#
+#   python bench/bench_archive.py --messages 1000000 --codecs zlib,zstd --block-bytes 16384,65536,262144
+#
+# A SQLite store is filled once with --messages spread evenly over --days,
+# across --rooms rooms plus --dm-share direct messages, and copied for every
+# codec and block size. The archiver then moves everything older than
+# --hot-days into the archive. Reads are /older-sized pages of one room (and
+# one user's direct messages) before a random point in the archived range:
+# cold with the block cache emptied before each, warm with it filled, and
+# the same page from the full store before archiving for comparison.
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import benchutil
+
+sys.path.insert(0, benchutil.SERVER_DIR)
+import archive  # noqa: E402
+import compressors  # noqa: E402
+import storage  # noqa: E402
+from rooms import DIRECT  # noqa: E402
+
+WORDS = ['hello', 'deploy', 'lunch', 'ok', 'thanks', 'build', 'green', 'red', 'ship', 'review', 'later', 'done']
+
+
+def fill(path, args, now):
+    store = storage.SQLiteStore(path)
+    start = now - args.days * 86400
+    step = args.days * 86400 / args.messages
+    batch = []
+    for i in range(args.messages):
+        document = {
+            '_id': storage.new_message_id(),
+            'sender_name': f"user-{random.randrange(args.users)}",
+            'message': ' '.join(random.choice(WORDS) for _ in range(random.randint(2, 16))),
+            'room': f"room-{random.randrange(args.rooms)}",
+            'timestamp': storage.from_epoch(start + i * step),
+        }
+        if random.random() < args.dm_share:
+            document['room'], document['recipient'] = DIRECT, f"user-{random.randrange(args.users)}"
+        batch.append(document)
+        if len(batch) == 5000:
+            store.insert_many(batch)
+            batch = []
+    if batch:
+        store.insert_many(batch)
+    # Fold the WAL into the file so a plain copy carries everything.
+    store._writer.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    store.close()
+
+
+def measure(fn, calls, before_each=None):
+    samples = []
+    for args in calls:
+        if before_each is not None:
+            before_each()
+        t0 = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - t0) * 1e6)
+    samples.sort()
+    return round(benchutil.percentile(samples, 50), 1), round(benchutil.percentile(samples, 99), 1)
+
+
+def bench(codec, block_bytes, args, workdir, reference, now):
+    path = os.path.join(workdir, f"hot-{codec}-{block_bytes}.db")
+    shutil.copy(reference, path)
+    store = storage.SQLiteStore(path)
+    directory = os.path.join(workdir, f"archive-{codec}-{block_bytes}")
+    arc = archive.Archive(directory, writable=True, codec=codec, block_bytes=block_bytes)
+    archiver = archive.Archiver(store, arc, args.hot_days * 86400)
+    t0 = time.perf_counter()
+    moved = archiver.run_once(now)
+    elapsed = time.perf_counter() - t0
+    hot_rows = store._reader().execute('SELECT COUNT(*) FROM chat_history').fetchone()[0]
+
+    # Random pages in the archived range, the same ones for every reader.
+    full = storage.SQLiteStore(reference)
+    archived_until = now - args.hot_days * 86400
+    first = now - args.days * 86400
+    rooms = [f"room-{random.randrange(args.rooms)}" for _ in range(args.repeat)]
+    befores = [storage.from_epoch(random.uniform(first + 3600, archived_until)) for _ in range(args.repeat)]
+    users = [f"user-{random.randrange(args.users)}" for _ in range(args.repeat)]
+    pages = [(args.page, before, room) for before, room in zip(befores, rooms)]
+    dm_pages = [(user, args.page, before) for user, before in zip(users, befores)]
+    cold = measure(arc.history, pages, arc.clear_cache)
+    warm = measure(arc.history, pages)
+    tiered = measure(archive.ArchivedStore(store, arc).history, pages, arc.clear_cache)
+    stored = measure(full.history, pages)
+    dm_cold = measure(arc.direct_history, dm_pages[:max(3, args.repeat // 10)], arc.clear_cache)
+    dm_stored = measure(full.direct_history, dm_pages[:max(3, args.repeat // 10)])
+    full.close()
+    store.close()
+
+    raw = sum(entry[archive.RAW_SIZE] for segment in arc.segments
+              for entries in segment.runs.values() for entry in entries)
+    stats = arc.stats()
+    row = {
+        'codec': arc.codec.name,
+        'block_bytes': block_bytes,
+        'archived': moved,
+        'hot_rows': hot_rows,
+        'segments': stats['segments'],
+        'archive_seconds': round(elapsed, 2),
+        'archive_msgs_per_s': round(moved / elapsed),
+        'raw_mb': round(raw / 2**20, 1),
+        'archive_mb': round(stats['bytes'] / 2**20, 1),
+        'ratio': round(raw / stats['bytes'], 2),
+        'cold_p50_us': cold[0], 'cold_p99_us': cold[1],
+        'warm_p50_us': warm[0], 'warm_p99_us': warm[1],
+        'through_store_p50_us': tiered[0],
+        'unarchived_p50_us': stored[0], 'unarchived_p99_us': stored[1],
+        'dm_cold_p50_us': dm_cold[0], 'dm_unarchived_p50_us': dm_stored[0],
+    }
+    print(f"{row['codec']:>5} {block_bytes // 1024:4d} KB blocks: archived {moved} in {elapsed:6.2f}s "
+          f"({row['archive_msgs_per_s']:7d}/s), {row['raw_mb']} MB -> {row['archive_mb']} MB "
+          f"(x{row['ratio']}) in {row['segments']} segments, {hot_rows} left hot")
+    print(f"{'':>5} page of {args.page}: cold p50 {cold[0]:8.1f} us p99 {cold[1]:8.1f} us, "
+          f"warm p50 {warm[0]:8.1f} us, via the store {tiered[0]:8.1f} us, unarchived {stored[0]:8.1f} us; "
+          f"DMs cold {dm_cold[0]:9.1f} us, unarchived {dm_stored[0]:8.1f} us")
+    shutil.rmtree(directory)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark history archiving and archived-range reads.")
+    parser.add_argument('--messages', type=int, default=500000)
+    parser.add_argument('--days', type=float, default=90)
+    parser.add_argument('--hot-days', type=float, default=7, help="retention: history younger than this stays in the store")
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--dm-share', type=float, default=0.05)
+    parser.add_argument('--codecs', default=','.join(sorted(compressors.CODECS)))
+    parser.add_argument('--block-bytes', default='16384,65536,262144')
+    parser.add_argument('--page', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    now = time.time()
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        reference = os.path.join(workdir, 'reference.db')
+        t0 = time.perf_counter()
+        fill(reference, args, now)
+        print(f"stored {args.messages} messages over {args.days:g} days in {time.perf_counter() - t0:.1f}s")
+        for codec in args.codecs.split(','):
+            if codec not in compressors.CODECS:
+                print(f"{codec} is not available here; skipped")
+                continue
+            for block_bytes in (int(n) for n in args.block_bytes.split(',')):
+                results.append(bench(codec, block_bytes, args, workdir, reference, now))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# bench_broadcast.py
+# Fan-out cost per delivered message: how many socket writes and encodes the
+# server spends and how many bytes it copies, read from its own /metrics
+# counters, next to the delivered throughput.
+#
+#   python bench/bench_broadcast.py --receivers 200 --messages 2000 --burst 20
+#
+# One sender pushes chat in bursts of --burst frames into a room of
+# --receivers clients. With per-tick coalescing a burst should reach each
+# receiver in far fewer writes than frames, and every message should be
+# encoded once however many receivers it has.
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+import urllib.request
+
+import benchutil
+
+sys.path.insert(0, benchutil.SERVER_DIR)
+import protocol  # noqa: E402
+
+COUNTERS = ('chat_frames_encoded_total', 'chat_frames_written_total', 'chat_socket_writes_total',
+            'chat_bytes_written_total', 'chat_bytes_copied_total')
+
+
+class Receiver(asyncio.Protocol):
+    def __init__(self):
+        self.decoder = protocol.FrameDecoder()
+        self.delivered = 0
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+        for ftype, _ in self.decoder.frames():
+            if ftype == protocol.MESSAGE:
+                self.delivered += 1
+
+
+def scrape(port):
+    values = {}
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+        for line in response.read().decode('utf-8').splitlines():
+            name, _, value = line.partition(' ')
+            if name in COUNTERS:
+                values[name] = float(value)
+    return values
+
+
+async def run_mode(mode, args):
+    port, metrics_port = benchutil.free_port(), benchutil.free_port()
+    env = {'METRICS_PORT': str(metrics_port), 'TCP_NODELAY': '1' if args.nodelay else '0'}
+    proc = benchutil.start_server(mode, port, env=env)
+    loop = asyncio.get_running_loop()
+    receivers = []
+    try:
+        for i in range(args.receivers):
+            _, receiver = await loop.create_connection(Receiver, '127.0.0.1', port)
+            receiver.transport.write(protocol.encode_json(protocol.HELLO, {'name': f"rx-{i}", 'version': 1}))
+            receivers.append(receiver)
+        _, sender = await loop.create_connection(Receiver, '127.0.0.1', port)
+        sender.transport.write(protocol.encode_json(protocol.HELLO, {'name': 'tx', 'version': 1}))
+        await asyncio.sleep(1.0)
+
+        before = scrape(metrics_port)
+        expected = args.messages * args.receivers
+        text = 'x' * args.size
+        start = time.perf_counter()
+        for sent in range(0, args.messages, args.burst):
+            burst = b''.join(protocol.encode_frame(protocol.CHAT, f"{sent + i} {text}".encode('utf-8'))
+                             for i in range(min(args.burst, args.messages - sent)))
+            sender.transport.write(burst)
+            await asyncio.sleep(args.gap)
+        deadline = time.monotonic() + 60
+        while sum(r.delivered for r in receivers) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0.2)
+        after = scrape(metrics_port)
+    finally:
+        for r in receivers:
+            r.transport.abort()
+        benchutil.stop_server(proc)
+
+    delivered = sum(r.delivered for r in receivers)
+    delta = {name: after.get(name, 0) - before.get(name, 0) for name in COUNTERS}
+    frames = delta['chat_frames_written_total'] or 1
+    return {
+        'mode': mode,
+        'receivers': args.receivers,
+        'messages': args.messages,
+        'burst': args.burst,
+        'tcp_nodelay': args.nodelay,
+        'delivered': delivered,
+        'delivered_per_s': round(delivered / elapsed),
+        'encodes_per_message': round(delta['chat_frames_encoded_total'] / args.messages, 3),
+        'writes_per_delivery': round(delta['chat_socket_writes_total'] / frames, 3),
+        'frames_per_write': round(frames / (delta['chat_socket_writes_total'] or 1), 2),
+        'bytes_copied_per_delivery': round(delta['chat_bytes_copied_total'] / frames, 1),
+        'bytes_per_delivery': round(delta['chat_bytes_written_total'] / frames, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark broadcast fan-out costs.")
+    parser.add_argument('--modes', default='threaded,asyncio')
+    parser.add_argument('--receivers', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--burst', type=int, default=20, help="frames the sender writes at once")
+    parser.add_argument('--gap', type=float, default=0.005, help="seconds between bursts")
+    parser.add_argument('--size', type=int, default=64, help="chat text size in bytes")
+    parser.add_argument('--no-nodelay', dest='nodelay', action='store_false', help="leave Nagle on")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.modes.split(','):
+        result = asyncio.run(run_mode(mode, args))
+        results.append(result)
+        print(f"{mode:>9}: {result['delivered_per_s']:8d} deliveries/s  "
+              f"encodes/msg {result['encodes_per_message']:5.3f}  "
+              f"writes/delivery {result['writes_per_delivery']:5.3f} ({result['frames_per_write']:5.2f} frames/write)  "
+              f"copied {result['bytes_copied_per_delivery']:6.1f} of {result['bytes_per_delivery']:6.1f} B/delivery")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# bench_client_render.py
+# Client-side display cost against incoming message rate: the terminal UI
+# (client/tui.py), which batches events into at most RENDER_FPS frames a
+# second, next to the old print-per-message loop.
+#
+#   python bench/bench_client_render.py --rates 10,100,1000,10000 --seconds 5
+#
+# Time is simulated: each run feeds --seconds worth of messages at the given
+# rate and advances the UI clock between them, so the figures are CPU time
+# and terminal output per second of traffic, not wall-clock throughput. The
+# UI draws to a stand-in screen that counts the characters curses would have
+# had to lay out. The print loop writes to an in-memory sink, so its CPU
+# figure leaves out what the terminal itself spends on every line; compare
+# the characters written instead.
+
+import argparse
+import io
+import json
+import sys
+import time
+
+import benchutil
+
+sys.path.insert(0, benchutil.CLIENT_DIR)
+import client  # noqa: E402
+import tui  # noqa: E402
+
+
+class CountingScreen:
+    """The few curses window calls ChatUI makes, counting characters drawn."""
+
+    def __init__(self, height, width):
+        self.size = (height, width)
+        self.chars = 0
+
+    def getmaxyx(self):
+        return self.size
+
+    def erase(self):
+        pass
+
+    def addnstr(self, y, x, text, n, attr=0):
+        self.chars += min(len(text), n)
+
+    def move(self, y, x):
+        pass
+
+    def refresh(self):
+        pass
+
+
+class Session:
+    name = 'bench'
+    room = 'lobby'
+    outbox = ()
+
+
+def messages(rate, seconds):
+    for i in range(int(rate * seconds)):
+        yield i / rate, {'id': str(i), 'from': f"user-{i % 50}", 'text': f"message number {i} " + 'x' * 40}
+
+
+def run_tui(rate, args):
+    screen = CountingScreen(args.height, args.width)
+    ui = tui.ChatUI(screen, Session(), client.render, fps=args.fps)
+    start = time.process_time()
+    for at, fields in messages(rate, args.seconds):
+        ui.on_event('message', fields)
+        ui.tick(now=at)
+    ui.tick(now=args.seconds + 1)
+    cpu = time.process_time() - start
+    return {'frames': ui.frames, 'cpu': cpu, 'output': screen.chars}
+
+
+def run_print(rate, args):
+    sink = io.StringIO()
+    chars = 0
+    start = time.process_time()
+    for _, fields in messages(rate, args.seconds):
+        line = f"\r{client.render('message', fields)}\n{Session.name}: "
+        print(line, end="", file=sink)
+        chars += len(line)
+        # Keep the sink from growing; a terminal would have taken the write.
+        sink.seek(0)
+    cpu = time.process_time() - start
+    return {'frames': int(rate * args.seconds), 'cpu': cpu, 'output': chars}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark client rendering against message rate.")
+    parser.add_argument('--rates', default='10,100,1000,10000', help="incoming messages per second")
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--fps', type=float, default=tui.RENDER_FPS)
+    parser.add_argument('--height', type=int, default=50)
+    parser.add_argument('--width', type=int, default=120)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for rate in (float(r) for r in args.rates.split(',')):
+        for name, run in (('tui', run_tui), ('print', run_print)):
+            measured = run(rate, args)
+            result = {
+                'renderer': name,
+                'msgs_per_s': rate,
+                'redraws_per_s': round(measured['frames'] / args.seconds, 1),
+                'cpu_ms_per_s': round(measured['cpu'] / args.seconds * 1e3, 2),
+                'chars_out_per_s': round(measured['output'] / args.seconds),
+            }
+            results.append(result)
+            print(f"{name:>5} at {rate:8.0f} msgs/s: {result['redraws_per_s']:8.1f} redraws/s  "
+                  f"{result['cpu_ms_per_s']:8.2f} ms CPU/s  {result['chars_out_per_s']:9d} chars/s")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# bench_compression.py
+# What per-message compression buys and costs for each available codec:
+# compression ratio and microseconds to compress and decompress, for short
+# chat lines, pasted logs and a history replay, and the per-message cost of
+# compressing once for a whole room against compressing per recipient.
+#
+#   python bench/bench_compression.py --recipients 100 --rounds 2000
+#
+# Payloads below COMPRESS_THRESHOLD are sent as they are, so the short chat
+# row shows why the threshold exists rather than what the server does.
+
+import argparse
+import json
+import random
+import sys
+import time
+
+import benchutil
+
+sys.path.insert(0, benchutil.SERVER_DIR)
+import compressors  # noqa: E402
+import protocol  # noqa: E402
+
+WORDS = ('the', 'server', 'room', 'message', 'hello', 'is', 'anyone', 'here', 'deploy', 'failed',
+         'again', 'retry', 'looks', 'good', 'to', 'me', 'ok', 'lunch', 'build', 'green')
+
+
+def chat_line(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+
+
+def log_paste(rng, lines=40):
+    out = []
+    for i in range(lines):
+        out.append(f"2024-05-0{rng.randint(1, 9)}T12:{i % 60:02d}:{rng.randint(0, 59):02d}Z "
+                   f"{rng.choice(('INFO', 'WARN', 'ERROR'))} worker-{rng.randint(1, 8)} "
+                   f"request id={rng.getrandbits(32):08x} took {rng.randint(1, 900)}ms {chat_line(rng)}")
+    return '\n'.join(out)
+
+
+def history_replay(rng, messages=50):
+    """The bytes a joining client is replayed: one framed MESSAGE per line."""
+    return b''.join(
+        protocol.Outgoing.chat(f"user-{rng.randint(1, 20)}", chat_line(rng), message_id=str(i)).framed()
+        for i in range(messages))
+
+
+def payloads(rng):
+    return {
+        'chat line': protocol.Outgoing.chat('alice', chat_line(rng)).framed_parts()[1],
+        'log paste': protocol.Outgoing.chat('alice', log_paste(rng)).framed_parts()[1],
+        'history replay': history_replay(rng),
+    }
+
+
+def per_call_us(fn, data, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(data)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def measure_codec(codec, name, data, rounds):
+    compressed = codec.compress(data)
+    return {
+        'codec': codec.name,
+        'payload': name,
+        'bytes': len(data),
+        'compressed_bytes': len(compressed),
+        'ratio': round(len(data) / len(compressed), 2),
+        'compress_us': round(per_call_us(codec.compress, data, rounds), 2),
+        'decompress_us': round(per_call_us(lambda d: codec.decompress(d, protocol.MAX_PAYLOAD),
+                                           compressed, rounds), 2),
+    }
+
+
+def measure_fanout(codec, text, recipients, rounds):
+    """Microseconds per broadcast to `recipients` compressing clients."""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        outgoing = protocol.Outgoing.chat('alice', text)
+        for _ in range(recipients):
+            outgoing.buffers(True, codec)
+    shared = (time.perf_counter() - start) / rounds * 1e6
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for _ in range(recipients):
+            protocol.Outgoing.chat('alice', text).buffers(True, codec)
+    separate = (time.perf_counter() - start) / rounds * 1e6
+    return {'codec': codec.name, 'recipients': recipients,
+            'compress_once_us': round(shared, 1), 'per_recipient_us': round(separate, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-message compression codecs.")
+    parser.add_argument('--codecs', default=','.join(compressors.CODECS))
+    parser.add_argument('--rounds', type=int, default=2000)
+    parser.add_argument('--recipients', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    data = payloads(rng)
+    fanout_text = log_paste(rng)
+    codecs = [compressors.CODECS[name] for name in args.codecs.split(',') if name in compressors.CODECS]
+    results = {'threshold': compressors.COMPRESS_THRESHOLD, 'codecs': [], 'fanout': []}
+    for codec in codecs:
+        for name, payload in data.items():
+            row = measure_codec(codec, name, payload, args.rounds)
+            results['codecs'].append(row)
+            print(f"{row['codec']:>5} {row['payload']:>15}: {row['bytes']:7d} -> {row['compressed_bytes']:7d} B "
+                  f"(x{row['ratio']:5.2f})  compress {row['compress_us']:8.2f} us  "
+                  f"decompress {row['decompress_us']:8.2f} us")
+    for codec in codecs:
+        row = measure_fanout(codec, fanout_text, args.recipients, max(1, args.rounds // args.recipients))
+        results['fanout'].append(row)
+        print(f"{row['codec']:>5} fan-out to {row['recipients']}: compress once {row['compress_once_us']:9.1f} us/msg  "
+              f"per recipient {row['per_recipient_us']:9.1f} us/msg")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# bench_direct.py
+# Cost of addressing users by name, and of paging one user's direct
+# messages, as the number of sessions and the history grow.
+#
+#   python bench/bench_direct.py --sessions 1000,10000,100000 --messages 100000,1000000
+#
+# The name lookups compare the NameIndex (server/names.py) with scanning the
+# connection set for a matching name, the way /msg, the HELLO name check and
+# /who would otherwise find a user. The history part stores --dm-share of
+# the messages as direct messages between --users users in SQLite, and times
+# direct_history() with the recipient and sender indexes and then with them
+# dropped.
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import benchutil
+
+sys.path.insert(0, benchutil.SERVER_DIR)
+import hub  # noqa: E402
+import session  # noqa: E402
+import storage  # noqa: E402
+from rooms import DIRECT  # noqa: E402
+
+DIRECT_INDEXES = ('chat_history_recipient_timestamp', 'chat_history_direct_sender_timestamp')
+
+
+class NullConn(session.Session):
+    __slots__ = ()
+
+    def send(self, outgoing):
+        pass
+
+
+def measure(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1e6)
+    samples.sort()
+    return round(benchutil.percentile(samples, 50), 2)
+
+
+def bench_names(count, repeat):
+    chat = hub.ChatHub(lambda *a: None)
+    for i in range(count):
+        conn = NullConn(('127.0.0.1', i))
+        conn.name = f"user-{i}"
+        chat.names.claim(conn)
+        chat.clients.add(conn)
+    names = [f"user-{random.randrange(count)}" for _ in range(repeat)]
+    it = iter(names * 2)
+
+    def scan():
+        name = next(it).casefold()
+        with chat.clients_lock:
+            return next((c for c in chat.clients if c.name.casefold() == name), None)
+
+    return {
+        'sessions': count,
+        'lookup_index_us': measure(lambda: chat.names.get(next(it)), repeat),
+        'lookup_scan_us': measure(scan, repeat),
+        'who_us': measure(chat.names.names, max(3, repeat // 100)),
+    }
+
+
+def fill(store, count, users, dm_share, start):
+    batch = []
+    for i in range(count):
+        sender = random.choice(users)
+        document = {
+            '_id': storage.new_message_id(),
+            'sender_name': sender,
+            'message': f"message number {i}",
+            'room': 'lobby',
+            'timestamp': start + timedelta(milliseconds=i),
+        }
+        if random.random() < dm_share:
+            document['room'], document['recipient'] = DIRECT, random.choice(users)
+        batch.append(document)
+        if len(batch) == 5000:
+            store.insert_many(batch)
+            batch = []
+    if batch:
+        store.insert_many(batch)
+
+
+def bench_history(store, users, repeat):
+    picks = iter([random.choice(users) for _ in range(4 * repeat)])
+    return {
+        'user_us': measure(lambda: store.direct_history(next(picks), limit=50), repeat),
+        'pair_us': measure(lambda: store.direct_history(next(picks), limit=50, peer=next(picks)), repeat),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark name lookups and direct message history.")
+    parser.add_argument('--sessions', default='1000,10000,100000')
+    parser.add_argument('--messages', default='100000,1000000')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--dm-share', type=float, default=0.05)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = {'names': [], 'history': []}
+    for count in (int(n) for n in args.sessions.split(',')):
+        result = bench_names(count, args.repeat)
+        results['names'].append(result)
+        print(f"{count:>7} sessions: lookup {result['lookup_index_us']:8.2f} us indexed, "
+              f"{result['lookup_scan_us']:10.2f} us scanning; /who listing {result['who_us']:10.2f} us")
+
+    users = [f"user-{i}" for i in range(args.users)]
+    start, stored = datetime(2024, 1, 1), 0
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'bench.db')
+        for size in (int(n) for n in args.messages.split(',')):
+            store = storage.SQLiteStore(path)
+            fill(store, size - stored, users, args.dm_share, start + timedelta(milliseconds=stored))
+            stored = size
+            indexed = bench_history(store, users, args.repeat)
+            with store._writer:
+                for name in DIRECT_INDEXES:
+                    store._writer.execute(f'DROP INDEX {name}')
+            scanned = bench_history(store, users, max(3, args.repeat // 50))
+            store.close()
+            result = {'messages': size, 'indexed': indexed, 'unindexed': scanned}
+            results['history'].append(result)
+            print(f"{size:>9} messages: one user's DMs {indexed['user_us']:9.1f} us indexed, "
+                  f"{scanned['user_us']:11.1f} us without; one pair {indexed['pair_us']:9.1f} us / "
+                  f"{scanned['pair_us']:11.1f} us")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
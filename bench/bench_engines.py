@@ -0,0 +1,131 @@
+# bench_engines.py
+# Compares the threaded and asyncio server engines: resident memory per
+# connected client and end-to-end broadcast latency to every client.
+#
+#   python bench/bench_engines.py --connections 2000 --rounds 50
+#
+# Each engine runs in its own child process so its RSS can be sampled in
+# isolation. The simulated clients live in this process on one event loop.
+
+import argparse
+import asyncio
+import json
+import time
+
+import benchutil
+
+
+class BenchClient(asyncio.Protocol):
+    """Headless client that only watches for broadcast markers."""
+
+    def __init__(self):
+        self.transport = None
+        self.bytes_received = 0
+        self.waiting_for = None
+        self.arrived = None
+        self._tail = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.bytes_received += len(data)
+        if self.waiting_for is None:
+            return
+        # A marker can straddle two reads, so keep a short tail around.
+        window = self._tail + data
+        if self.waiting_for in window:
+            self.waiting_for = None
+            self._tail = b''
+            self.arrived.set_result(time.perf_counter())
+        else:
+            self._tail = window[-64:]
+
+    def expect(self, marker):
+        self.waiting_for = marker
+        self._tail = b''
+        self.arrived = asyncio.get_running_loop().create_future()
+        return self.arrived
+
+
+async def settle(clients, quiet_for=0.5, timeout=120.0):
+    """Waits until the clients stop receiving data (join announcements drained)."""
+    deadline = time.monotonic() + timeout
+    last = -1
+    while time.monotonic() < deadline:
+        total = sum(c.bytes_received for c in clients)
+        if total == last:
+            return
+        last = total
+        await asyncio.sleep(quiet_for)
+
+
+async def run_engine(mode, connections, rounds):
+    port = benchutil.free_port()
+    proc = benchutil.start_server(mode, port)
+    loop = asyncio.get_running_loop()
+    clients = []
+    try:
+        await asyncio.sleep(0.3)
+        base_rss = benchutil.rss_kb(proc.pid)
+
+        for i in range(connections):
+            _, client = await loop.create_connection(BenchClient, '127.0.0.1', port)
+            client.transport.write(f"bench-{i}".encode('utf-8'))
+            clients.append(client)
+        await settle(clients)
+        loaded_rss = benchutil.rss_kb(proc.pid)
+
+        sender, receivers = clients[0], clients[1:]
+        first, last = [], []
+        for seq in range(rounds):
+            marker = f"@mark-{seq}@".encode('utf-8')
+            futures = [c.expect(marker) for c in receivers]
+            start = time.perf_counter()
+            sender.transport.write(marker)
+            arrivals = await asyncio.wait_for(asyncio.gather(*futures), timeout=60)
+            first.append((min(arrivals) - start) * 1e3)
+            last.append((max(arrivals) - start) * 1e3)
+            await asyncio.sleep(0.01)
+    finally:
+        for c in clients:
+            c.transport.abort()
+        benchutil.stop_server(proc)
+
+    first.sort()
+    last.sort()
+    return {
+        'mode': mode,
+        'connections': connections,
+        'rss_base_kb': base_rss,
+        'rss_loaded_kb': loaded_rss,
+        'kb_per_connection': round((loaded_rss - base_rss) / connections, 2),
+        'first_delivery_ms_p50': round(benchutil.percentile(first, 50), 3),
+        'all_delivered_ms_p50': round(benchutil.percentile(last, 50), 3),
+        'all_delivered_ms_p99': round(benchutil.percentile(last, 99), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the server engines.")
+    parser.add_argument('--modes', default='threaded,asyncio')
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=30)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.modes.split(','):
+        result = asyncio.run(run_engine(mode, args.connections, args.rounds))
+        results.append(result)
+        print(f"{mode:>9}: {result['kb_per_connection']:8.2f} KiB/conn  "
+              f"first {result['first_delivery_ms_p50']:8.3f} ms  "
+              f"all p50 {result['all_delivered_ms_p50']:8.3f} ms  "
+              f"all p99 {result['all_delivered_ms_p99']:8.3f} ms")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
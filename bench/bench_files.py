@@ -0,0 +1,182 @@
+# bench_files.py
+# File transfer throughput, and what it does to chat latency, against a live
+# server: /get downloads go out with sendfile() a chunk at a time behind any
+# queued chat, and /send uploads come in under the credit window.
+#
+#   python bench/bench_files.py --modes asyncio,threaded --chunk-sizes 16384,65536,262144
+#
+# A talker says a timestamped line every --chat-interval seconds to a reader
+# in the same room. Each phase runs for --seconds: no transfers, then the
+# reader itself and --downloaders others pulling --file-mb files over and
+# over, then --uploaders clients sending fresh files, then both. Chat latency
+# is measured at the reader, whose own connection carries a download in the
+# transfer phases, so it shows how long a chat line waits behind a chunk.
+# Clients run the real client's ChatClient in this process.
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+import benchutil
+
+sys.path.insert(0, benchutil.CLIENT_DIR)
+import client as chat_client  # noqa: E402
+
+PHASES = ('idle', 'downloads', 'uploads', 'both')
+
+
+class Session:
+    """One ChatClient and the events the benchmark waits on."""
+
+    def __init__(self, name, port):
+        self.saved = asyncio.Queue()
+        self.on_message = None
+        self.client = chat_client.ChatClient(name, '127.0.0.1', port, on_event=self._event)
+        self.task = asyncio.ensure_future(self.client.run())
+
+    def _event(self, kind, fields):
+        if kind == 'message' and self.on_message is not None:
+            self.on_message(fields)
+        elif kind in ('system', 'error') and fields['text'].startswith(('Saved ', 'Could not')):
+            self.saved.put_nowait(fields['text'])
+
+    async def ready(self):
+        while not self.client.connected:
+            await asyncio.sleep(0.01)
+
+    async def close(self):
+        self.client.close()
+        await self.task
+
+
+async def download_loop(session, file_id, size, stop, moved):
+    while not stop.is_set():
+        session.client.send(f"/get {file_id}")
+        text = await session.saved.get()
+        if not text.startswith('Saved '):
+            raise RuntimeError(text)
+        os.unlink(text.split(' to ', 1)[1][:-1])
+        moved['down'] += size
+
+
+async def upload_loop(session, path, size, stop, moved):
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        while not stop.is_set():
+            # New leading bytes each round, or commit() would drop the upload as a second copy.
+            os.pwrite(fd, os.urandom(16), 0)
+            if not await session.client.send_file(path):
+                raise RuntimeError(f"upload of {path} failed")
+            moved['up'] += size
+    finally:
+        os.close(fd)
+
+
+async def run_phase(phase, args, reader, talker, downloaders, uploaders, file_id, paths, size):
+    latencies = []
+    stop = asyncio.Event()
+    moved = {'down': 0, 'up': 0}
+
+    def on_message(fields):
+        if fields.get('from') == talker.client.name:
+            latencies.append((time.perf_counter() - float(fields['text'])) * 1000)
+
+    reader.on_message = on_message
+    jobs = []
+    if phase in ('downloads', 'both'):
+        jobs += [download_loop(s, file_id, size, stop, moved) for s in [reader] + downloaders]
+    if phase in ('uploads', 'both'):
+        jobs += [upload_loop(s, path, size, stop, moved) for s, path in zip(uploaders, paths)]
+    tasks = [asyncio.ensure_future(job) for job in jobs]
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.seconds:
+        talker.client.send(repr(time.perf_counter()))
+        await asyncio.sleep(args.chat_interval)
+    stop.set()
+    elapsed = time.perf_counter() - start
+    # Let the last lines arrive and the transfers finish their current file.
+    await asyncio.gather(*tasks)
+    await asyncio.sleep(0.2)
+    reader.on_message = None
+    latencies.sort()
+    return {
+        'phase': phase,
+        'chat_lines': len(latencies),
+        'chat_p50_ms': round(benchutil.percentile(latencies, 50), 2),
+        'chat_p99_ms': round(benchutil.percentile(latencies, 99), 2),
+        'chat_max_ms': round(latencies[-1], 2) if latencies else None,
+        'download_mb_s': round(moved['down'] / 2**20 / elapsed, 1),
+        'upload_mb_s': round(moved['up'] / 2**20 / elapsed, 1),
+    }
+
+
+async def bench(mode, chunk_size, args, workdir):
+    port = benchutil.free_port()
+    env = {'BLOB_DIR': os.path.join(workdir, f"blobs-{mode}-{chunk_size}"), 'FILE_CHUNK_SIZE': str(chunk_size)}
+    server = benchutil.start_server(mode, port, env=env)
+    size = int(args.file_mb * 2**20)
+    paths = []
+    for i in range(max(1, args.uploaders)):
+        path = os.path.join(workdir, f"upload-{i}.bin")
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        paths.append(path)
+    sessions = []
+    try:
+        reader, talker = Session('reader', port), Session('talker', port)
+        downloaders = [Session(f"down-{i}", port) for i in range(args.downloaders)]
+        uploaders = [Session(f"up-{i}", port) for i in range(args.uploaders)]
+        sessions = [reader, talker] + downloaders + uploaders
+        for session in sessions:
+            await session.ready()
+        if not await talker.client.send_file(paths[0]):
+            raise RuntimeError("could not upload the download file")
+        file_id = chat_client.file_digest(paths[0])[:16]
+        # Let the server settle after storing it before the idle phase.
+        await asyncio.sleep(1)
+        rows = []
+        for phase in PHASES:
+            row = await run_phase(phase, args, reader, talker, downloaders, uploaders, file_id, paths, size)
+            row.update(mode=mode, chunk_size=chunk_size)
+            rows.append(row)
+            print(f"{mode:>8} chunk {chunk_size // 1024:4d} KB {phase:>9}: chat p50 {row['chat_p50_ms']:7.2f} ms "
+                  f"p99 {row['chat_p99_ms']:7.2f} ms max {row['chat_max_ms']:7.2f} ms  "
+                  f"down {row['download_mb_s']:7.1f} MB/s  up {row['upload_mb_s']:7.1f} MB/s")
+        return rows
+    finally:
+        for session in sessions:
+            await session.close()
+        benchutil.stop_server(server)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark file transfers and chat latency during them.")
+    parser.add_argument('--modes', default='asyncio,threaded')
+    parser.add_argument('--chunk-sizes', default='16384,65536,262144')
+    parser.add_argument('--file-mb', type=float, default=16)
+    parser.add_argument('--downloaders', type=int, default=2)
+    parser.add_argument('--uploaders', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--chat-interval', type=float, default=0.02)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results, cwd = [], os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # /get saves into the client's DOWNLOAD_DIR, relative to here.
+        os.chdir(workdir)
+        for mode in args.modes.split(','):
+            for chunk_size in (int(n) for n in args.chunk_sizes.split(',')):
+                results += asyncio.run(bench(mode, chunk_size, args, workdir))
+        os.chdir(cwd)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# bench_history.py
+# Replay latency of the in-memory recent-history ring versus paging the same
+# number of messages out of the store, as the collection grows.
+#
+#   python bench/bench_history.py --sizes 10000,100000,1000000
+#
+# The ring replay is what a client pays on join; the store page is what
+# /older pays. Only the second should grow with the collection.
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import benchutil
+
+sys.path.insert(0, benchutil.SERVER_DIR)
+import hub  # noqa: E402
+import session  # noqa: E402
+import storage  # noqa: E402
+
+
+class NullConn(session.Session):
+    """Stands in for a connection; counts what would have been queued."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0))
+        self.name = 'bench'
+        self.framed = True
+        self.sent = 0
+
+    def send(self, outgoing):
+        outgoing.buffers(self.framed)
+        self.sent += 1
+
+
+def fill(store, count, rooms, start):
+    batch = []
+    for i in range(count):
+        batch.append({
+            '_id': storage.new_message_id(),
+            'sender_name': f"user-{i % 300}",
+            'message': f"message number {i}",
+            'room': rooms[i % len(rooms)],
+            'timestamp': start + timedelta(milliseconds=i),
+        })
+        if len(batch) == 5000:
+            store.insert_many(batch)
+            batch = []
+    if batch:
+        store.insert_many(batch)
+
+
+def measure(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1e6)
+    samples.sort()
+    return round(benchutil.percentile(samples, 50), 1), round(benchutil.percentile(samples, 99), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark history replay and paging.")
+    parser.add_argument('--sizes', default='10000,100000')
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--ring', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=300)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    rooms = [f"room-{i}" for i in range(args.rooms)]
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        store = storage.SQLiteStore(os.path.join(workdir, 'bench.db'))
+        start = datetime(2024, 1, 1)
+        stored = 0
+        for size in sorted(int(s) for s in args.sizes.split(',')):
+            fill(store, size - stored, rooms, start + timedelta(milliseconds=stored))
+            stored = size
+            chat = hub.ChatHub(lambda *a: None, store)
+            chat.recent.size = args.ring
+            t0 = time.perf_counter()
+            chat.warm_recent()
+            warm_ms = (time.perf_counter() - t0) * 1e3
+            conn = NullConn()
+
+            ring_p50, ring_p99 = measure(lambda: chat.replay_recent(conn, rooms[0]), args.repeat)
+
+            def page():
+                before = start + timedelta(milliseconds=random.randrange(size))
+                store.history(limit=args.ring, before=before, room=random.choice(rooms))
+            page_p50, page_p99 = measure(page, args.repeat)
+
+            result = {'messages': size, 'warm_ms': round(warm_ms, 1), 'ring_replay_us_p50': ring_p50, 'ring_replay_us_p99': ring_p99,
+                      'store_page_us_p50': page_p50, 'store_page_us_p99': page_p99}
+            results.append(result)
+            print(f"{size:>9} msgs: warm {warm_ms:6.1f} ms  ring replay p50 {ring_p50:8.1f} us p99 {ring_p99:8.1f} us  "
+                  f"store page p50 {page_p50:8.1f} us p99 {page_p99:8.1f} us")
+        store.close()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
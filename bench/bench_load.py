@@ -0,0 +1,336 @@
+# bench_load.py
+# Load generator: thousands of headless simulated clients against a server,
+# reporting end-to-end delivery latency, throughput and the server's CPU and
+# memory use.
+#
+#   python bench/bench_load.py --connections 2000 --msg-rate 1 --rooms 50 --json load.json
+#   python bench/bench_load.py --baseline load.json          # flag regressions
+#   python bench/bench_load.py --target 127.0.0.1:65432 --server-pid 1234
+#
+# Clients are spread over several load processes. Every chat message carries
+# its send time (CLOCK_MONOTONIC, shared by all processes on the machine), so
+# each delivery is timed from the sender's write to the recipient's read.
+# Only messages sent inside the measurement window are counted.
+#
+# --client chat drives the real client's ChatClient sessions (headless, with
+# reconnects) instead of the bare SimClient protocol, e.g. to watch a fleet
+# ride out a server restart.
+
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import benchutil
+
+sys.path.insert(0, benchutil.SERVER_DIR)
+sys.path.insert(0, benchutil.CLIENT_DIR)
+import client as chat_client  # noqa: E402
+import protocol  # noqa: E402
+
+# Latencies are kept in logarithmic buckets 2% wide, so percentiles over
+# millions of deliveries cost a small dict instead of a list.
+BUCKET_BASE = 1.02
+
+
+class LatencyHistogram:
+    """Log-bucketed latency counts in microseconds; mergeable across processes."""
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or {}
+        self.count = sum(self.buckets.values())
+
+    def add(self, micros):
+        bucket = int(math.log(max(micros, 1.0), BUCKET_BASE))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        for bucket, n in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + n
+        self.count += other.count
+
+    def percentile(self, pct):
+        """Upper edge of the bucket holding the pct-th percentile, in ms."""
+        if not self.count:
+            return float('nan')
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return BUCKET_BASE ** (bucket + 1) / 1000.0
+        return BUCKET_BASE ** (max(self.buckets) + 1) / 1000.0
+
+
+class SimClient(asyncio.Protocol):
+    """Headless framed client that times the chat messages delivered to it."""
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.transport = None
+        self.decoder = protocol.FrameDecoder()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+        for ftype, payload in self.decoder.frames():
+            if ftype != protocol.MESSAGE:
+                continue
+            now = time.monotonic_ns()
+            text = json.loads(bytes(payload))['text']
+            if text.startswith('@'):
+                sent = int(text[1:text.index('@', 1)])
+                self.stats.delivered(sent, now)
+
+
+class ChatSession:
+    """A client.ChatClient session with SimClient's timing and write interface."""
+
+    def __init__(self, stats, name, host, port):
+        self.stats = stats
+        self.session = chat_client.ChatClient(name, host, port, on_event=self.on_event)
+        self.task = asyncio.ensure_future(self.session.run())
+
+    def on_event(self, kind, fields):
+        if kind == 'message' and fields['text'].startswith('@'):
+            text = fields['text']
+            self.stats.delivered(int(text[1:text.index('@', 1)]), time.monotonic_ns())
+
+    def send(self, text):
+        self.session.send(text)
+
+    def close(self):
+        self.session.close()
+
+
+class ProcessStats:
+    """What one load process measured inside the window."""
+
+    def __init__(self):
+        self.window = (0, 0)
+        self.sent = 0
+        self.delivered_count = 0
+        self.latency = LatencyHistogram()
+
+    def in_window(self, sent_ns):
+        return self.window[0] <= sent_ns < self.window[1]
+
+    def delivered(self, sent_ns, now_ns):
+        if self.in_window(sent_ns):
+            self.delivered_count += 1
+            self.latency.add((now_ns - sent_ns) / 1000.0)
+
+
+def room_weights(rooms, distribution, skew):
+    if distribution == 'zipf':
+        return [1.0 / (rank + 1) ** skew for rank in range(rooms)]
+    return [1.0] * rooms
+
+
+async def run_clients(index, args, count, schedule, results):
+    loop = asyncio.get_running_loop()
+    stats = ProcessStats()
+    rng = random.Random(args.seed + index)
+    rooms = rng.choices(range(args.rooms), room_weights(args.rooms, args.room_dist, args.zipf_skew), k=count)
+    host, port = args.target
+    join_gap = args.procs / args.join_rate if args.join_rate > 0 else 0
+    clients = []
+    join_started = time.monotonic()
+    for i, room in enumerate(rooms):
+        if args.client == 'chat':
+            client = ChatSession(stats, f"sim-{index}-{i}", host, port)
+            client.send(f"/join room-{room}")
+        else:
+            _, client = await loop.create_connection(lambda: SimClient(stats), host, port)
+            client.transport.write(protocol.encode_json(protocol.HELLO, {'name': f"sim-{index}-{i}", 'version': 1}))
+            client.transport.write(protocol.encode_frame(protocol.CHAT, f"/join room-{room}".encode('utf-8')))
+        clients.append(client)
+        if join_gap:
+            await asyncio.sleep(join_gap)
+    join_seconds = time.monotonic() - join_started
+    results.put(('ready', index, join_seconds))
+
+    start_at, record_from, record_until, stop_at = await loop.run_in_executor(None, schedule.get)
+    stats.window = (record_from, record_until)
+    await asyncio.sleep(max(0, (start_at - time.monotonic_ns()) / 1e9))
+    padding = 'x' * max(0, args.msg_size - 22)
+    interval = 1.0 / args.msg_rate
+
+    async def talk(client):
+        # Spread the senders over the interval instead of firing in lockstep.
+        await asyncio.sleep(rng.random() * interval)
+        while time.monotonic_ns() < stop_at:
+            sent = time.monotonic_ns()
+            if args.client == 'chat':
+                client.send(f"@{sent}@{padding}")
+            else:
+                client.transport.write(protocol.encode_frame(protocol.CHAT, f"@{sent}@{padding}".encode('utf-8')))
+            if stats.in_window(sent):
+                stats.sent += 1
+            await asyncio.sleep(interval)
+
+    await asyncio.gather(*(talk(c) for c in clients))
+    # Let the last messages of the window arrive.
+    await asyncio.sleep(args.drain)
+    for c in clients:
+        if args.client == 'chat':
+            c.close()
+        else:
+            c.transport.abort()
+    results.put(('done', index, {'sent': stats.sent, 'delivered': stats.delivered_count,
+                                 'buckets': stats.latency.buckets}))
+
+
+def load_process(index, args, count, schedule, results):
+    asyncio.run(run_clients(index, args, count, schedule, results))
+
+
+def run(args):
+    proc = None
+    if args.target is None:
+        port = benchutil.free_port()
+        proc = benchutil.start_server(args.mode, port, workers=args.workers)
+        args.target = ('127.0.0.1', port)
+        server_pid = proc.pid
+    else:
+        server_pid = args.server_pid
+    try:
+        ctx = multiprocessing.get_context('fork')
+        results = ctx.Queue()
+        schedules = [ctx.Queue() for _ in range(args.procs)]
+        counts = [args.connections // args.procs + (1 if i < args.connections % args.procs else 0)
+                  for i in range(args.procs)]
+        loaders = [ctx.Process(target=load_process, args=(i, args, counts[i], schedules[i], results))
+                   for i in range(args.procs)]
+        for loader in loaders:
+            loader.start()
+        join_seconds = max(results.get(timeout=600)[2] for _ in loaders)
+
+        # Every process starts sending at the same moment; the window opens
+        # after the warm-up and the senders stop shortly after it closes.
+        now = time.monotonic_ns()
+        start_at = now + int(0.2e9)
+        record_from = start_at + int(args.warmup * 1e9)
+        record_until = record_from + int(args.duration * 1e9)
+        stop_at = record_until + int(0.2e9)
+        for schedule in schedules:
+            schedule.put((start_at, record_from, record_until, stop_at))
+
+        cpu_start = cpu_end = rss_peak = None
+        if server_pid:
+            time.sleep(max(0, (record_from - time.monotonic_ns()) / 1e9))
+            cpu_start, rss_peak = benchutil.tree_usage(server_pid)
+            while time.monotonic_ns() < record_until:
+                time.sleep(min(0.5, max(0, (record_until - time.monotonic_ns()) / 1e9)))
+                cpu_end, rss = benchutil.tree_usage(server_pid)
+                rss_peak = max(rss_peak, rss)
+
+        latency = LatencyHistogram()
+        sent = delivered = 0
+        for _ in loaders:
+            _, _, partial = results.get(timeout=args.warmup + args.duration + args.drain + 600)
+            sent += partial['sent']
+            delivered += partial['delivered']
+            latency.merge(LatencyHistogram(partial['buckets']))
+        for loader in loaders:
+            loader.join()
+    finally:
+        if proc is not None:
+            benchutil.stop_server(proc)
+
+    result = {
+        'config': {
+            'mode': args.mode if proc is not None else None,
+            'client': args.client,
+            'workers': args.workers if proc is not None else None,
+            'connections': args.connections,
+            'join_rate': args.join_rate,
+            'msg_rate': args.msg_rate,
+            'msg_size': args.msg_size,
+            'rooms': args.rooms,
+            'room_dist': args.room_dist,
+            'duration_s': args.duration,
+        },
+        'join_seconds': round(join_seconds, 2),
+        'sent_per_s': round(sent / args.duration, 1),
+        'delivered_per_s': round(delivered / args.duration, 1),
+        'latency_ms_p50': round(latency.percentile(50), 3),
+        'latency_ms_p99': round(latency.percentile(99), 3),
+        'latency_ms_p999': round(latency.percentile(99.9), 3),
+    }
+    if cpu_start is not None:
+        result['server_cpu_pct'] = round((cpu_end - cpu_start) / args.duration * 100, 1)
+        result['server_rss_peak_kb'] = rss_peak
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """Returns the metrics that got worse than `baseline` by more than `tolerance` percent."""
+    worse = []
+    higher_is_worse = ('latency_ms_p50', 'latency_ms_p99', 'latency_ms_p999', 'server_cpu_pct', 'server_rss_peak_kb')
+    for key in higher_is_worse + ('delivered_per_s',):
+        if key not in result or key not in baseline or not baseline[key]:
+            continue
+        change = (result[key] - baseline[key]) / baseline[key] * 100
+        if key == 'delivered_per_s':
+            change = -change
+        if change > tolerance:
+            worse.append(f"{key}: {baseline[key]} -> {result[key]} ({change:+.1f}% worse)")
+    return worse
+
+
+def parse_target(text):
+    host, _, port = text.rpartition(':')
+    return host, int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive simulated clients against a chat server.")
+    parser.add_argument('--mode', default='asyncio', help="engine of the server started for the run")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--target', type=parse_target, help="host:port of an already running server")
+    parser.add_argument('--server-pid', type=int, help="pid of that server, for CPU and RSS")
+    parser.add_argument('--client', choices=('sim', 'chat'), default='sim',
+                        help="bare protocol clients, or client.py's reconnecting sessions")
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--join-rate', type=float, default=500.0, help="new connections per second (0 = no limit)")
+    parser.add_argument('--msg-rate', type=float, default=1.0, help="messages per second per connection")
+    parser.add_argument('--msg-size', type=int, default=64, help="chat text size in bytes")
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--room-dist', choices=('uniform', 'zipf'), default='uniform')
+    parser.add_argument('--zipf-skew', type=float, default=1.0)
+    parser.add_argument('--procs', type=int, default=max(1, min(4, os.cpu_count() or 1)),
+                        help="load processes the connections are spread over")
+    parser.add_argument('--warmup', type=float, default=2.0)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--drain', type=float, default=2.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--baseline', help="results file of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=10.0, help="allowed regression in percent")
+    args = parser.parse_args()
+
+    result = run(args)
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            worse = compare(result, json.load(f), args.tolerance)
+        for line in worse:
+            print(f"REGRESSION {line}")
+        if worse:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
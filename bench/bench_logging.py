@@ -0,0 +1,120 @@
+# bench_logging.py
+# Broadcast throughput through ChatHub under each logging mode:
+#
+#   sync           format and write every record inline (what print() did)
+#   async          hand records to the background writer
+#   async-sampled  the same, keeping one [BROADCAST] record in --sample
+#   off            LOG_LEVEL=warning, broadcasts are never logged
+#
+#   python bench/bench_logging.py --messages 50000 --recipients 10
+#
+# Records go line-buffered to a pipe drained by a child process (--sink pipe,
+# like a container's log pipe) or to a file, so every line is its own
+# write() the way an unbuffered stdout is. The async figures are what the
+# message path sees; the writer's drain time is reported separately. Each
+# mode runs --repeat times and keeps its best.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import benchutil
+
+sys.path.insert(0, benchutil.SERVER_DIR)
+import hub  # noqa: E402
+import log  # noqa: E402
+import session  # noqa: E402
+
+MODES = {
+    'sync': dict(mode=log.SYNC),
+    'async': dict(mode=log.ASYNC),
+    'async-sampled': dict(mode=log.ASYNC),
+    'off': dict(mode=log.ASYNC, level=log.WARNING),
+}
+
+
+class NullConn(session.Session):
+    """Stands in for a connection; encodes what would have been queued."""
+
+    def __init__(self, name):
+        super().__init__(('127.0.0.1', 0))
+        self.name = name
+        self.framed = True
+
+    def send(self, outgoing):
+        outgoing.buffers(self.framed)
+
+
+def run_mode(name, args, stream):
+    options = dict(MODES[name])
+    sampling = {'BROADCAST': args.sample} if name == 'async-sampled' else {}
+    log.LOGGER = log.Logger(options.get('level', log.INFO), 'text', options['mode'],
+                            buffer_size=args.buffer, sampling=sampling, stream=stream)
+    chat = hub.ChatHub(lambda *a: None)
+    conns = [NullConn(f"user-{i}") for i in range(args.recipients + 1)]
+    for conn in conns:
+        chat.rooms.add(conn)
+    sender = conns[0]
+
+    start = time.perf_counter()
+    for i in range(args.messages):
+        chat.handle_message(sender, f"message number {i}")
+    hot = time.perf_counter() - start
+    log.LOGGER.flush()
+    total = time.perf_counter() - start
+    stats = log.LOGGER.stats()
+    return {
+        'mode': name,
+        'msgs_per_s': round(args.messages / hot),
+        'hot_path_us': round(hot / args.messages * 1e6, 2),
+        'drain_ms': round((total - hot) * 1e3, 1),
+        'written': stats['written'],
+        'dropped': stats['dropped'],
+        'sampled_out': stats['sampled_out'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the logging modes.")
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--recipients', type=int, default=10)
+    parser.add_argument('--buffer', type=int, default=log.LOG_BUFFER)
+    parser.add_argument('--sample', type=int, default=100)
+    parser.add_argument('--sink', choices=('pipe', 'file'), default='pipe')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.modes.split(','):
+            runs = []
+            for _ in range(args.repeat):
+                if args.sink == 'pipe':
+                    reader = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+                    stream = open(reader.stdin.fileno(), 'w', buffering=1, closefd=False)
+                else:
+                    reader = None
+                    stream = open(os.path.join(workdir, f'{name}.log'), 'w', buffering=1)
+                with stream:
+                    runs.append(run_mode(name, args, stream))
+                if reader is not None:
+                    reader.stdin.close()
+                    reader.wait()
+            result = max(runs, key=lambda r: r['msgs_per_s'])
+            results.append(result)
+            print(f"{name:>14}: {result['msgs_per_s']:8d} msgs/s  {result['hot_path_us']:7.2f} us/msg  "
+                  f"drain {result['drain_ms']:7.1f} ms  written {result['written']:6d}  "
+                  f"dropped {result['dropped']:6d}  sampled out {result['sampled_out']:6d}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# bench_metrics.py
+# Cost of the metrics instrumentation on the message path: the same
+# broadcasts through ChatHub with metrics.ENABLED off and on, plus the cost
+# of rendering a scrape.
+#
+#   python bench/bench_metrics.py --recipients 1,10,100 --messages 20000
+#
+# Recipients are in-memory stand-ins, so what is left is the hub's own work
+# and whatever the instrumentation adds to it.
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+import benchutil
+
+sys.path.insert(0, benchutil.SERVER_DIR)
+import hub  # noqa: E402
+import metrics  # noqa: E402
+import session  # noqa: E402
+
+
+class NullConn(session.Session):
+    """Stands in for a connection; encodes what would have been queued."""
+
+    def __init__(self, name):
+        super().__init__(('127.0.0.1', 0))
+        self.name = name
+        self.framed = True
+
+    def send(self, outgoing):
+        outgoing.buffers(self.framed)
+
+
+def make_hub(recipients):
+    chat = hub.ChatHub(lambda *a: None)
+    conns = [NullConn(f"user-{i}") for i in range(recipients + 1)]
+    for conn in conns:
+        chat.rooms.add(conn)
+    return chat, conns[0]
+
+
+def per_message_us(chat, sender, messages, enabled):
+    metrics.ENABLED = enabled
+    start = time.perf_counter()
+    for _ in range(messages):
+        chat.handle_message(sender, "hello everyone", time.perf_counter())
+    return (time.perf_counter() - start) / messages * 1e6
+
+
+def compare(recipients, messages, repeat):
+    """Best of `repeat` runs each way, alternating so drift hits both equally."""
+    chat, sender = make_hub(recipients)
+    off = on = float('inf')
+    for _ in range(repeat):
+        off = min(off, per_message_us(chat, sender, messages, False))
+        on = min(on, per_message_us(chat, sender, messages, True))
+    return off, on
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the metrics overhead.")
+    parser.add_argument('--recipients', default='1,10,100')
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=9)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    # handle_message logs every broadcast; keep the terminal out of the timing.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for recipients in (int(r) for r in args.recipients.split(',')):
+            off, on = compare(recipients, args.messages, args.repeat)
+            results.append({'recipients': recipients, 'off_us': round(off, 3), 'on_us': round(on, 3),
+                            'overhead_us': round(on - off, 3), 'overhead_pct': round((on - off) / off * 100, 1)})
+
+    start = time.perf_counter()
+    scrapes = 1000
+    for _ in range(scrapes):
+        metrics.REGISTRY.render()
+    render_us = (time.perf_counter() - start) / scrapes * 1e6
+
+    for r in results:
+        print(f"{r['recipients']:>5} recipients: off {r['off_us']:8.3f} us/msg  on {r['on_us']:8.3f} us/msg  "
+              f"overhead {r['overhead_us']:6.3f} us ({r['overhead_pct']:+.1f}%)")
+    print(f"scrape render: {render_us:.1f} us")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'per_message': results, 'render_us': round(render_us, 1)}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
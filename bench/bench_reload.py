@@ -0,0 +1,194 @@
+# bench_reload.py
+# What clients see of a zero-downtime reload (server/handoff.py): the server
+# is replaced by a new process with --takeover while they chat, and the
+# benchmark counts disconnects, lost and duplicated messages, and the
+# longest a message took to arrive across the handoff.
+#
+#   python bench/bench_reload.py --modes asyncio,threaded --clients 200 --reloads 3
+#
+# Every client sits in the lobby; --senders of them say a numbered,
+# timestamped line every --interval seconds, and every client checks it
+# receives each line exactly once. Each server runs the SQLite store, the
+# search index and the file store in a temporary directory, like a real
+# node. The handoff timings are read from the servers' JSON logs: the old
+# process's quiesce, drain, flush and transfer phases, and how long after
+# asking for them the new one was serving the connections. Clients run the
+# real client's ChatClient in this process, so on a small machine too high
+# a --senders/--interval rate backs them up until the server's drop-oldest
+# send queues discard lines, which count as lost.
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import benchutil
+
+sys.path.insert(0, benchutil.CLIENT_DIR)
+import client as chat_client  # noqa: E402
+
+
+def launch(mode, port, workdir, generation, takeover=False):
+    """Starts a whole server node (store included) that logs JSON to a file."""
+    call = f"server.start_server({mode!r}, 'sqlite', 1, {port}, takeover={takeover})"
+    code = f"import sys; sys.path.insert(0, {benchutil.SERVER_DIR!r}); import server; {call}"
+    env = dict(os.environ, **benchutil.UNLIMITED)
+    env.update(RELOAD_SOCKET=os.path.join(workdir, 'reload.sock'), LOG_FORMAT='json',
+               SQLITE_PATH=os.path.join(workdir, 'chat.db'), SEARCH_DIR=os.path.join(workdir, 'search'),
+               BLOB_DIR=os.path.join(workdir, 'blobs'), PERSIST_JOURNAL=os.path.join(workdir, 'journal.jsonl'))
+    log_path = os.path.join(workdir, f"server-{generation}.log")
+    with open(log_path, 'w') as out:
+        proc = subprocess.Popen([sys.executable, '-c', code], stdout=out, stderr=subprocess.STDOUT, env=env)
+    return proc, log_path
+
+
+def handoff_records(log_path):
+    records = []
+    with open(log_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('event') in ('HANDOFF', 'HANDOFF ERROR'):
+                records.append(entry)
+    return records
+
+
+async def wait_for(predicate, timeout, what):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"timed out waiting for {what}")
+        await asyncio.sleep(0.05)
+
+
+class Receiver:
+    """One ChatClient and what it has received from the senders."""
+
+    def __init__(self, name, port, senders):
+        self.seen = {sender: set() for sender in senders}
+        self.duplicates = 0
+        self.latencies = []
+        self.client = chat_client.ChatClient(name, '127.0.0.1', port, on_event=self._event)
+        self.task = asyncio.ensure_future(self.client.run())
+
+    def _event(self, kind, fields):
+        if kind != 'message' or fields.get('from') not in self.seen:
+            return
+        seq, _, sent = fields['text'].partition(' ')
+        seen = self.seen[fields['from']]
+        if int(seq) in seen:
+            self.duplicates += 1
+            return
+        seen.add(int(seq))
+        self.latencies.append((time.time(), (time.perf_counter() - float(sent)) * 1000))
+
+    async def close(self):
+        self.client.close()
+        await self.task
+
+
+async def bench(mode, args, workdir):
+    port = benchutil.free_port()
+    proc, log_path = launch(mode, port, workdir, 0)
+    logs = [log_path]
+    receivers = []
+    try:
+        benchutil.wait_for_port('127.0.0.1', port)
+        names = [f"user-{i}" for i in range(args.clients)]
+        senders = names[:args.senders]
+        receivers = [Receiver(name, port, senders) for name in names]
+        await wait_for(lambda: all(r.client.connected for r in receivers), 30, "clients to connect")
+        sent = {name: 0 for name in senders}
+        stop = asyncio.Event()
+
+        async def talk():
+            while not stop.is_set():
+                for receiver in receivers[:args.senders]:
+                    name = receiver.client.name
+                    receiver.client.send(f"{sent[name]} {time.perf_counter()!r}")
+                    sent[name] += 1
+                await asyncio.sleep(args.interval)
+
+        talker = asyncio.ensure_future(talk())
+        reload_times = []
+        for generation in range(1, args.reloads + 1):
+            await asyncio.sleep(args.settle)
+            reload_times.append(time.time())
+            successor, log_path = launch(mode, port, workdir, generation, takeover=True)
+            logs.append(log_path)
+            # The old process exits once it has handed everything over.
+            await wait_for(lambda: proc.poll() is not None, 60, "the old server to exit")
+            proc = successor
+            await wait_for(lambda: any('inherited' in r['msg'] for r in handoff_records(log_path)),
+                           60, "the new server to serve")
+        await asyncio.sleep(args.settle)
+        stop.set()
+        await talker
+        # Let the last lines arrive.
+        await asyncio.sleep(1)
+    finally:
+        for receiver in receivers:
+            await receiver.close()
+        benchutil.stop_server(proc)
+
+    expected = sum(sent.values()) * (args.clients - 1)
+    received = sum(len(seen) for r in receivers for name, seen in r.seen.items() if name != r.client.name)
+    latencies = sorted(ms for r in receivers for _, ms in r.latencies)
+    # The stall a reload causes: the slowest delivery within two seconds after it started.
+    stalls = [max((ms for r in receivers for at, ms in r.latencies if start <= at < start + 2), default=0.0)
+              for start in reload_times]
+    old = [r for path in logs for r in handoff_records(path) if 'total' in r]
+    new = [r for path in logs for r in handoff_records(path) if 'inherited' in r['msg']]
+    row = {
+        'mode': mode,
+        'clients': args.clients,
+        'reloads': args.reloads,
+        'handoffs': len(old),
+        'reconnects': sum(r.client.connects - 1 for r in receivers),
+        'messages_expected': expected,
+        'messages_lost': expected - received,
+        'duplicates': sum(r.duplicates for r in receivers),
+        'delivery_p50_ms': round(benchutil.percentile(latencies, 50), 2),
+        'stall_max_ms': round(max(stalls, default=0.0), 1),
+        'handoff_total_ms': [round(r['total'] * 1000, 1) for r in old],
+        'quiesce_ms': [round(r['quiesce'] * 1000, 1) for r in old],
+        'drain_ms': [round(r['drain'] * 1000, 1) for r in old],
+        'flush_ms': [round(r['flush'] * 1000, 1) for r in old],
+        'transfer_ms': [round(r['transfer'] * 1000, 1) for r in old],
+        'serving_after_ms': [round(r['seconds'] * 1000, 1) for r in new],
+    }
+    print(f"{mode:>8} {args.clients} clients, {len(old)}/{args.reloads} handoffs: {row['reconnects']} reconnects, "
+          f"{row['messages_lost']} of {expected} lost, {row['duplicates']} duplicates; max stall {row['stall_max_ms']} ms")
+    print(f"{'':>8} handoff {row['handoff_total_ms']} ms (quiesce {row['quiesce_ms']}, drain {row['drain_ms']}, "
+          f"flush {row['flush_ms']}, transfer {row['transfer_ms']}); new process serving after {row['serving_after_ms']} ms")
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark what clients see of a zero-downtime reload.")
+    parser.add_argument('--modes', default='asyncio,threaded')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--senders', type=int, default=5)
+    parser.add_argument('--interval', type=float, default=0.1)
+    parser.add_argument('--reloads', type=int, default=3)
+    parser.add_argument('--settle', type=float, default=2.0, help="seconds of chat before and between reloads")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.modes.split(','):
+        with tempfile.TemporaryDirectory() as workdir:
+            results.append(asyncio.run(bench(mode, args, workdir)))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+# bench_scaling.py
+# Delivered chat throughput of the asyncio engine as the number of worker
+# processes grows (see server/supervisor.py).
+#
+#   python bench/bench_scaling.py --workers 1,2,4,8 --connections 2000
+#
+# The load runs in several client processes so the clients are not the
+# bottleneck. Connections are spread over rooms; each one sends chat at a
+# fixed rate and every MESSAGE frame received counts as one delivery. On a
+# machine with fewer cores than workers the extra workers only add bus hops.
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import benchutil
+
+sys.path.insert(0, benchutil.SERVER_DIR)
+import protocol  # noqa: E402
+
+
+class LoadClient(asyncio.Protocol):
+    """Framed client that counts the chat messages delivered to it."""
+
+    def __init__(self):
+        self.transport = None
+        self.decoder = protocol.FrameDecoder()
+        self.delivered = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+        for ftype, _ in self.decoder.frames():
+            if ftype == protocol.MESSAGE:
+                self.delivered += 1
+
+
+async def run_load(port, first, count, rooms, rate, warmup, duration):
+    loop = asyncio.get_running_loop()
+    clients = []
+    for i in range(first, first + count):
+        _, client = await loop.create_connection(LoadClient, '127.0.0.1', port)
+        client.transport.write(protocol.encode_json(protocol.HELLO, {'name': f"load-{i}", 'version': 1}))
+        client.transport.write(protocol.encode_frame(protocol.CHAT, f"/join room-{i % rooms}".encode('utf-8')))
+        clients.append(client)
+
+    async def talk(client, index):
+        # Stagger the senders so the load is spread over each interval.
+        await asyncio.sleep((index % 100) / 100.0 / rate)
+        seq = 0
+        while True:
+            client.transport.write(protocol.encode_frame(protocol.CHAT, f"msg {seq}".encode('utf-8')))
+            seq += 1
+            await asyncio.sleep(1.0 / rate)
+
+    talkers = [asyncio.ensure_future(talk(c, i)) for i, c in enumerate(clients)]
+    await asyncio.sleep(warmup)
+    before = sum(c.delivered for c in clients)
+    await asyncio.sleep(duration)
+    delivered = sum(c.delivered for c in clients) - before
+    for task in talkers:
+        task.cancel()
+    for c in clients:
+        c.transport.abort()
+    return delivered
+
+
+def load_process(port, first, count, rooms, rate, warmup, duration, results):
+    results.put(asyncio.run(run_load(port, first, count, rooms, rate, warmup, duration)))
+
+
+def measure(workers, args):
+    port = benchutil.free_port()
+    proc = benchutil.start_server('asyncio', port, workers=workers)
+    try:
+        time.sleep(0.5)
+        ctx = multiprocessing.get_context('fork')
+        results = ctx.Queue()
+        per_proc = args.connections // args.client_procs
+        loaders = [ctx.Process(target=load_process,
+                               args=(port, p * per_proc, per_proc, args.rooms, args.rate,
+                                     args.warmup, args.duration, results))
+                   for p in range(args.client_procs)]
+        for loader in loaders:
+            loader.start()
+        delivered = sum(results.get(timeout=args.warmup + args.duration + 120) for _ in loaders)
+        for loader in loaders:
+            loader.join()
+    finally:
+        benchutil.stop_server(proc)
+    return {
+        'workers': workers,
+        'connections': per_proc * args.client_procs,
+        'rooms': args.rooms,
+        'offered_msgs_per_s': per_proc * args.client_procs * args.rate,
+        'delivered_per_s': round(delivered / args.duration),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark throughput against the worker count.")
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=2.0, help="messages per second per connection")
+    parser.add_argument('--client-procs', type=int, default=max(1, min(4, os.cpu_count() or 1)))
+    parser.add_argument('--warmup', type=float, default=3.0)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for workers in (int(w) for w in args.workers.split(',')):
+        result = measure(workers, args)
+        results.append(result)
+        print(f"{workers:>3} workers: offered {result['offered_msgs_per_s']:8.0f} msgs/s  "
+              f"delivered {result['delivered_per_s']:9d} msgs/s")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+# bench_search.py
+# /search over a growing corpus: indexing throughput of the segment index
+# (server/search.py) and query latency against it, next to the same queries
+# as a LIKE scan of the SQLite history table, which is what a search without
+# an index costs.
+#
+#   python bench/bench_search.py --checkpoints 250000,500000,1000000,2000000
+#
+# Messages draw their words from a Zipf-distributed vocabulary, their senders
+# from a Zipf-distributed user base and their room uniformly, two seconds
+# apart. At every checkpoint each query is run --repeat times on both sides;
+# index latency should stay close to flat while the scan grows with the
+# corpus.
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import benchutil
+
+sys.path.insert(0, benchutil.SERVER_DIR)
+import search  # noqa: E402
+import storage  # noqa: E402
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'pa', 'do', 'gu', 'he', 'ji', 'bo', 'fe']
+START = datetime(2024, 1, 1)
+SPACING = timedelta(seconds=2)
+CHUNK = 10000
+
+
+def vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+
+def zipf_weights(size, exponent=1.1):
+    return list(itertools.accumulate(1.0 / (rank + 1) ** exponent for rank in range(size)))
+
+
+class Corpus:
+    """Deterministic synthetic chat, generated a chunk at a time."""
+
+    def __init__(self, args):
+        self.rng = random.Random(args.seed)
+        self.words = vocabulary(args.vocabulary, self.rng)
+        self.word_weights = zipf_weights(len(self.words))
+        self.senders = [f"user{i}" for i in range(args.senders)]
+        self.sender_weights = zipf_weights(len(self.senders))
+        self.rooms = [f"room{i}" for i in range(args.rooms)]
+        self.count = 0
+
+    def chunk(self, size):
+        rng = self.rng
+        lengths = [rng.randint(3, 15) for _ in range(size)]
+        words = rng.choices(self.words, cum_weights=self.word_weights, k=sum(lengths))
+        senders = rng.choices(self.senders, cum_weights=self.sender_weights, k=size)
+        documents, at = [], 0
+        for i, length in enumerate(lengths):
+            documents.append({
+                '_id': storage.new_message_id(),
+                'sender_name': senders[i],
+                'message': ' '.join(words[at:at + length]),
+                'room': rng.choice(self.rooms),
+                'timestamp': START + SPACING * (self.count + i),
+            })
+            at += length
+        self.count += size
+        return documents
+
+
+def queries(corpus, size):
+    """(label, search.Query, SQL conditions, params) for a corpus of `size` messages."""
+    words = corpus.words
+    rare, common, mid_a, mid_b = words[len(words) // 2], words[0], words[100], words[200]
+    early = storage.to_epoch(START + SPACING * (size // 10))
+    return [
+        ('rare word', search.Query([rare]), ['message LIKE ?'], [f'%{rare}%']),
+        ('common word', search.Query([common]), ['message LIKE ?'], [f'%{common}%']),
+        ('two words', search.Query([mid_a, mid_b]), ['message LIKE ?', 'message LIKE ?'],
+         [f'%{mid_a}%', f'%{mid_b}%']),
+        ('word in:room', search.Query([words[50]], room='room3'), ['message LIKE ?', 'room = ?'],
+         [f'%{words[50]}%', 'room3']),
+        ('word from:user', search.Query([words[20]], sender='user40'), ['message LIKE ?', 'sender_name = ?'],
+         [f'%{words[20]}%', 'user40']),
+        ('word until:early', search.Query([words[5]], until=early), ['message LIKE ?', 'timestamp < ?'],
+         [f'%{words[5]}%', early]),
+    ]
+
+
+def scan(conn, conditions, params, limit):
+    sql = ('SELECT id, sender_name, message, room, timestamp FROM chat_history WHERE '
+           + ' AND '.join(conditions) + ' ORDER BY timestamp DESC LIMIT ?')
+    return conn.execute(sql, params + [limit]).fetchall()
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return round(benchutil.percentile(samples, 50), 3), len(result)
+
+
+def grow(corpus, index, store, target):
+    """Adds messages up to `target`; returns seconds the indexer spent keeping up."""
+    index_seconds = 0.0
+    while corpus.count < target:
+        documents = corpus.chunk(min(CHUNK, target - corpus.count))
+        store.insert_many(documents)
+        t0 = time.perf_counter()
+        index.add(documents)
+        while index.indexed < corpus.count:
+            time.sleep(0.001)
+        index_seconds += time.perf_counter() - t0
+    return index_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /search indexing and queries against a table scan.")
+    parser.add_argument('--checkpoints', default='250000,500000,1000000,2000000')
+    parser.add_argument('--vocabulary', type=int, default=50000)
+    parser.add_argument('--senders', type=int, default=5000)
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--limit', type=int, default=search.SEARCH_RESULTS)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    corpus = Corpus(args)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        store = storage.SQLiteStore(os.path.join(workdir, 'history.db'))
+        index = search.SearchIndex(os.path.join(workdir, 'search', 'worker-0'))
+        conn = store._reader()
+        try:
+            for checkpoint in (int(size) for size in args.checkpoints.split(',')):
+                start_count = corpus.count
+                seconds = grow(corpus, index, store, checkpoint)
+                stats = index.stats()
+                result = {
+                    'messages': checkpoint,
+                    'index_docs_per_s': round((checkpoint - start_count) / seconds),
+                    'segments': stats['segments'],
+                    'merges': stats['merges'],
+                    'index_mb': round(stats['bytes'] / 2**20, 1),
+                    'queries': {},
+                }
+                print(f"{checkpoint:>9} messages: indexed {result['index_docs_per_s']} msg/s, "
+                      f"{result['segments']} segments, {result['index_mb']} MB")
+                for label, query, conditions, params in queries(corpus, checkpoint):
+                    index_ms, hits = timed(lambda: index.search(query, args.limit), args.repeat)
+                    scan_ms, rows = timed(lambda: scan(conn, conditions, params, args.limit), args.repeat)
+                    result['queries'][label] = {'index_ms': index_ms, 'scan_ms': scan_ms,
+                                                'index_hits': hits, 'scan_rows': rows}
+                    print(f"    {label:>17}: index {index_ms:9.3f} ms ({hits:2d} hits)  "
+                          f"scan {scan_ms:9.3f} ms ({rows:2d} rows)")
+                results.append(result)
+        finally:
+            index.close()
+            store.close()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+# bench_sessions.py
+# What idle connections cost: server RSS per 10k idle sessions for each
+# engine, the size of one Session object against the attribute-dict
+# connection it replaced, and the timer wheel's cost to watch them.
+#
+#   python bench/bench_sessions.py --sessions 10000 --modes asyncio,threaded
+#
+# The idle clients are framed, take part in heartbeats and then say nothing;
+# they live in this process on one event loop. Raise `ulimit -n` above twice
+# --sessions first (this process and the server each hold one end).
+
+import argparse
+import asyncio
+import gc
+import json
+import resource
+import sys
+import time
+import tracemalloc
+
+import benchutil
+
+sys.path.insert(0, benchutil.SERVER_DIR)
+import protocol  # noqa: E402
+import session  # noqa: E402
+
+
+class IdleClient(asyncio.Protocol):
+    """Says HELLO, answers PINGs and otherwise just holds the connection."""
+
+    def __init__(self, name):
+        self.name = name
+        self.transport = None
+        self.decoder = protocol.FrameDecoder()
+        self.welcomed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(protocol.encode_json(protocol.HELLO, {'name': self.name, 'version': 1, 'heartbeat': True}))
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+        for ftype, _ in self.decoder.frames():
+            if ftype == protocol.WELCOME:
+                self.welcomed = True
+            elif ftype == protocol.PING:
+                self.transport.write(protocol.PONG_FRAME)
+
+
+async def measure_server(mode, args):
+    port = benchutil.free_port()
+    proc = benchutil.start_server(mode, port, env={'LOG_LEVEL': 'warning'})
+    loop = asyncio.get_running_loop()
+    clients = []
+    try:
+        await asyncio.sleep(0.5)
+        base_rss = benchutil.rss_kb(proc.pid)
+        for i in range(args.sessions):
+            _, client = await loop.create_connection(lambda i=i: IdleClient(f"idle-{i}"), '127.0.0.1', port)
+            clients.append(client)
+        deadline = time.monotonic() + 120
+        while sum(c.welcomed for c in clients) < args.sessions and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(args.settle)
+        loaded_rss = benchutil.rss_kb(proc.pid)
+    finally:
+        for c in clients:
+            c.transport.abort()
+        benchutil.stop_server(proc)
+    welcomed = sum(c.welcomed for c in clients)
+    per_session = (loaded_rss - base_rss) / max(welcomed, 1)
+    return {
+        'mode': mode,
+        'sessions': args.sessions,
+        'welcomed': welcomed,
+        'rss_base_kb': base_rss,
+        'rss_loaded_kb': loaded_rss,
+        'kb_per_session': round(per_session, 2),
+        'mb_per_10k_sessions': round(per_session * 10000 / 1024, 1),
+    }
+
+
+class DictConn:
+    """The pre-Session connection shape: plain attributes in a __dict__."""
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.name = None
+        self.framed = None
+        self.codec = None
+        self.resume = None
+        self.outbox = None
+        self.history_cursor = None
+
+
+def object_bytes(make, count):
+    """Bytes traced while building `count` objects with make(i)."""
+    gc.collect()
+    tracemalloc.start()
+    objects = [make(i) for i in range(count)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return size
+
+
+def measure_objects(count):
+    addr = ('10.0.0.1', 50000)
+    sessions = object_bytes(lambda i: session.Session(addr), count)
+    # The old layout also kept a clients[conn] = name and a room_of[conn] = room entry.
+    old_clients, old_rooms = {}, {}
+
+    def old(i):
+        conn = DictConn(addr)
+        old_clients[conn] = f"user-{i}"
+        old_rooms[conn] = 'lobby'
+        return conn
+    dicts = object_bytes(old, count)
+    return {'session_bytes': round(sessions / count), 'dict_conn_bytes': round(dicts / count)}
+
+
+class WatchedSession(session.Session):
+    __slots__ = ()
+
+    def ping(self):
+        pass
+
+    def expire(self, reason):
+        self.closed = True
+
+
+def measure_monitor(count, interval=30.0):
+    """Timer-wheel cost of watching `count` heartbeat sessions that stay busy."""
+    monitor = session.SessionMonitor(interval=interval, idle_timeout=3 * interval, read_timeout=30.0, tick=1.0)
+    start = time.monotonic()
+    sessions = []
+    for i in range(count):
+        s = WatchedSession(('10.0.0.1', i))
+        s.name, s.framed, s.heartbeat = f"user-{i}", True, True
+        s.connected_at = s.last_seen = start
+        monitor.watch(s)
+        sessions.append(s)
+    # Simulated clock: every session is heard from each second, so each
+    # deadline that comes up is re-armed rather than acted on.
+    ticks, busiest, total = int(interval * 2), 0.0, 0.0
+    for t in range(1, ticks + 1):
+        now = start + t
+        for s in sessions:
+            s.last_seen = now
+        began = time.perf_counter()
+        monitor.check(now)
+        spent = time.perf_counter() - began
+        busiest, total = max(busiest, spent), total + spent
+    return {'watched': count, 'tick_ms_mean': round(total / ticks * 1e3, 3),
+            'tick_ms_max': round(busiest * 1e3, 3),
+            'expired': sum(s.closed for s in sessions)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the memory and timer cost of idle sessions.")
+    parser.add_argument('--modes', default='asyncio,threaded')
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--settle', type=float, default=2.0, help="seconds to wait before sampling RSS")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    results = {'objects': measure_objects(args.sessions), 'monitor': measure_monitor(args.sessions), 'servers': []}
+    objects, monitor = results['objects'], results['monitor']
+    print(f"Session object: {objects['session_bytes']} B  (attribute-dict connection + map entries: "
+          f"{objects['dict_conn_bytes']} B)")
+    print(f"Timer wheel over {monitor['watched']} sessions: {monitor['tick_ms_mean']:.3f} ms/tick mean, "
+          f"{monitor['tick_ms_max']:.3f} ms max")
+    for mode in args.modes.split(','):
+        result = asyncio.run(measure_server(mode, args))
+        results['servers'].append(result)
+        print(f"{mode:>9}: {result['welcomed']} idle sessions, {result['kb_per_session']:6.2f} KB each, "
+              f"{result['mb_per_10k_sessions']:6.1f} MB per 10k")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
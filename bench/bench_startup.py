@@ -0,0 +1,132 @@
+# bench_startup.py
+# Startup-to-first-accept: how long after `python server.py` a client gets
+# its WELCOME, and when the server reports the history store ready, with a
+# store that answers and with one that does not.
+#
+#   python bench/bench_startup.py --runs 5
+#   python bench/bench_startup.py --mongo-uri mongodb://127.0.0.1:27017/chat_application
+#
+# Each run starts the real entry point (server.py with a store, not the
+# database-less serve() the other benchmarks use) in a fresh directory,
+# polls the chat port from the moment of spawning, and reads the server's
+# own startup milestones from /readyz. The unreachable case points MongoDB
+# at a closed port.
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import benchutil
+
+sys.path.insert(0, benchutil.SERVER_DIR)
+import protocol  # noqa: E402
+
+SERVER_SCRIPT = os.path.join(benchutil.SERVER_DIR, 'server.py')
+
+
+def readyz(metrics_port):
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{metrics_port}/readyz', timeout=1) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return json.loads(e.read())
+
+
+def first_welcome(port, spawned, timeout):
+    """Seconds from `spawned` until a HELLO on `port` is answered with WELCOME."""
+    deadline = spawned + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1) as s:
+                s.sendall(protocol.encode_json(protocol.HELLO, {'name': 'probe', 'version': 1}))
+                decoder = protocol.FrameDecoder()
+                while True:
+                    data = s.recv(4096)
+                    if not data:
+                        break
+                    decoder.feed(data)
+                    for ftype, _ in decoder.frames():
+                        if ftype == protocol.WELCOME:
+                            return time.monotonic() - spawned
+        except OSError:
+            time.sleep(0.005)
+    return float('nan')
+
+
+def run_once(mode, backend, env, args):
+    port, metrics_port = benchutil.free_port(), benchutil.free_port()
+    workdir = tempfile.mkdtemp(prefix='chat-startup-')
+    child_env = dict(os.environ, METRICS_PORT=str(metrics_port), LOG_LEVEL='error',
+                     SQLITE_PATH=os.path.join(workdir, 'history.db'),
+                     PERSIST_JOURNAL=os.path.join(workdir, 'journal.jsonl'), **env)
+    spawned = time.monotonic()
+    proc = subprocess.Popen([sys.executable, SERVER_SCRIPT, '--mode', mode, '--storage', backend,
+                             '--port', str(port)], env=child_env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        welcome = first_welcome(port, spawned, args.timeout)
+        # Give a reachable store a moment to finish connecting.
+        deadline = time.monotonic() + args.store_wait
+        state = readyz(metrics_port)
+        while state['store'] != 'connected' and time.monotonic() < deadline:
+            time.sleep(0.05)
+            state = readyz(metrics_port)
+    finally:
+        benchutil.stop_server(proc)
+    startup = state['startup']
+    return {'welcome': welcome, 'listening': startup['listening_seconds'],
+            'store_ready': startup['store_ready_seconds'], 'store': state['store']}
+
+
+def median(values):
+    values = [v for v in values if v is not None]
+    return round(statistics.median(values), 3) if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark time from server start to first accept.")
+    parser.add_argument('--modes', default='threaded,asyncio')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--mongo-uri', help="also measure against a reachable MongoDB")
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--store-wait', type=float, default=3.0,
+                        help="seconds to wait for the store after the first WELCOME")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    cases = [('sqlite', 'sqlite', {}),
+             ('mongo down', 'mongo', {'MONGO_DATABASE_URI': f'mongodb://127.0.0.1:{benchutil.free_port()}/chat'})]
+    if args.mongo_uri:
+        cases.append(('mongo up', 'mongo', {'MONGO_DATABASE_URI': args.mongo_uri}))
+
+    results = []
+    for mode in args.modes.split(','):
+        for label, backend, env in cases:
+            runs = [run_once(mode, backend, env, args) for _ in range(args.runs)]
+            result = {
+                'mode': mode,
+                'store': label,
+                'welcome_s': median([r['welcome'] for r in runs]),
+                'listening_s': median([r['listening'] for r in runs]),
+                'store_ready_s': median([r['store_ready'] for r in runs]),
+                'store_state': runs[-1]['store'],
+            }
+            results.append(result)
+            ready = f"{result['store_ready_s']:.3f}s" if result['store_ready_s'] is not None else result['store_state']
+            print(f"{mode:>9} {label:>10}: listening {result['listening_s']:.3f}s  "
+                  f"first WELCOME {result['welcome_s']:.3f}s  store {ready}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# bench_storage.py
+# Insert throughput and history-read latency for each history backend.
+#
+#   python bench/bench_storage.py --messages 200000
+#   MONGO_DATABASE_URI=mongodb://localhost:27017 python bench/bench_storage.py --backends sqlite,mongo
+#
+# Inserts go through insert_many() in write-behind sized batches, the way
+# persistence.py drives the store. Reads page back through history() from
+# random points in the stored range.
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import benchutil
+
+sys.path.insert(0, benchutil.SERVER_DIR)
+import storage  # noqa: E402
+
+
+def make_documents(count, start):
+    words = ['hello', 'deploy', 'lunch', 'ok', 'thanks', 'build', 'green', 'red', 'ship', 'review']
+    for i in range(count):
+        yield {
+            '_id': storage.new_message_id(),
+            'sender_name': f"user-{i % 500}",
+            'message': ' '.join(random.choice(words) for _ in range(8)),
+            'timestamp': start + timedelta(milliseconds=i),
+        }
+
+
+def open_backend(name, workdir):
+    if name == 'sqlite':
+        return storage.SQLiteStore(os.path.join(workdir, 'bench.db'))
+    store = storage.MongoStore(os.environ.get('MONGO_DATABASE_URI'))
+    store.ping()
+    store.collection = store.db['chat_history_bench']
+    store.collection.drop()
+    return store
+
+
+def run_backend(name, messages, batch_size, reads, page_size):
+    with tempfile.TemporaryDirectory() as workdir:
+        store = open_backend(name, workdir)
+        start = datetime(2024, 1, 1)
+        docs = list(make_documents(messages, start))
+
+        t0 = time.perf_counter()
+        for i in range(0, messages, batch_size):
+            store.insert_many(docs[i:i + batch_size])
+        insert_s = time.perf_counter() - t0
+
+        latencies = []
+        for _ in range(reads):
+            before = start + timedelta(milliseconds=random.randrange(page_size, messages))
+            t0 = time.perf_counter()
+            page = store.history(limit=page_size, before=before)
+            latencies.append((time.perf_counter() - t0) * 1e3)
+            assert len(page) == page_size
+        latencies.sort()
+        if name == 'mongo':
+            store.collection.drop()
+        store.close()
+
+    return {
+        'backend': name,
+        'messages': messages,
+        'inserts_per_s': round(messages / insert_s),
+        'history_ms_p50': round(benchutil.percentile(latencies, 50), 3),
+        'history_ms_p99': round(benchutil.percentile(latencies, 99), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the history storage backends.")
+    parser.add_argument('--backends', default='sqlite')
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--reads', type=int, default=500)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.backends.split(','):
+        result = run_backend(name, args.messages, args.batch_size, args.reads, args.page_size)
+        results.append(result)
+        print(f"{name:>7}: {result['inserts_per_s']:>9} inserts/s  "
+              f"history p50 {result['history_ms_p50']:.3f} ms  p99 {result['history_ms_p99']:.3f} ms")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# benchutil.py
+# Helpers shared by the benchmark scripts: launching a server under test,
+# finding free ports and sampling process memory and CPU.
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_DIR = os.path.join(REPO_ROOT, 'server')
+CLIENT_DIR = os.path.join(REPO_ROOT, 'client')
+
+# Benchmarks drive many connections from one address as fast as they can;
+# with the admission limits (server/admission.py) on they would measure the
+# limits instead of the server. Pass them in `env` to measure them.
+UNLIMITED = {'MAX_CONNECTIONS': '0', 'MAX_CONNECTIONS_PER_IP': '0', 'MESSAGE_RATE': '0',
+             'IP_MESSAGE_RATE': '0', 'BYTE_RATE': '0', 'IP_BYTE_RATE': '0'}
+
+
+def free_port():
+    """Asks the kernel for a currently unused TCP port on localhost."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Server on {host}:{port} did not start within {timeout}s")
+
+
+def start_server(mode, port, host='127.0.0.1', env=None, quiet=True, workers=1):
+    """Starts server.py's engine in a child process without a database.
+
+    The server is imported as a module and served directly, so the benchmark
+    does not depend on MongoDB being reachable. With `workers` > 1 it runs
+    behind the multi-process supervisor. The admission limits are off
+    unless `env` sets them.
+    """
+    if workers > 1:
+        call = f"server.serve_workers({workers}, {mode!r}, {host!r}, {port})"
+    else:
+        call = f"server.serve({mode!r}, {host!r}, {port})"
+    code = f"import sys; sys.path.insert(0, {SERVER_DIR!r}); import server; {call}"
+    child_env = dict(os.environ)
+    child_env.update(UNLIMITED)
+    child_env.update(env or {})
+    out = subprocess.DEVNULL if quiet else None
+    proc = subprocess.Popen([sys.executable, '-c', code], stdout=out, stderr=out, env=child_env)
+    try:
+        wait_for_port(host, port)
+    except TimeoutError:
+        proc.kill()
+        raise
+    return proc
+
+
+def stop_server(proc):
+    # SIGTERM so a supervisor can take its workers down with it.
+    proc.terminate()
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def rss_kb(pid):
+    """Resident set size of a process in KiB, read from /proc (Linux only)."""
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    raise RuntimeError(f"VmRSS not found for pid {pid}")
+
+
+def process_tree(pid):
+    """`pid` and all of its descendants, e.g. a supervisor and its workers (Linux only)."""
+    pids = [pid]
+    for parent in pids:
+        for task in os.listdir(f'/proc/{parent}/task'):
+            try:
+                with open(f'/proc/{parent}/task/{task}/children') as f:
+                    pids.extend(int(child) for child in f.read().split())
+            except OSError:
+                pass
+    return pids
+
+
+def cpu_seconds(pid):
+    """User plus system CPU time a process has used so far, in seconds (Linux only)."""
+    with open(f'/proc/{pid}/stat') as f:
+        # The command name may contain spaces; the fields we want follow its ')'.
+        fields = f.read().rpartition(')')[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def tree_usage(pid):
+    """(CPU seconds, RSS KiB) summed over a process and its descendants."""
+    cpu = rss = 0
+    for member in process_tree(pid):
+        try:
+            cpu += cpu_seconds(member)
+            rss += rss_kb(member)
+        except (OSError, RuntimeError):
+            # Exited between listing and reading.
+            pass
+    return cpu, rss
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return float('nan')
+    k = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
@@ -1,73 +1,573 @@
-import socket
-import threading
+# client.py
+# Chat client built on asyncio. A ChatClient session outlives its TCP
+# connection: when the server goes away it reconnects with exponential
+# backoff and jitter, queues whatever is typed meanwhile in a local outbox,
+# and on reconnect asks the server to resume after the last message it saw,
+# so only the missed ones are replayed. It answers the server's heartbeat
+# PINGs, and treats a server that stays silent through a PING of its own as
+# gone. A server that turns it away (REJECT) is left alone for at least as
+# long as it asks.
+#
+#   python client.py                      # interactive
+#   python client.py --headless --name bot < script.txt
+#
+# On a terminal the interactive client runs the curses UI in tui.py; --plain
+# (or no curses) falls back to printing lines. Headless mode reads one
+# message or command per stdin line and writes every event as a JSON line to
+# stdout, for scripts and the load generator.
+#
+# "/send <path>" uploads a file in CHUNK frames, never more than the server's
+# credit window ahead of its acknowledgements, and the server announces it to
+# the room with a "/get <id>" line; "/get <id>" saves it under DOWNLOAD_DIR.
+
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
 import os
+import random
+import re
+import struct
+import sys
+import tempfile
+import threading
+import zlib
+from collections import deque
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # --- Configuration ---
 # The client will connect to the server using the hostname 'server',
 # which is its service name in the docker-compose network.
 # A default value is provided for local testing without Docker.
 SERVER_HOST = os.environ.get('SERVER_HOST', '127.0.0.1')
-SERVER_PORT = 65432
-# NAME will be set by user input when the script runs.
-NAME = None
+SERVER_PORT = int(os.environ.get('SERVER_PORT', '65432'))
+# Asked for at startup when not set.
+NAME = os.environ.get('NAME')
+# Reconnect delays are drawn uniformly from [0, min(RECONNECT_MAX, RECONNECT_BASE * 2**attempt)].
+RECONNECT_BASE = float(os.environ.get('RECONNECT_BASE', '0.5'))
+RECONNECT_MAX = float(os.environ.get('RECONNECT_MAX', '30'))
+# Messages kept while offline; beyond this the oldest are dropped.
+OUTBOX_LIMIT = int(os.environ.get('OUTBOX_LIMIT', '1000'))
+# Message ids remembered so a replay never shows a message twice.
+SEEN_LIMIT = 1000
+# Where /get saves files.
+DOWNLOAD_DIR = os.environ.get('DOWNLOAD_DIR', 'downloads')
+# File bytes per upload CHUNK frame.
+UPLOAD_CHUNK = 65536
+# The server's reply to /join and /leave (hub.py's _move), naming the room we are in.
+ROOM_CONFIRMED = re.compile(r'^\[SERVER\] You are (?:now|already) in #([a-z0-9][a-z0-9_-]*)')
 
-def receive_messages(client_socket):
-    """Listens for messages from the server and prints them."""
-    while True:
+# --- Wire protocol ---
+# Mirrors server/protocol.py: a 6 byte header (version, type, payload length)
+# followed by the payload. The client container does not ship the server
+# modules, so the few pieces the client needs are kept here.
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!BBI')
+TYPE_MASK = 0x7F
+FLAG_COMPRESSED = 0x80
+MAX_PAYLOAD = 1 << 20
+HELLO, WELCOME, CHAT, MESSAGE, SYSTEM, ERROR, PING, PONG, REJECT = 1, 2, 3, 4, 5, 6, 7, 8, 9
+UPLOAD, CHUNK, CREDIT, DOWNLOAD = 10, 11, 12, 13
+# A CHUNK payload starts with the transfer id.
+CHUNK_ID = struct.Struct('!I')
+
+# --- Compression ---
+# Offered in HELLO; the server names the one it picked in WELCOME, and from
+# then on either side may flag a large payload as compressed with it.
+COMPRESS_THRESHOLD = 512
+CODECS = {'zlib': (lambda data: zlib.compress(data, 6),
+                   lambda data: zlib.decompressobj().decompress(data, MAX_PAYLOAD))}
+if zstandard is not None:
+    CODECS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                      lambda data: zstandard.ZstdDecompressor().decompress(data, max_output_size=MAX_PAYLOAD))
+
+def encode_frame(ftype, payload, codec=None):
+    if codec is not None and len(payload) >= COMPRESS_THRESHOLD:
+        compressed = CODECS[codec][0](payload)
+        if len(compressed) < len(payload):
+            return HEADER.pack(PROTOCOL_VERSION, ftype | FLAG_COMPRESSED, len(compressed)) + compressed
+    return HEADER.pack(PROTOCOL_VERSION, ftype, len(payload)) + payload
+
+async def read_frame(reader, codec=None, timeout=None):
+    """Reads one (type, payload) frame; raises EOFError when the server disconnects
+    and asyncio.TimeoutError if no frame starts within `timeout` seconds."""
+    # Only the header wait is timed: readexactly() consumes nothing until it
+    # has every byte, so cancelling it never splits a frame.
+    header = await asyncio.wait_for(reader.readexactly(HEADER.size), timeout)
+    version, ftype, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION or length > MAX_PAYLOAD:
+        raise ValueError(f"Bad frame header from server (version {version}, length {length})")
+    payload = await reader.readexactly(length)
+    if ftype & FLAG_COMPRESSED:
+        payload = CODECS[codec][1](payload)
+    return ftype & TYPE_MASK, payload
+
+def chunk_frame(transfer, data):
+    return HEADER.pack(PROTOCOL_VERSION, CHUNK, CHUNK_ID.size + len(data)) + CHUNK_ID.pack(transfer) + data
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def unused_path(directory, name):
+    """`name` in `directory`, numbered like "report (2).pdf" if that is taken."""
+    stem, ext = os.path.splitext(name)
+    path, n = os.path.join(directory, name), 1
+    while os.path.exists(path):
+        n += 1
+        path = os.path.join(directory, f"{stem} ({n}){ext}")
+    return path
+
+def backoff_delay(attempt, base=RECONNECT_BASE, cap=RECONNECT_MAX, rng=random):
+    """Seconds to wait before reconnect attempt number `attempt` (0-based).
+
+    Full jitter: clients dropped together by a server restart come back
+    spread over the whole window instead of all at once.
+    """
+    return rng.uniform(0, min(cap, base * 2 ** attempt))
+
+# --- Files ---
+class Download:
+    """A file the server is streaming to us: a temporary file, hashed as it fills."""
+
+    def __init__(self, blob, name, size, window, directory=DOWNLOAD_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.blob = blob
+        self.name = name
+        self.size = size
+        self.received = 0
+        # The server sends at most `window` bytes past what we last acknowledged.
+        self.window = window
+        self.acked = 0
+        self.directory = directory
+        self.file = tempfile.NamedTemporaryFile(dir=directory, prefix='.download-', delete=False)
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.file.write(data)
+        self.hash.update(data)
+        self.received += len(data)
+
+    def finish(self):
+        """Moves the file into place; returns its path, or None if it came out corrupt."""
+        self.file.close()
+        if self.received != self.size or self.hash.hexdigest() != self.blob:
+            os.unlink(self.file.name)
+            return None
+        path = unused_path(self.directory, self.name)
+        os.replace(self.file.name, path)
+        return path
+
+    def abort(self):
+        self.file.close()
+        os.unlink(self.file.name)
+
+# --- Session ---
+class ChatClient:
+    """One chat session that survives disconnects.
+
+    Everything the server sends is passed to on_event(kind, fields) with kind
+    one of 'message' (fields as in the MESSAGE frame: id, from, text, room,
+    ts, to for a direct message and file for a shared one), 'system', 'error'
+    (fields {'text'}), 'connected' or 'disconnected' (fields {'text'}).
+    """
+
+    def __init__(self, name, host=SERVER_HOST, port=SERVER_PORT, on_event=None,
+                 outbox_limit=OUTBOX_LIMIT, rng=None):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.on_event = on_event or (lambda kind, fields: None)
+        self.rng = rng or random.Random()
+        # Lines typed while offline, sent in order once the server welcomes us.
+        self.outbox = deque()
+        self.outbox_limit = outbox_limit
+        self.dropped = 0
+        # The room the server last said we are in (None: the server's
+        # default), and the last message id seen in each room, for resuming.
+        # A /join only counts once the server confirms it, so lines queued
+        # before it are not resumed into the new room.
+        self.room = None
+        self.last_seen = {}
+        # From WELCOME; sent back on reconnect so the server lets us take our
+        # name over from a session it has not yet noticed is gone.
+        self.resume_token = None
+        self._seen = deque()
+        self._seen_ids = set()
+        self.codec = None
+        # Seconds of server silence before we PING it: twice the interval the
+        # server named in WELCOME, so an idle client just answers its PINGs.
+        self.heartbeat = None
+        self.connects = 0
+        self._attempt = 0
+        # Seconds the server last asked us to stay away in a REJECT.
+        self._retry_after = 0.0
+        self._writer = None
+        self._ready = False
+        self._closing = False
+        self._stop = None
+        # Files in flight: upload transfer id -> queue of its CREDITs, download
+        # transfer id -> Download, and the names of files shared in the room.
+        self._uploads = {}
+        self._transfer_ids = itertools.count(1)
+        self._downloads = {}
+        self._file_names = {}
+
+    @property
+    def connected(self):
+        return self._ready
+
+    def send(self, text):
+        """Sends a message or command now, or queues it until we are back online."""
+        command, _, path = text.partition(' ')
+        if command.lower() == '/send' and path.strip():
+            asyncio.ensure_future(self.send_file(os.path.expanduser(path.strip())))
+            return
+        if self._ready:
+            self._writer.write(encode_frame(CHAT, text.encode('utf-8'), self.codec))
+            return
+        if len(self.outbox) >= self.outbox_limit:
+            self.outbox.popleft()
+            self.dropped += 1
+        self.outbox.append(text)
+
+    async def send_file(self, path):
+        """Uploads a file with /send's flow control; True once the server has stored it."""
+        name = os.path.basename(path)
         try:
-            message = client_socket.recv(1024).decode('utf-8')
-            if message:
-                # \r moves the cursor to the start of the line.
-                # We then print the received message and reprint the user's prompt
-                # on a new line, ensuring the user's current input isn't disrupted.
-                print(f"\r{message}\n{NAME}: ", end="")
-            else:
-                # Server has closed the connection
-                break
-        except:
-            break
-    print("\rDisconnected from server.")
-    client_socket.close()
+            size = os.path.getsize(path)
+            digest = await asyncio.to_thread(file_digest, path)
+        except OSError as e:
+            self.on_event('error', {'text': f"Cannot send {path}: {e.strerror or e}"})
+            return False
+        if not self._ready:
+            self.on_event('error', {'text': f"Not connected; send {name} again once back online."})
+            return False
+        transfer = next(self._transfer_ids) % 2**32
+        credits = self._uploads[transfer] = asyncio.Queue()
+        writer = self._writer
+        upload = {"transfer": transfer, "name": name, "size": size, "sha256": digest}
+        writer.write(encode_frame(UPLOAD, json.dumps(upload).encode('utf-8')))
+        try:
+            credit = await credits.get()
+            window, sent = credit.get('window'), 0
+            with open(path, 'rb') as f:
+                while window and 'error' not in credit and sent < size:
+                    # Only what the window allows beyond the last acknowledgement.
+                    room = credit['received'] + window - sent
+                    if room <= 0:
+                        credit = await credits.get()
+                        continue
+                    data = f.read(min(UPLOAD_CHUNK, room, size - sent))
+                    if not data:
+                        raise OSError(f"{path} shrank while being sent")
+                    writer.write(chunk_frame(transfer, data))
+                    sent += len(data)
+                    await writer.drain()
+            while 'blob' not in credit and 'error' not in credit:
+                credit = await credits.get()
+        except OSError as e:
+            credit = {'error': str(e.strerror or e)}
+        finally:
+            del self._uploads[transfer]
+        if 'error' in credit:
+            self.on_event('error', {'text': f"Could not send {name}: {credit['error']}"})
+            return False
+        self.on_event('system', {'text': f"Sent {name}."})
+        return True
 
-def send_messages(client_socket):
-    """Sends messages from user input."""
+    async def run(self):
+        """Connects, and reconnects after every drop, until close() is called."""
+        self._stop = asyncio.Event()
+        while not self._closing:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as e:
+                await self._backoff(f"Could not connect to {self.host}:{self.port} ({e.strerror or e}).")
+                continue
+            self._writer = writer
+            self.connects += 1
+            writer.write(encode_frame(HELLO, json.dumps(self._hello()).encode('utf-8')))
+            pinged = False
+            try:
+                while True:
+                    try:
+                        frame = await read_frame(reader, self.codec, self.heartbeat)
+                    except asyncio.TimeoutError:
+                        if pinged:
+                            raise EOFError("Server stopped answering")
+                        pinged = True
+                        writer.write(encode_frame(PING, b''))
+                        continue
+                    pinged = False
+                    self._handle(*frame)
+            except (OSError, EOFError, ValueError, zlib.error):
+                pass
+            finally:
+                self._ready = False
+                self._writer = None
+                self.heartbeat = None
+                writer.close()
+                self._abort_transfers()
+            if not self._closing:
+                await self._backoff("Disconnected from server.")
+
+    def _hello(self):
+        hello = {"name": self.name, "version": PROTOCOL_VERSION, "compression": list(CODECS),
+                 "heartbeat": True}
+        if self.room is not None or self.last_seen or self.resume_token:
+            room = self.room or ''
+            hello["resume"] = {"room": room, "after": self.last_seen.get(room), "token": self.resume_token}
+        return hello
+
+    async def _backoff(self, reason):
+        delay = backoff_delay(self._attempt, rng=self.rng)
+        self._attempt += 1
+        if self._retry_after:
+            # Spread over up to twice the wait, so refused clients do not all return at once.
+            delay = max(delay, self.rng.uniform(self._retry_after, 2 * self._retry_after))
+            self._retry_after = 0.0
+        self.on_event('disconnected', {'text': f"{reason} Reconnecting in {delay:.1f}s..."})
+        try:
+            await asyncio.wait_for(self._stop.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    def _abort_transfers(self):
+        for credits in self._uploads.values():
+            credits.put_nowait({'error': "Disconnected."})
+        for download in self._downloads.values():
+            download.abort()
+        self._downloads.clear()
+
+    def _handle(self, ftype, payload):
+        if ftype == CHUNK:
+            transfer, = CHUNK_ID.unpack_from(payload)
+            download = self._downloads.get(transfer)
+            if download is not None:
+                download.write(memoryview(payload)[CHUNK_ID.size:])
+                if download.received >= download.size:
+                    self._finish_download(transfer)
+                elif download.received - download.acked >= download.window // 2:
+                    download.acked = download.received
+                    credit = {"transfer": transfer, "received": download.received}
+                    self._writer.write(encode_frame(CREDIT, json.dumps(credit).encode('utf-8')))
+        elif ftype == CREDIT:
+            credit = json.loads(payload)
+            credits = self._uploads.get(credit.get('transfer'))
+            if credits is not None:
+                credits.put_nowait(credit)
+        elif ftype == DOWNLOAD:
+            header = json.loads(payload)
+            blob = header['blob']
+            self._downloads[header['transfer']] = Download(blob, self._file_names.get(blob) or blob[:12],
+                                                           header['size'], header['window'])
+            if not header['size']:
+                self._finish_download(header['transfer'])
+        elif ftype == PING:
+            self._writer.write(encode_frame(PONG, b''))
+        elif ftype == WELCOME:
+            welcome = json.loads(payload)
+            self.codec = welcome.get('compression')
+            interval = welcome.get('heartbeat')
+            self.heartbeat = 2 * interval if interval else None
+            self.resume_token = welcome.get('resume_token')
+            self._ready = True
+            self._attempt = 0
+            queued, self.outbox = self.outbox, deque()
+            for text in queued:
+                self._writer.write(encode_frame(CHAT, text.encode('utf-8'), self.codec))
+            text = "Connected to the chat server!"
+            if queued:
+                text += f" Sent {len(queued)} queued messages."
+            self.on_event('connected', {'text': text})
+        elif ftype == MESSAGE:
+            message = json.loads(payload)
+            message_id, room = message.get('id'), message.get('room')
+            if message_id is not None:
+                if message_id in self._seen_ids:
+                    return
+                self._remember(message_id)
+            attachment = message.get('file')
+            if attachment:
+                # Saved under its own name if we /get it later.
+                self._file_names[attachment['blob']] = os.path.basename(attachment['name']).lstrip('.') or None
+                if len(self._file_names) > SEEN_LIMIT:
+                    del self._file_names[next(iter(self._file_names))]
+            if room:
+                # Rooms we were moved into without a /join of our own, too.
+                self.room = room
+                if message_id is not None:
+                    self.last_seen[room] = message_id
+            self.on_event('message', message)
+        elif ftype == SYSTEM:
+            text = payload.decode('utf-8')
+            moved = ROOM_CONFIRMED.match(text)
+            if moved:
+                self.room = moved.group(1)
+            self.on_event('system', {'text': text})
+        elif ftype == ERROR:
+            self.on_event('error', {'text': payload.decode('utf-8')})
+        elif ftype == REJECT:
+            reject = json.loads(payload)
+            self._retry_after = float(reject.get('retry_after') or 0)
+            self.on_event('error', {'text': f"Not admitted: {reject.get('reason')}"})
+
+    def _finish_download(self, transfer):
+        download = self._downloads.pop(transfer)
+        path = download.finish()
+        if path is None:
+            self.on_event('error', {'text': f"{download.name} arrived corrupt; try /get again."})
+        else:
+            self.on_event('system', {'text': f"Saved {download.name} to {path}."})
+
+    def _remember(self, message_id):
+        self._seen.append(message_id)
+        self._seen_ids.add(message_id)
+        if len(self._seen) > SEEN_LIMIT:
+            self._seen_ids.discard(self._seen.popleft())
+
+    async def drain(self, timeout=None):
+        """Waits until the outbox has been sent; False if `timeout` ran out first."""
+        async def sent():
+            while not self._ready or self.outbox:
+                await asyncio.sleep(0.05)
+            await self._writer.drain()
+        try:
+            await asyncio.wait_for(sent(), timeout)
+            return True
+        except (asyncio.TimeoutError, OSError):
+            return False
+
+    def close(self):
+        self._closing = True
+        if self._stop is not None:
+            self._stop.set()
+        if self._writer is not None:
+            self._writer.close()
+
+# --- Front ends ---
+def render(kind, fields):
+    """Turns a session event into the line shown to the user, or None to show nothing."""
+    if kind == 'message' and fields.get('to') is not None:
+        return f"[{fields['from']} -> {fields['to']}]: {fields['text']}"
+    if kind == 'message':
+        return f"[{fields['from']}]: {fields['text']}"
+    if kind == 'error':
+        return f"[SERVER ERROR] {fields['text']}"
+    return fields.get('text')
+
+def read_lines(loop, lines, prompt=None):
+    """Feeds stdin lines into the asyncio queue `lines`; None marks end of input.
+
+    Runs on a daemon thread so a blocked input() never holds up exit.
+    """
     try:
         while True:
-            message_to_send = input(f"{NAME}: ")
-            if message_to_send.lower() in ['quit', 'exit']:
+            line = input(prompt) if prompt else sys.stdin.readline()
+            if not prompt and not line:
                 break
-            client_socket.send(message_to_send.encode('utf-8'))
+            loop.call_soon_threadsafe(lines.put_nowait, line.rstrip('\n'))
     except (EOFError, KeyboardInterrupt):
-        # Handle Ctrl+D or Ctrl+C to gracefully exit
-        print("\nDisconnecting...")
-    finally:
-        client_socket.close()
+        pass
+    loop.call_soon_threadsafe(lines.put_nowait, None)
+
+async def run_interactive(name, host, port):
+    def show(kind, fields):
+        line = render(kind, fields)
+        if line:
+            # \r moves the cursor to the start of the line.
+            # We then print the received message and reprint the user's prompt
+            # on a new line, ensuring the user's current input isn't disrupted.
+            print(f"\r{line}\n{name}: ", end="", flush=True)
+
+    client = ChatClient(name, host, port, on_event=show)
+    session = asyncio.create_task(client.run())
+    lines = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    threading.Thread(target=read_lines, args=(loop, lines, f"{name}: "), daemon=True).start()
+    while True:
+        line = await lines.get()
+        if line is None or line.lower() in ['quit', 'exit']:
+            break
+        if line:
+            client.send(line)
+    print("\nDisconnecting...")
+    await client.drain(timeout=1.0)
+    client.close()
+    await session
+
+async def run_tui(name, host, port):
+    import tui
+    await tui.run(ChatClient(name, host, port), render)
+
+async def run_headless(name, host, port, linger):
+    def emit(kind, fields):
+        sys.stdout.write(json.dumps(dict(fields, event=kind)) + '\n')
+        sys.stdout.flush()
+
+    client = ChatClient(name, host, port, on_event=emit)
+    session = asyncio.create_task(client.run())
+    lines = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    threading.Thread(target=read_lines, args=(loop, lines), daemon=True).start()
+    while True:
+        line = await lines.get()
+        if line is None:
+            break
+        if line:
+            client.send(line)
+    # End of input: deliver what is still queued, then stay for replies.
+    await client.drain(timeout=linger if linger > 0 else None)
+    await asyncio.sleep(linger)
+    client.close()
+    await session
+
+def has_curses():
+    try:
+        import curses  # noqa: F401
+    except ImportError:
+        return False
+    return True
 
 def start_client():
-    """Prompts for a name, connects to the server, and starts threads."""
-    global NAME
-    # Ask the user for their name first
-    NAME = input("Please enter your name to join the chat: ")
-    if not NAME:
-        # Provide a default name if the user enters nothing
-        NAME = f"Guest-{os.getpid()}"
+    """Parses the command line, asks for a name if needed and runs the client."""
+    parser = argparse.ArgumentParser(description="Chat client.")
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--name', default=NAME)
+    parser.add_argument('--headless', action='store_true',
+                        help="read messages from stdin and print events as JSON lines")
+    parser.add_argument('--plain', action='store_true',
+                        help="print incoming lines instead of running the terminal UI")
+    parser.add_argument('--linger', type=float, default=1.0,
+                        help="headless: seconds to keep receiving after stdin ends")
+    args = parser.parse_args()
 
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    name = args.name
+    if not name and not args.headless:
+        # Ask the user for their name first
+        name = input("Please enter your name to join the chat: ")
+    if not name:
+        # Provide a default name if the user enters nothing
+        name = f"Guest-{os.getpid()}"
     try:
-        client.connect((SERVER_HOST, SERVER_PORT))
-        print("Connected to the chat server! Start typing to send messages.")
-    except Exception as e:
-        print(f"Error: Could not connect to server at {SERVER_HOST}:{SERVER_PORT}. {e}")
-        return
-
-    # Start a thread to listen for incoming messages from the server
-    receive_thread = threading.Thread(target=receive_messages, args=(client,))
-    receive_thread.daemon = True # Allows main program to exit even if thread is running
-    receive_thread.start()
-    
-    # The main thread will handle sending messages
-    send_messages(client)
+        if args.headless:
+            asyncio.run(run_headless(name, args.host, args.port, args.linger))
+        elif not args.plain and sys.stdin.isatty() and sys.stdout.isatty() and has_curses():
+            asyncio.run(run_tui(name, args.host, args.port))
+        else:
+            asyncio.run(run_interactive(name, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
     start_client()
-
@@ -0,0 +1,267 @@
+# tui.py
+# Terminal UI for client.py: a message pane, a status bar and an input line
+# of its own, drawn with curses.
+#
+# Incoming events are only appended to a list. At most RENDER_FPS times a
+# second a render tick moves them into the scrollback and redraws the rows
+# that fit on screen, so a busy room costs the same screen work as a quiet
+# one and never scribbles over what is being typed.
+#
+# Keys: Enter sends, PageUp/PageDown scroll, End or Esc jumps back to the
+# newest message. "/find <text>" searches the scrollback from the newest line
+# back; "/find" on its own goes to the next older match. "/quit" or Ctrl-C
+# exits.
+
+import asyncio
+import curses
+import itertools
+import os
+import sys
+import textwrap
+import time
+from collections import deque
+
+# --- Configuration ---
+RENDER_FPS = float(os.environ.get('RENDER_FPS', '20'))
+# Lines kept for scrolling back and /find; older ones are forgotten.
+SCROLLBACK = int(os.environ.get('SCROLLBACK', '5000'))
+
+
+class Scrollback:
+    """The last `limit` lines. Lines are numbered from the first one ever
+    added, so a number stays valid while older lines fall off the front."""
+
+    def __init__(self, limit=SCROLLBACK):
+        self.lines = deque(maxlen=limit)
+        self.total = 0
+
+    def __len__(self):
+        return len(self.lines)
+
+    @property
+    def first(self):
+        """Number of the oldest line still kept."""
+        return self.total - len(self.lines)
+
+    def extend(self, lines):
+        self.lines.extend(lines)
+        self.total += len(lines)
+
+    def backwards(self, before):
+        """Yields (number, line) from line `before` - 1 back to the oldest kept."""
+        before = min(before, self.total)
+        skipped = itertools.islice(reversed(self.lines), self.total - before, None)
+        return zip(itertools.count(before - 1, -1), skipped)
+
+    def find(self, term, before=None):
+        """Number of the newest line before `before` containing `term`, ignoring case; None if none does."""
+        term = term.lower()
+        for number, line in self.backwards(self.total if before is None else before):
+            if term in line.lower():
+                return number
+        return None
+
+
+class ChatUI:
+    """Screen state for one session; curses calls are confined to draw()."""
+
+    def __init__(self, screen, session, render, fps=RENDER_FPS, scrollback=SCROLLBACK):
+        self.screen = screen
+        self.session = session
+        self.render = render
+        self.interval = 1.0 / fps
+        self.scrollback = Scrollback(scrollback)
+        self.pending = []
+        self.input = []
+        self.status = "Connecting..."
+        # Number of the line drawn last; None follows the newest line.
+        self.bottom = None
+        self.unseen = 0
+        # (term, matched line number) while a /find result is shown.
+        self.search = None
+        self.dirty = True
+        self.last_frame = 0.0
+        self.frames = 0
+
+    # --- Events ---
+
+    def on_event(self, kind, fields):
+        """Session callback; O(1) however fast events arrive."""
+        if kind in ('connected', 'disconnected'):
+            self.status = fields['text']
+        line = self.render(kind, fields)
+        if line:
+            self.pending.append(line)
+            self.dirty = True
+
+    def on_key(self, key):
+        """Handles one key from get_wch(); returns a line the user submitted, or None."""
+        self.dirty = True
+        if key in ('\n', '\r', curses.KEY_ENTER):
+            line, self.input = ''.join(self.input), []
+            return line
+        if key in (curses.KEY_BACKSPACE, '\x7f', '\b'):
+            if self.input:
+                self.input.pop()
+        elif key == curses.KEY_PPAGE:
+            self.scroll(-self.page())
+        elif key == curses.KEY_NPAGE:
+            self.scroll(self.page())
+        elif key in (curses.KEY_END, '\x1b'):
+            self.follow()
+        elif isinstance(key, str) and key.isprintable():
+            self.input.append(key)
+        return None
+
+    # --- Scrolling and search ---
+
+    def page(self):
+        return max(1, self.screen.getmaxyx()[0] - 3)
+
+    def scroll(self, lines):
+        newest = self.scrollback.total - 1
+        bottom = (newest if self.bottom is None else self.bottom) + lines
+        if bottom >= newest:
+            self.follow()
+        else:
+            self.bottom = max(bottom, self.scrollback.first)
+
+    def follow(self):
+        self.bottom = None
+        self.search = None
+        self.unseen = 0
+
+    def find(self, term):
+        """Shows the newest line matching `term`; an empty term steps to the next older match."""
+        before = None
+        if not term and self.search is not None:
+            term, before = self.search
+        if not term:
+            self.status = "Usage: /find <text>"
+            return
+        self._flush_pending()
+        match = self.scrollback.find(term, before)
+        if match is None:
+            self.status = f"No {'older ' if before is not None else ''}match for {term!r}."
+            return
+        self.search = (term, match)
+        self.bottom = match
+        self.status = f"Match for {term!r}; /find for the next, End to return."
+
+    # --- Rendering ---
+
+    def _flush_pending(self):
+        if self.pending:
+            if self.bottom is not None:
+                self.unseen += len(self.pending)
+            self.scrollback.extend(self.pending)
+            self.pending = []
+
+    def tick(self, now=None):
+        """Draws a frame if something changed and the last one is a frame interval old."""
+        now = time.monotonic() if now is None else now
+        if not self.dirty or now - self.last_frame < self.interval:
+            return False
+        self.draw()
+        self.last_frame = now
+        return True
+
+    def visible_rows(self, height, width):
+        """The wrapped rows ending at the bottom line, oldest first, as (text, highlighted)."""
+        rows = []
+        bottom = self.scrollback.total - 1 if self.bottom is None else self.bottom
+        matched = self.search[1] if self.search else None
+        for number, line in self.scrollback.backwards(bottom + 1):
+            wrapped = textwrap.wrap(line, width, subsequent_indent='  ') or ['']
+            for text in reversed(wrapped):
+                rows.append((text, number == matched))
+                if len(rows) == height:
+                    rows.reverse()
+                    return rows
+        rows.reverse()
+        return rows
+
+    def status_line(self):
+        room = self.session.room or 'lobby'
+        parts = [f"#{room}", self.status]
+        if self.session.outbox:
+            parts.append(f"{len(self.session.outbox)} queued")
+        if self.bottom is not None:
+            parts.append(f"scrolled back, {self.unseen} new" if self.unseen else "scrolled back")
+        return ' | '.join(parts)
+
+    def draw(self):
+        self._flush_pending()
+        self.dirty = False
+        self.frames += 1
+        height, width = self.screen.getmaxyx()
+        if height < 3 or width < 10:
+            return
+        rows = self.visible_rows(height - 2, width - 1)
+        self.screen.erase()
+        top = height - 2 - len(rows)
+        for y, (text, highlighted) in enumerate(rows, top):
+            self.screen.addnstr(y, 0, text, width - 1, curses.A_BOLD if highlighted else curses.A_NORMAL)
+        self.screen.addnstr(height - 2, 0, self.status_line().ljust(width - 1), width - 1, curses.A_REVERSE)
+        prompt = f"{self.session.name}: "
+        typed = ''.join(self.input)
+        # Keep the cursor end of a long line in view.
+        visible = (prompt + typed)[-(width - 1):]
+        self.screen.addnstr(height - 1, 0, visible, width - 1)
+        self.screen.move(height - 1, len(visible))
+        self.screen.refresh()
+
+
+def _read_keys(screen):
+    keys = []
+    while True:
+        try:
+            keys.append(screen.get_wch())
+        except curses.error:
+            return keys
+
+
+async def run(session, render):
+    """Runs `session` (a client.ChatClient) under the terminal UI until /quit or Ctrl-C."""
+    # Esc should leave search at once, not after curses' default second.
+    os.environ.setdefault('ESCDELAY', '25')
+    screen = curses.initscr()
+    curses.noecho()
+    curses.cbreak()
+    screen.keypad(True)
+    screen.nodelay(True)
+    loop = asyncio.get_running_loop()
+    keys_ready = asyncio.Event()
+    loop.add_reader(sys.stdin.fileno(), keys_ready.set)
+    ui = ChatUI(screen, session, render)
+    session.on_event = ui.on_event
+    task = asyncio.create_task(session.run())
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(keys_ready.wait(), ui.interval)
+            except asyncio.TimeoutError:
+                pass
+            keys_ready.clear()
+            for key in _read_keys(screen):
+                line = ui.on_key(key)
+                if not line:
+                    continue
+                command, _, argument = line.partition(' ')
+                if command.lower() in ('/quit', '/exit', 'quit', 'exit'):
+                    return
+                if command.lower() == '/find':
+                    ui.find(argument.strip())
+                else:
+                    session.send(line)
+                    ui.follow()
+            ui.tick()
+    finally:
+        loop.remove_reader(sys.stdin.fileno())
+        screen.keypad(False)
+        curses.nocbreak()
+        curses.echo()
+        curses.endwin()
+        await session.drain(timeout=1.0)
+        session.close()
+        await task
@@ -0,0 +1,312 @@
+# admission.py
+# Who gets in, and how fast they may talk.
+#
+# Connections are counted at accept, in total and per remote address; past
+# either cap a client is sent a REJECT frame (or a text line, for legacy
+# clients) naming how long to wait, and closed. Admitted clients draw from
+# token buckets, their own and their address's: a chat message that finds
+# the message buckets empty is dropped before it is stored or fanned out,
+# and reading from a client that is over its byte rate pauses, which lets
+# TCP flow control push back on the sender instead of the server buffering.
+#
+# Bucket updates take no lock, like the counters in metrics.py: in the
+# threaded engine two connections from one address can very occasionally
+# both spend the same token.
+
+import os
+import selectors
+import socket
+import threading
+import time
+
+import metrics
+import protocol
+
+# --- Configuration ---
+# 0 disables the respective limit.
+MAX_CONNECTIONS = int(os.environ.get('MAX_CONNECTIONS', '10000'))
+MAX_CONNECTIONS_PER_IP = int(os.environ.get('MAX_CONNECTIONS_PER_IP', '100'))
+# Sustained chat messages (commands included) per second, and the burst allowed on top.
+MESSAGE_RATE = float(os.environ.get('MESSAGE_RATE', '10'))
+MESSAGE_BURST = float(os.environ.get('MESSAGE_BURST', '20'))
+IP_MESSAGE_RATE = float(os.environ.get('IP_MESSAGE_RATE', '100'))
+IP_MESSAGE_BURST = float(os.environ.get('IP_MESSAGE_BURST', '200'))
+# Bytes per second read from one connection and from one address.
+BYTE_RATE = float(os.environ.get('BYTE_RATE', '65536'))
+BYTE_BURST = float(os.environ.get('BYTE_BURST', '1048576'))
+IP_BYTE_RATE = float(os.environ.get('IP_BYTE_RATE', '1048576'))
+IP_BYTE_BURST = float(os.environ.get('IP_BYTE_BURST', '4194304'))
+# Pending connections the kernel queues before accept(); it caps this at
+# net.core.somaxconn. Large enough that a reconnect storm is queued, not refused.
+LISTEN_BACKLOG = int(os.environ.get('LISTEN_BACKLOG', '1024'))
+# Seconds a refused client is asked to wait before trying again.
+RETRY_AFTER = float(os.environ.get('REJECT_RETRY_AFTER', '5'))
+# Seconds a refused connection is given to send its first bytes, so the
+# refusal can be written in the protocol it speaks.
+REJECT_GRACE = 2.0
+# Refused connections waiting for that; beyond this they are closed outright.
+REJECT_PENDING = 1024
+
+
+class Refused(Exception):
+    """A connection that is not admitted; str() is the reason given to the client."""
+
+
+class TokenBucket:
+    """`rate` tokens a second, holding at most `burst`."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.stamp = now
+
+    def _refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def take(self, amount, now):
+        """Spends `amount` if it is available; False (spending nothing) if not."""
+        self._refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def debit(self, amount, now):
+        """Spends `amount` unconditionally; returns the seconds until the bucket is out of debt."""
+        self._refill(now)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class Peer:
+    """Everything connected from one address."""
+
+    __slots__ = ('ip', 'connections', 'messages', 'bytes')
+
+    def __init__(self, ip, messages, bytes_):
+        self.ip = ip
+        self.connections = 0
+        self.messages = messages
+        self.bytes = bytes_
+
+
+class ClientLimits:
+    """The buckets one connection draws from: its own and its address's."""
+
+    __slots__ = ('peer', 'messages', 'bytes', 'dropping')
+
+    def __init__(self, peer, messages, bytes_):
+        self.peer = peer
+        self.messages = messages
+        self.bytes = bytes_
+        # True from a dropped message until the next one gets through.
+        self.dropping = False
+
+    def allow_message(self, now=None):
+        """Spends one message token from both buckets, or none if either is empty."""
+        now = time.monotonic() if now is None else now
+        own, shared = self.messages, self.peer.messages
+        if own is not None and not own.take(1, now):
+            return False
+        if shared is not None and not shared.take(1, now):
+            if own is not None:
+                own.tokens += 1
+            return False
+        return True
+
+    def read(self, nbytes, now=None):
+        """Charges a read of `nbytes`; returns the seconds to pause reading (0 for none)."""
+        now = time.monotonic() if now is None else now
+        pause = 0.0
+        for bucket in (self.bytes, self.peer.bytes):
+            if bucket is not None:
+                pause = max(pause, bucket.debit(nbytes, now))
+        if pause:
+            metrics.READS_THROTTLED.inc()
+            metrics.READ_THROTTLED_SECONDS.inc(pause)
+        return pause
+
+
+def _bucket(rate, burst, now):
+    return TokenBucket(rate, burst, now) if rate else None
+
+
+class Admission:
+    """Connection caps and the rate limits every connection is held to."""
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_per_ip=MAX_CONNECTIONS_PER_IP,
+                 message_rate=MESSAGE_RATE, message_burst=MESSAGE_BURST,
+                 ip_message_rate=IP_MESSAGE_RATE, ip_message_burst=IP_MESSAGE_BURST,
+                 byte_rate=BYTE_RATE, byte_burst=BYTE_BURST,
+                 ip_byte_rate=IP_BYTE_RATE, ip_byte_burst=IP_BYTE_BURST):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.message_rate, self.message_burst = message_rate, message_burst
+        self.ip_message_rate, self.ip_message_burst = ip_message_rate, ip_message_burst
+        self.byte_rate, self.byte_burst = byte_rate, byte_burst
+        self.ip_byte_rate, self.ip_byte_burst = ip_byte_rate, ip_byte_burst
+        self.connections = 0
+        # ip -> Peer. An address stays here after its last connection closes
+        # until its buckets have refilled, so reconnecting does not reset them.
+        self._peers = {}
+        self._sweep_at = 1024
+        self._lock = threading.Lock()
+
+    def admit(self, ip, now=None, force=False):
+        """Counts a new connection from `ip`; returns its ClientLimits or raises Refused.
+
+        With `force` the caps are not applied: the connection was admitted
+        before, by the process that handed it over (handoff.py).
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if not force and self.max_connections and self.connections >= self.max_connections:
+                metrics.CONNECTIONS_REFUSED_FULL.inc()
+                raise Refused("The server is full.")
+            peer = self._peers.get(ip)
+            if peer is None:
+                if len(self._peers) >= self._sweep_at:
+                    self._sweep(now)
+                peer = self._peers[ip] = Peer(ip, _bucket(self.ip_message_rate, self.ip_message_burst, now),
+                                              _bucket(self.ip_byte_rate, self.ip_byte_burst, now))
+            if not force and self.max_per_ip and peer.connections >= self.max_per_ip:
+                metrics.CONNECTIONS_REFUSED_PER_IP.inc()
+                raise Refused(f"Too many connections from {ip}.")
+            peer.connections += 1
+            self.connections += 1
+        return ClientLimits(peer, _bucket(self.message_rate, self.message_burst, now),
+                            _bucket(self.byte_rate, self.byte_burst, now))
+
+    def release(self, limits, now=None):
+        """Uncounts a connection admit() let in."""
+        now = time.monotonic() if now is None else now
+        peer = limits.peer
+        with self._lock:
+            self.connections -= 1
+            peer.connections -= 1
+            if peer.connections == 0 and self._idle(peer, now):
+                self._peers.pop(peer.ip, None)
+
+    def _idle(self, peer, now):
+        return all(bucket is None or bucket.full(now) for bucket in (peer.messages, peer.bytes))
+
+    def _sweep(self, now):
+        for ip, peer in list(self._peers.items()):
+            if peer.connections == 0 and self._idle(peer, now):
+                del self._peers[ip]
+        # Sweeping again only once the table has doubled keeps admit() amortised O(1).
+        self._sweep_at = max(1024, 2 * len(self._peers))
+
+    def stats(self):
+        return {'connections': self.connections, 'addresses': len(self._peers)}
+
+
+def rejection(first_byte, reason, retry_after=RETRY_AFTER):
+    """What to send a refused client, in the protocol its first byte shows it speaks."""
+    if first_byte is not None and protocol.is_framed(first_byte):
+        return protocol.reject_frame(reason, retry_after)
+    return f"[SERVER] {reason} Try again in {retry_after:g}s.".encode('utf-8')
+
+
+class Rejector:
+    """Writes refusals for the threaded engine, on one thread for all of them.
+
+    A refused socket waits here, up to REJECT_GRACE seconds, for its first
+    bytes; then it is sent its rejection and closed. A reconnect storm thus
+    costs no thread per refused connection.
+    """
+
+    def __init__(self, grace=REJECT_GRACE, limit=REJECT_PENDING):
+        self.grace = grace
+        self.limit = limit
+        self._selector = selectors.DefaultSelector()
+        self._pending = {}
+        self._incoming = []
+        self._lock = threading.Lock()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._thread = None
+
+    def reject(self, sock, reason):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='rejector', daemon=True)
+                self._thread.start()
+            if len(self._pending) + len(self._incoming) >= self.limit:
+                sock.close()
+                return
+            self._incoming.append((sock, reason))
+        self._wake_w.send(b'\0')
+
+    def _run(self):
+        while True:
+            for key, _ in self._selector.select(self.grace / 4):
+                if key.fileobj is self._wake_r:
+                    self._take_incoming()
+                else:
+                    self._answer(key.fileobj)
+            now = time.monotonic()
+            for sock, (_, deadline) in list(self._pending.items()):
+                if now >= deadline:
+                    self._answer(sock)
+
+    def _take_incoming(self):
+        try:
+            self._wake_r.recv(4096)
+        except BlockingIOError:
+            pass
+        with self._lock:
+            incoming, self._incoming = self._incoming, []
+            deadline = time.monotonic() + self.grace
+            for sock, reason in incoming:
+                sock.setblocking(False)
+                self._pending[sock] = (reason, deadline)
+                self._selector.register(sock, selectors.EVENT_READ)
+
+    def _answer(self, sock):
+        reason, _ = self._pending.pop(sock)
+        self._selector.unregister(sock)
+        try:
+            data = sock.recv(64)
+            first = data[0] if data else None
+        except BlockingIOError:
+            first = None
+        except OSError:
+            sock.close()
+            return
+        try:
+            sock.send(rejection(first, reason))
+        except OSError:
+            pass
+        sock.close()
+
+    def stats(self):
+        return {'pending': len(self._pending)}
+
+
+def listen_overflows():
+    """The kernel's count of connections dropped because a listen queue was full.
+
+    Read from /proc/net/netstat, so it covers every listener in this network
+    namespace (in a container, just this server); 0 where unavailable.
+    """
+    try:
+        with open('/proc/net/netstat') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return 0
+    for names, values in zip(lines[::2], lines[1::2]):
+        if names.startswith('TcpExt:'):
+            fields = dict(zip(names.split()[1:], values.split()[1:]))
+            return int(fields.get('ListenOverflows', 0))
+    return 0
@@ -0,0 +1,348 @@
+# aio_server.py
+# asyncio engine for the chat server. One event loop multiplexes every
+# connection, so an idle client costs a transport and a protocol object
+# instead of a whole thread and its stack.
+
+import asyncio
+import os
+import socket
+import time
+
+import admission
+import handoff
+import health
+import log
+import metrics
+import outbound
+import protocol
+import session
+
+
+class ChatProtocol(session.Session, asyncio.BufferedProtocol):
+    """One instance per connection; mirrors handle_client() in server.py.
+
+    Incoming bytes are read straight into the connection's frame decoder
+    buffer, so no intermediate bytes object is created per read.
+    """
+
+    __slots__ = ('hub', 'monitor', 'admission', 'engine', 'arrival', 'refusal', 'transport', 'reader')
+
+    def __init__(self, hub, monitor=None, admission_control=None, engine=None, arrival=None):
+        super().__init__()
+        self.hub = hub
+        self.monitor = monitor
+        self.admission = admission_control
+        # The Engine that can hand this connection over, if reloads are on.
+        self.engine = engine
+        # handoff.Arrival of a connection taken over from the previous process.
+        self.arrival = arrival
+        # Why the connection was not admitted, or None.
+        self.refusal = None
+        self.transport = None
+        self.reader = protocol.ClientReader()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.engine is not None:
+            self.engine.connections.add(self)
+        if self.arrival is not None:
+            self._adopt()
+            return
+        self.addr = transport.get_extra_info('peername')
+        metrics.CONNECTIONS_ACCEPTED.inc()
+        health.accepted()
+        if self.admission is not None:
+            try:
+                self.limits = self.admission.admit(self.addr[0])
+            except admission.Refused as refusal:
+                ip, port = self.addr[:2]
+                log.warning('REFUSED', "{ip}:{port}: {reason}", ip=ip, port=port, reason=str(refusal))
+                # Wait briefly for the first bytes to answer in the client's own protocol.
+                self.refusal = str(refusal)
+                asyncio.get_running_loop().call_later(admission.REJECT_GRACE, self._reject)
+                return
+        outbound.tune_socket(transport.get_extra_info('socket'))
+        self.outbox = outbound.AsyncOutbox(transport, asyncio.get_running_loop())
+        if self.monitor is not None:
+            self.monitor.watch(self)
+
+    def pause_writing(self):
+        self.outbox.pause()
+
+    def resume_writing(self):
+        self.outbox.resume()
+
+    def get_buffer(self, sizehint):
+        return self.reader.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.reader.decoder.buffer_updated(nbytes)
+        if self.refusal is not None:
+            self._reject()
+            return
+        received_at = time.perf_counter()
+        upload_bytes = 0
+        try:
+            for kind, value in self.reader.events():
+                if kind == protocol.HELLO:
+                    if not self._join(value):
+                        return
+                elif kind == protocol.PING:
+                    self.outbox.put(protocol.PONG_FRAME)
+                elif kind == protocol.CHUNK:
+                    if self.hub.upload_chunk(self, *value):
+                        upload_bytes += len(value[1])
+                elif kind == protocol.UPLOAD:
+                    self.hub.begin_upload(self, value)
+                elif kind == protocol.CREDIT:
+                    self.outbox.credit(*value)
+                else:
+                    self.hub.handle_message(self, value, received_at)
+            now = time.monotonic()
+            self.received(nbytes, len(self.reader.decoder), now)
+            pause = self.limits.read(max(0, nbytes - upload_bytes), now) if self.limits is not None else 0.0
+            if pause:
+                # Over its byte rate: stop reading for a while and let TCP push back.
+                self.transport.pause_reading()
+                asyncio.get_running_loop().call_later(pause, self._resume_reading)
+        except protocol.ProtocolError as e:
+            ip, port = self.addr[:2]
+            log.warning('PROTOCOL ERROR', "{ip}:{port}: {error}", ip=ip, port=port, error=str(e))
+            if self.reader.framed:
+                self.outbox.put(protocol.Outgoing.error(str(e)).framed())
+                self.outbox.flush()
+            self.transport.close()
+
+    def _resume_reading(self):
+        # Reads stay off while a handoff is in progress.
+        if self.engine is None or not self.engine.handing_over:
+            self.transport.resume_reading()
+
+    def _reject(self):
+        if self.transport.is_closing():
+            return
+        self.transport.write(admission.rejection(self.reader.decoder.first_byte(), self.refusal))
+        self.transport.close()
+
+    def _start(self):
+        """Takes what the client negotiated in HELLO."""
+        self.name = self.reader.name
+        self.framed = self.reader.framed
+        self.codec = self.reader.decoder.codec
+        self.resume = self.reader.resume
+        self.heartbeat = self.reader.heartbeat
+
+    def _join(self, name):
+        """Admits the client under `name`; False if the name is refused and the connection closing."""
+        self._start()
+        refusal = self.hub.claim(self)
+        if refusal is not None:
+            ip, port = self.addr[:2]
+            log.warning('REFUSED', "{ip}:{port}: {reason}", ip=ip, port=port, reason=refusal)
+            first_byte = protocol.PROTOCOL_VERSION if self.framed else None
+            self.outbox.put(admission.rejection(first_byte, refusal))
+            self.outbox.flush()
+            self.transport.close()
+            return False
+        if self.framed:
+            heartbeat = self.monitor.interval if self.heartbeat and self.monitor is not None else None
+            self.outbox.put(protocol.welcome_frame(self.reader.compression, heartbeat, self.token))
+        self.hub.join(self)
+        return True
+
+    def _adopt(self):
+        """Carries on with a connection the previous process handed over (handoff.py)."""
+        arrival, self.arrival = self.arrival, None
+        self.addr = arrival.addr
+        if self.admission is not None:
+            self.limits = self.admission.admit(self.addr[0], force=True)
+        self.reader = protocol.ClientReader.restore(arrival.state['reader'], arrival.input)
+        self.outbox = outbound.AsyncOutbox(self.transport, asyncio.get_running_loop())
+        if self.reader.name is not None:
+            self._start()
+        handoff.restore(self.hub, self, arrival)
+        if self.monitor is not None:
+            self.monitor.watch(self)
+
+    def send(self, outgoing):
+        """Queues a message for this client; never blocks the event loop."""
+        if not self.outbox.put(outgoing.buffers(self.framed, self.codec)):
+            log.warning('SLOW CONSUMER', "Disconnecting {name}: send queue full.", name=self.name)
+            self.transport.abort()
+
+    def ping(self):
+        self.outbox.put(protocol.PING_FRAME)
+
+    def expire(self, reason):
+        self.transport.abort()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if self.engine is not None:
+            self.engine.connections.discard(self)
+        if self.outbox is not None:
+            self.outbox.close()
+        if self.name is not None:
+            self.hub.leave(self)
+        if self.limits is not None:
+            self.admission.release(self.limits)
+
+
+def executor_offload(loop):
+    """An offload() for ChatHub that keeps blocking work off the event loop."""
+    def offload(fn, callback):
+        def done(future):
+            error = future.exception()
+            callback(None if error else future.result(), error)
+        loop.run_in_executor(None, fn).add_done_callback(done)
+    return offload
+
+
+async def check_sessions(monitor):
+    """Runs the session monitor once a tick on the event loop."""
+    while True:
+        await asyncio.sleep(monitor.wheel.tick)
+        monitor.check()
+
+
+class Engine:
+    """The listening server and its connections, and their side of a reload
+    (see handoff.Handoff). The handoff calls in from its own thread; the
+    work is done on the event loop.
+    """
+
+    def __init__(self, hub, monitor, admission_control, loop):
+        self.hub = hub
+        self.monitor = monitor
+        self.admission = admission_control
+        self.loop = loop
+        self.server = None
+        # Every ChatProtocol from connection_made() to connection_lost().
+        self.connections = set()
+        # Set from quiesce() until resume().
+        self.handing_over = False
+        # A duplicate of the listening socket while the server is closed for a handoff.
+        self.listener = None
+        self.stopped = asyncio.Event()
+
+    def factory(self, arrival=None):
+        return ChatProtocol(self.hub, self.monitor, self.admission, self, arrival)
+
+    async def listen(self, host=None, port=None, reuse_port=False, sock=None):
+        self.server = await self.loop.create_server(
+            self.factory, host, port, sock=sock, backlog=admission.LISTEN_BACKLOG, reuse_port=reuse_port)
+
+    async def adopt(self, inherited):
+        """Carries on with the connections a previous process handed over.
+
+        Started together, every connection_made() runs before the loop polls
+        any of the sockets, so all are back in their rooms before the first
+        message is read and broadcast.
+        """
+        await asyncio.gather(*(self.loop.connect_accepted_socket(lambda arrival=arrival: self.factory(arrival), arrival.sock)
+                               for arrival in inherited.arrivals))
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def quiesce(self, deadline):
+        return self._call(self._quiesce())
+
+    def drain(self, deadline):
+        return self._call(self._drain(deadline))
+
+    def resume(self):
+        self._call(self._resume())
+
+    def finish(self, conns):
+        self._call(self._finish(conns))
+
+    async def _quiesce(self):
+        self.handing_over = True
+        if self.monitor is not None:
+            self.monitor.paused = True
+        # Closing the server closes its socket; the duplicate keeps the
+        # listen queue, and is what the next process is sent.
+        self.listener = socket.socket(fileno=os.dup(self.server.sockets[0].fileno()))
+        self.server.close()
+        for conn in self.connections:
+            conn.transport.pause_reading()
+        return True
+
+    async def _drain(self, deadline):
+        # Refused connections are only waiting to be told so; they are not handed over.
+        conns = [conn for conn in self.connections if not conn.transport.is_closing() and conn.refusal is None]
+        for conn in conns:
+            if conn.outbox is not None:
+                self.hub.cancel_uploads(conn, "The server is restarting; send the file again.")
+                conn.outbox.holding = True
+        while time.monotonic() < deadline and not all(conn.outbox is None or conn.outbox.drained for conn in conns):
+            await asyncio.sleep(0.005)
+        departures = []
+        for conn in conns:
+            if conn.transport.is_closing():
+                continue
+            # A download chunk's sendfile() turns reading back on when it ends.
+            conn.transport.pause_reading()
+            if conn.outbox is not None:
+                conn.outbox.frozen = True
+                if not conn.outbox.drained:
+                    continue
+            departures.append(handoff.departure(self.hub, conn, conn.reader, conn.transport.get_extra_info('socket')))
+        return departures
+
+    async def _resume(self):
+        await self.listen(sock=self.listener)
+        self.listener = None
+        self.handing_over = False
+        for conn in self.connections:
+            if conn.outbox is not None:
+                conn.outbox.release()
+            if not conn.transport.is_closing():
+                conn.transport.resume_reading()
+        if self.monitor is not None:
+            self.monitor.paused = False
+
+    async def _finish(self, conns):
+        for conn in conns:
+            self.hub.detach(conn)
+        # Closing only drops this process's descriptor; the connection lives
+        # on in the new process. Those not handed over are closed for good.
+        for conn in list(self.connections):
+            conn.transport.abort()
+        self.stopped.set()
+
+
+async def serve_forever(hub, host, port, reuse_port=False, monitor=None, admission_control=None,
+                        inherited=None, reload=None):
+    loop = asyncio.get_running_loop()
+    hub.offload = executor_offload(loop)
+    hub.call_soon = loop.call_soon_threadsafe
+    engine = Engine(hub, monitor, admission_control, loop)
+    if inherited is not None:
+        await engine.listen(sock=inherited.listener)
+    else:
+        await engine.listen(host, port, reuse_port)
+    log.info('LISTENING', f"Server is listening on {host}:{port} (asyncio mode, {health.listening():.2f}s after start)")
+    if monitor is not None:
+        # Held here so the task is not garbage collected while serving.
+        checker = asyncio.ensure_future(check_sessions(monitor))  # noqa: F841
+    if inherited is not None:
+        await engine.adopt(inherited)
+        log.info('HANDOFF', "Serving {count} inherited connections {seconds:.3f}s after asking for them.",
+                 count=len(inherited.arrivals), seconds=time.perf_counter() - inherited.started)
+    if reload is not None:
+        reload.start(engine)
+    try:
+        # Until interrupted, or handed over to a new process.
+        await engine.stopped.wait()
+    finally:
+        engine.server.close()
+
+
+def serve(host, port, hub, reuse_port=False, monitor=None, admission_control=None, inherited=None, reload=None):
+    """Runs the asyncio engine until interrupted or handed over."""
+    try:
+        asyncio.run(serve_forever(hub, host, port, reuse_port, monitor, admission_control, inherited, reload))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,527 @@
+# archive.py
+# History retention. With HISTORY_RETENTION_DAYS set, a background archiver
+# moves messages older than that out of the history store into compressed
+# segment files under ARCHIVE_DIR, so the store, and every query, index and
+# backup of it, only holds the recent part of the history. /older and /dms
+# read on into the archive once the store runs out (ArchivedStore).
+#
+# Each pass takes the store's oldest aged messages a batch at a time, groups
+# them into ARCHIVE_BUCKET_HOURS time buckets and writes each group out as an
+# immutable segment file. The manifest is replaced to make the segment live,
+# and only then are the messages deleted from the store. After a crash in
+# between, a message can be both stored and archived, or archived twice;
+# readers skip repeated _ids.
+#
+# Inside a segment the messages are sorted by room, then time, and cut into
+# blocks of about ARCHIVE_BLOCK_BYTES, each compressed on its own. The sparse
+# index at the end of the file has one entry per block: its room, time range,
+# offset and sizes. A page of one room's history before some time therefore
+# decompresses only the blocks that hold it, newest segment first. Direct
+# messages are filed under DM_PARTITIONS runs named "@direct/<n>", each
+# message under the partitions of both its sender and its recipient, so a
+# user's direct messages are read from one partition rather than all of them.
+#
+# Segment layout:
+#   MAGIC
+#   blocks    compressed runs of one room's (or partition's) records, oldest
+#             first; a record is
+#             RECORD (timestamp, binary id, byte lengths) followed by the
+#             sender, recipient and message in UTF-8
+#   index     UTF-8 JSON: codec, bucket, count, time range, and
+#             {run: [[first_ts, last_ts, offset, size, raw_size, count], ...]}
+#   FOOTER    offset of the index, MAGIC
+
+import glob
+import heapq
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
+
+import compressors
+import log
+import storage
+from rooms import DEFAULT_ROOM, DIRECT
+
+# --- Configuration ---
+# Days a message stays in the history store; 0 keeps everything there.
+HISTORY_RETENTION_DAYS = float(os.environ.get('HISTORY_RETENTION_DAYS', '0'))
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'chat_archive')
+# Time span one segment file covers at most.
+ARCHIVE_BUCKET_HOURS = float(os.environ.get('ARCHIVE_BUCKET_HOURS', '24'))
+# Seconds between archiver passes.
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', '300'))
+# Messages read from the store per step, and so the most one segment holds.
+ARCHIVE_BATCH = int(os.environ.get('ARCHIVE_BATCH', '50000'))
+# Uncompressed bytes per block, and so the most a cold read decompresses per block.
+ARCHIVE_BLOCK_BYTES = int(os.environ.get('ARCHIVE_BLOCK_BYTES', '65536'))
+# Falls back to zlib when zstd is not installed.
+ARCHIVE_CODEC = os.environ.get('ARCHIVE_CODEC', 'zstd')
+# Decompressed blocks kept in memory, for paging on through the same range.
+ARCHIVE_CACHE_BLOCKS = int(os.environ.get('ARCHIVE_CACHE_BLOCKS', '256'))
+
+MAGIC = b'CHATARC1'
+FOOTER = struct.Struct('<Q8s')
+RECORD = struct.Struct('<d12sHHI')
+MANIFEST = 'manifest.json'
+DM_PARTITIONS = 64
+# Index entry fields.
+FIRST, LAST, OFFSET, SIZE, RAW_SIZE, COUNT = range(6)
+
+
+def _id_bytes(message_id):
+    try:
+        raw = bytes.fromhex(message_id)
+    except (TypeError, ValueError):
+        raw = b''
+    return raw[:12].ljust(12, b'\0')
+
+
+def dm_run(name):
+    """The run holding the direct messages to and from `name`."""
+    return f"{DIRECT}/{zlib.crc32(name.encode('utf-8')) % DM_PARTITIONS}"
+
+
+def _runs(doc):
+    recipient = doc.get('recipient')
+    if recipient is None:
+        return (doc.get('room') or DEFAULT_ROOM,)
+    return {dm_run(doc['sender_name']), dm_run(recipient)}
+
+
+def encode_block(stamped):
+    """Packs (epoch seconds, document) pairs."""
+    parts = []
+    for ts, doc in stamped:
+        sender = doc['sender_name'].encode('utf-8')
+        recipient = (doc.get('recipient') or '').encode('utf-8')
+        message = doc['message'].encode('utf-8')
+        parts.append(RECORD.pack(ts, _id_bytes(doc['_id']), len(sender), len(recipient), len(message)))
+        parts += (sender, recipient, message)
+    return b''.join(parts)
+
+
+class Block:
+    """A decompressed block.
+
+    Only timestamps and record offsets are parsed up front; documents are
+    built for the records a read actually returns.
+    """
+
+    __slots__ = ('data', 'room', 'stamps', 'offsets')
+
+    def __init__(self, data, room):
+        self.data = data
+        self.room = room
+        self.stamps, self.offsets = [], []
+        pos, unpack, size = 0, RECORD.unpack_from, RECORD.size
+        while pos < len(data):
+            ts, _, sender_len, recipient_len, message_len = unpack(data, pos)
+            self.stamps.append(ts)
+            self.offsets.append(pos)
+            pos += size + sender_len + recipient_len + message_len
+
+    def message_id(self, i):
+        pos = self.offsets[i] + 8
+        return self.data[pos:pos + 12].hex()
+
+    def doc(self, i):
+        ts, raw_id, sender_len, recipient_len, message_len = RECORD.unpack_from(self.data, self.offsets[i])
+        view = memoryview(self.data)
+        pos = self.offsets[i] + RECORD.size
+        sender = str(view[pos:pos + sender_len], 'utf-8')
+        pos += sender_len
+        recipient = str(view[pos:pos + recipient_len], 'utf-8')
+        pos += recipient_len
+        doc = {'_id': raw_id.hex(), 'sender_name': sender, 'message': str(view[pos:pos + message_len], 'utf-8'),
+               'room': self.room, 'timestamp': storage.from_epoch(ts)}
+        if recipient:
+            doc['recipient'] = recipient
+        return doc
+
+
+def write_segment(path, bucket, docs, codec, block_bytes=ARCHIVE_BLOCK_BYTES):
+    """Writes `docs` as a segment file, fsynced, and returns it opened."""
+    # Each timestamp converted once: with a million messages that adds up.
+    stamped = sorted(((run, ts, doc) for doc in docs for ts in (storage.to_epoch(doc['timestamp']),)
+                      for run in _runs(doc)), key=lambda item: item[:2])
+    runs = {}
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+
+        def write_block(run, block):
+            raw = encode_block(block)
+            data = codec.compress(raw)
+            runs.setdefault(run, []).append([block[0][0], block[-1][0], f.tell(), len(data), len(raw), len(block)])
+            f.write(data)
+
+        block, block_run, size = [], None, 0
+        for run, ts, doc in stamped:
+            if block and (run != block_run or size >= block_bytes):
+                write_block(block_run, block)
+                block, size = [], 0
+            block.append((ts, doc))
+            block_run = run
+            size += RECORD.size + len(doc['sender_name']) + len(doc['message'])
+        if block:
+            write_block(block_run, block)
+        index = {
+            'codec': codec.name,
+            'bucket': bucket,
+            'count': len(docs),
+            'min_ts': min(entries[0][FIRST] for entries in runs.values()),
+            'max_ts': max(entries[-1][LAST] for entries in runs.values()),
+            'runs': runs,
+        }
+        index_offset = f.tell()
+        f.write(json.dumps(index, separators=(',', ':')).encode('utf-8'))
+        f.write(FOOTER.pack(index_offset, MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return Segment(path)
+
+
+class Segment:
+    """An archive segment file: its sparse index in memory, blocks read on demand."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            f.seek(self.size - FOOTER.size)
+            index_offset, magic = FOOTER.unpack(f.read(FOOTER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not an archive segment")
+            f.seek(index_offset)
+            index = json.loads(f.read(self.size - FOOTER.size - index_offset))
+        self.codec = compressors.CODECS[index['codec']]
+        self.bucket = index['bucket']
+        self.count = index['count']
+        self.min_ts, self.max_ts = index['min_ts'], index['max_ts']
+        # run -> index entries, oldest first; and their first timestamps, for bisecting.
+        self.runs = index['runs']
+        self.firsts = {run: [entry[FIRST] for entry in entries] for run, entries in self.runs.items()}
+
+    def newest(self, run):
+        entries = self.runs.get(run)
+        return entries[-1][LAST] if entries else None
+
+    def blocks_before(self, run, before_ts):
+        """Index entries of `run` that can hold messages older than `before_ts`, newest first."""
+        if run not in self.runs:
+            return []
+        end = bisect_left(self.firsts[run], before_ts)
+        return self.runs[run][end - 1::-1] if end else []
+
+    def read(self, entry):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            data = os.pread(fd, entry[SIZE], entry[OFFSET])
+        finally:
+            os.close(fd)
+        return self.codec.decompress(data, entry[RAW_SIZE])
+
+
+class Archive:
+    """The segments under `path`. One process writes (add()); any number read.
+
+    Readers pick up the writer's new segments when its manifest changes.
+    """
+
+    def __init__(self, path, writable=False, codec=ARCHIVE_CODEC, block_bytes=ARCHIVE_BLOCK_BYTES,
+                 cache_blocks=ARCHIVE_CACHE_BLOCKS):
+        self.path = path
+        self.writable = writable
+        self.codec = compressors.CODECS.get(codec) or compressors.CODECS['zlib']
+        self.block_bytes = block_bytes
+        self.cache_blocks = cache_blocks
+        self.segments = []
+        self._next_segment = 0
+        self._manifest_mtime = None
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.archived = 0
+        self.block_reads = 0
+        self.cache_hits = 0
+        if writable:
+            os.makedirs(path, exist_ok=True)
+            manifest = self._read_manifest()
+            self._load(manifest)
+            self._remove_orphans(manifest['segments'])
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'segments': [], 'next_segment': 0}
+
+    def _load(self, manifest):
+        held = {segment.name: segment for segment in self.segments}
+        segments = [held.get(name) or Segment(os.path.join(self.path, name)) for name in manifest['segments']]
+        with self._lock:
+            self.segments = segments
+            self._next_segment = manifest['next_segment']
+
+    def _remove_orphans(self, live):
+        # Left behind by a crash between writing a file and the manifest.
+        for path in glob.glob(os.path.join(self.path, 'arc-*')):
+            if os.path.basename(path) not in live:
+                os.remove(path)
+
+    def _write_manifest(self):
+        tmp = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'segments': [s.name for s in self.segments], 'next_segment': self._next_segment}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    def _current(self):
+        if not self.writable:
+            try:
+                mtime = os.stat(os.path.join(self.path, MANIFEST)).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime is not None and mtime != self._manifest_mtime:
+                try:
+                    self._load(self._read_manifest())
+                    self._manifest_mtime = mtime
+                except (OSError, ValueError) as e:
+                    # Caught mid-replace; the next read tries again.
+                    log.error('ARCHIVE ERROR', f"Could not reload the archive manifest: {e}")
+        return self.segments
+
+    # --- Writing ---
+
+    def add(self, bucket, docs):
+        """Writes `docs` (all within one bucket) as a new live segment."""
+        self._next_segment += 1
+        name = f"arc-{time.strftime('%Y%m%d-%H%M', time.gmtime(bucket))}-{self._next_segment:08d}.seg"
+        segment = write_segment(os.path.join(self.path, name), bucket, docs, self.codec, self.block_bytes)
+        with self._lock:
+            self.segments = self.segments + [segment]
+        self._write_manifest()
+        self.archived += len(docs)
+        return segment
+
+    # --- Reading ---
+
+    def newest(self, runs):
+        """Epoch seconds of the newest archived message in any of `runs`, or None."""
+        newest = [ts for segment in self._current() for run in runs
+                  if (ts := segment.newest(run)) is not None]
+        return max(newest, default=None)
+
+    def rooms(self):
+        """Every room the archive holds messages of, direct messages aside."""
+        return {run for segment in self._current() for run in segment.runs if not run.startswith(DIRECT)}
+
+    def history(self, limit=50, before=None, room=None):
+        """Like HistoryStore.history(), over the archive."""
+        rooms = [room] if room is not None else sorted(self.rooms())
+        return self._scan(rooms, before, limit)
+
+    def direct_history(self, user, limit=50, before=None, peer=None):
+        """Like HistoryStore.direct_history(), over the archive."""
+        def keep(doc):
+            sender, recipient = doc['sender_name'], doc['recipient']
+            if recipient == user:
+                return peer is None or sender == peer
+            return sender == user and (peer is None or recipient == peer)
+        return self._scan([dm_run(user)], before, limit, keep)
+
+    def _scan(self, runs, before, limit, keep=None):
+        before_ts = storage.to_epoch(before) if before is not None else float('inf')
+        # One stream per segment and run, newest first; once `limit` messages
+        # are in hand, a stream that ends before the oldest of them is skipped.
+        streams = sorted(((segment.newest(run), segment, run) for segment in self._current()
+                          if segment.min_ts < before_ts for run in runs if run in segment.runs),
+                         key=lambda s: s[0], reverse=True)
+        # A min-heap of (timestamp, _id, document): found[0] is the oldest kept.
+        found, seen = [], set()
+        for newest, segment, run in streams:
+            if len(found) >= limit and newest < found[0][0]:
+                break
+            for entry in segment.blocks_before(run, before_ts):
+                if len(found) >= limit and entry[LAST] < found[0][0]:
+                    break
+                block = self._block(segment, run, entry)
+                for i in range(bisect_left(block.stamps, before_ts) - 1, -1, -1):
+                    ts = block.stamps[i]
+                    if len(found) >= limit and ts < found[0][0]:
+                        break
+                    message_id = block.message_id(i)
+                    if message_id in seen:
+                        continue
+                    doc = block.doc(i)
+                    if keep is not None and not keep(doc):
+                        continue
+                    seen.add(message_id)
+                    item = (ts, message_id, doc)
+                    if len(found) < limit:
+                        heapq.heappush(found, item)
+                    else:
+                        heapq.heapreplace(found, item)
+        return [doc for _, _, doc in sorted(found)]
+
+    def _block(self, segment, run, entry):
+        key = (segment.name, entry[OFFSET])
+        with self._cache_lock:
+            block = self._cache.get(key)
+            if block is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return block
+        block = Block(segment.read(entry), DIRECT if run.startswith(DIRECT) else run)
+        with self._cache_lock:
+            self.block_reads += 1
+            self._cache[key] = block
+            while len(self._cache) > self.cache_blocks:
+                self._cache.popitem(last=False)
+        return block
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+
+    def stats(self):
+        segments = self.segments
+        return {'segments': len(segments), 'messages': sum(s.count for s in segments),
+                'bytes': sum(s.size for s in segments), 'archived': self.archived,
+                'block_reads': self.block_reads, 'cache_hits': self.cache_hits}
+
+
+class ArchivedStore(storage.HistoryStore):
+    """A history store whose reads carry on into the archive; writes go to the store."""
+
+    def __init__(self, store, archive):
+        self.store = store
+        self.archive = archive
+        self.name = store.name
+
+    def insert_many(self, documents):
+        self.store.insert_many(documents)
+
+    def history(self, limit=50, before=None, room=None):
+        docs = self.store.history(limit=limit, before=before, room=room)
+        rooms = [room] if room is not None else self.archive.rooms()
+        if not self._needs_archive(docs, limit, rooms):
+            return docs
+        return _merge(docs, self.archive.history(limit=limit, before=before, room=room), limit)
+
+    def direct_history(self, user, limit=50, before=None, peer=None):
+        docs = self.store.direct_history(user, limit=limit, before=before, peer=peer)
+        if not self._needs_archive(docs, limit, [dm_run(user)]):
+            return docs
+        return _merge(docs, self.archive.direct_history(user, limit=limit, before=before, peer=peer), limit)
+
+    def _needs_archive(self, docs, limit, runs):
+        # A full page from the store that is all newer than anything archived is complete.
+        newest = self.archive.newest(runs)
+        if newest is None:
+            return False
+        return len(docs) < limit or storage.to_epoch(docs[0]['timestamp']) <= newest
+
+    def rooms(self):
+        return self.store.rooms() | self.archive.rooms()
+
+    def oldest(self, before, limit, after=None):
+        return self.store.oldest(before, limit, after)
+
+    def delete_many(self, ids):
+        self.store.delete_many(ids)
+
+    def ping(self):
+        self.store.ping()
+
+    def ensure_indexes(self):
+        self.store.ensure_indexes()
+
+    def close(self):
+        self.store.close()
+
+
+def _merge(stored, archived, limit):
+    """The newest `limit` of two oldest-first pages, oldest first, each message once."""
+    docs, seen = [], set()
+    for doc in sorted(stored + archived, key=lambda doc: doc['timestamp'], reverse=True):
+        if doc['_id'] not in seen:
+            seen.add(doc['_id'])
+            docs.append(doc)
+            if len(docs) == limit:
+                break
+    docs.reverse()
+    return docs
+
+
+class Archiver:
+    """Moves messages older than `retention` seconds from `store` into `archive`, every `interval` seconds."""
+
+    def __init__(self, store, archive, retention, interval=ARCHIVE_INTERVAL, batch=ARCHIVE_BATCH,
+                 bucket=ARCHIVE_BUCKET_HOURS * 3600):
+        self.store = store
+        self.archive = archive
+        self.retention = retention
+        self.interval = interval
+        self.batch = batch
+        self.bucket = bucket
+        self._stop = threading.Event()
+        self.passes = 0
+        self.moved = 0
+        self.last_pass_seconds = 0.0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='archiver', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                log.error('ARCHIVE ERROR', f"Archiving failed, retrying in {self.interval:.0f}s: {e}")
+            self._stop.wait(self.interval)
+
+    def run_once(self, now=None):
+        """Archives everything currently past retention; returns how many messages moved."""
+        start = time.perf_counter()
+        cutoff = storage.from_epoch((now if now is not None else time.time()) - self.retention)
+        moved = 0
+        while not self._stop.is_set():
+            first = self.store.oldest(cutoff, 1)
+            if not first:
+                break
+            # Up to a batch of the oldest bucket's messages; a bucket bigger
+            # than that takes several steps, and segments.
+            bucket = self._bucket(first[0])
+            docs = self.store.oldest(min(cutoff, storage.from_epoch(bucket + self.bucket)), self.batch)
+            self.archive.add(bucket, docs)
+            self.store.delete_many([doc['_id'] for doc in docs])
+            moved += len(docs)
+        self.passes += 1
+        self.moved += moved
+        self.last_pass_seconds = time.perf_counter() - start
+        if moved:
+            log.info('ARCHIVE', "Archived {count} messages older than {cutoff} in {seconds:.2f}s.",
+                     count=moved, cutoff=cutoff.isoformat(timespec='seconds'), seconds=self.last_pass_seconds)
+        return moved
+
+    def _bucket(self, doc):
+        ts = storage.to_epoch(doc['timestamp'])
+        return int(ts // self.bucket * self.bucket)
+
+    def close(self, timeout=30.0):
+        """Stops after the step in progress; what it archived so far stays archived."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
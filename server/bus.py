@@ -0,0 +1,150 @@
+# bus.py
+# Local fan-out bus between the worker processes of one server (see
+# supervisor.py). Each worker keeps one Unix domain socket to the broker in
+# the supervisor and publishes its room broadcasts there as RELAY frames;
+# the broker forwards every frame unchanged to all other workers.
+#
+# Ordering: a worker's publishes travel one stream to the broker and one
+# stream from the broker to each peer, so every worker sees another worker's
+# messages in the order they were sent.
+#
+# Overflow: a link that falls BUS_QUEUE_LIMIT frames behind is closed rather
+# than left to drop frames, which would lose chat silently. The worker on it
+# then shuts down and the supervisor restarts it; its clients reconnect,
+# resume and are replayed what they missed from the shared history store.
+
+import os
+import socket
+import threading
+import time
+
+import log
+import outbound
+import protocol
+
+# Links carry every worker's traffic, so they queue far more than a client.
+BUS_QUEUE_LIMIT = 100000
+
+
+class BusBroker:
+    """Accepts worker connections and forwards each frame to every other worker."""
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self._peers = []
+        self._lock = threading.Lock()
+        # Worker links closed for falling behind.
+        self.overflows = 0
+
+    def start(self):
+        # Called after the workers are forked, so they do not inherit threads.
+        threading.Thread(target=self._accept_loop, name='bus-broker', daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            peer = outbound.ThreadedOutbox(conn, limit=BUS_QUEUE_LIMIT, policy=outbound.DISCONNECT)
+            with self._lock:
+                self._peers.append(peer)
+            threading.Thread(target=self._forward, args=(conn, peer), daemon=True).start()
+
+    def _forward(self, conn, source):
+        decoder = protocol.FrameDecoder()
+        try:
+            while decoder.recv_into(conn):
+                for ftype, payload in decoder.frames():
+                    frame = protocol.encode_frame(ftype, bytes(payload))
+                    with self._lock:
+                        peers = [peer for peer in self._peers if peer is not source]
+                    for peer in peers:
+                        if not peer.put(frame):
+                            self._overflow(peer)
+        except (OSError, protocol.ProtocolError):
+            pass
+        finally:
+            with self._lock:
+                self._peers.remove(source)
+            source.close()
+            conn.close()
+
+    def _overflow(self, peer):
+        # Its own forwarding thread sees the link close and cleans up.
+        self.overflows += 1
+        log.error('BUS ERROR', f"A worker fell {BUS_QUEUE_LIMIT} relayed frames behind; "
+                               "closing its link so it restarts and its clients resync.")
+        outbound.shutdown_socket(peer.sock)
+
+    def close(self):
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class BusClient:
+    """A worker's link to the broker.
+
+    publish() queues a room broadcast for the other workers; what they
+    publish is handed to `on_message(room, outgoing)` on the reader thread.
+    `on_lost()` is called if the link to the supervisor goes away.
+    """
+
+    def __init__(self, path, on_message, on_lost=None, connect_timeout=10.0):
+        self.on_message = on_message
+        self.on_lost = on_lost
+        self.sock = self._connect(path, connect_timeout)
+        self.outbox = outbound.ThreadedOutbox(self.sock, limit=BUS_QUEUE_LIMIT, policy=outbound.DISCONNECT)
+        self.published = 0
+        self.received = 0
+        threading.Thread(target=self._read_loop, name='bus-reader', daemon=True).start()
+
+    @staticmethod
+    def _connect(path, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                return sock
+            except OSError:
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)
+
+    def publish(self, room, outgoing):
+        fields = outgoing.to_dict()
+        fields['room'] = room
+        if not self.outbox.put(protocol.encode_json(protocol.RELAY, fields)):
+            # The reader then reports the link lost, and on_lost shuts us down.
+            log.error('BUS ERROR', f"The supervisor fell {BUS_QUEUE_LIMIT} frames behind; closing the bus.")
+            outbound.shutdown_socket(self.sock)
+            return
+        self.published += 1
+
+    def _read_loop(self):
+        decoder = protocol.FrameDecoder()
+        try:
+            while decoder.recv_into(self.sock):
+                for ftype, payload in decoder.frames():
+                    if ftype == protocol.RELAY:
+                        self.received += 1
+                        fields = protocol.decode_json(payload)
+                        self.on_message(fields['room'], protocol.Outgoing.from_dict(fields))
+        except (OSError, protocol.ProtocolError) as e:
+            log.error('BUS ERROR', f"Lost the link to the supervisor: {e}")
+        else:
+            log.error('BUS ERROR', "The supervisor closed the bus.")
+        if self.on_lost is not None:
+            self.on_lost()
+
+    def close(self):
+        self.outbox.close()
+        self.sock.close()
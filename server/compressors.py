@@ -0,0 +1,115 @@
+# compressors.py
+# Per-message compression negotiated in the HELLO/WELCOME handshake. A
+# framed client lists the codecs it can decode in HELLO ("compression":
+# ["zstd", "zlib"]); the server picks the first one in its own preference
+# order and names it in WELCOME. Clients that send no list, and legacy
+# clients, never see a compressed frame.
+#
+# A compressed frame has the high bit of its type byte set (FLAG_COMPRESSED
+# in protocol.py). Only payloads of at least COMPRESS_THRESHOLD bytes are
+# compressed, and only when that makes them smaller.
+#
+# zlib always works. zstd needs the `zstandard` package (or Python 3.14's
+# compression.zstd) and is skipped if neither is installed.
+
+import os
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    from compression import zstd as stdlib_zstd
+except ImportError:
+    stdlib_zstd = None
+
+# --- Configuration ---
+# Codecs the server agrees to, most preferred first; empty disables compression.
+COMPRESSION = os.environ.get('COMPRESSION', 'zstd,zlib')
+COMPRESS_THRESHOLD = int(os.environ.get('COMPRESS_THRESHOLD', '512'))
+ZLIB_LEVEL = int(os.environ.get('ZLIB_LEVEL', '6'))
+ZSTD_LEVEL = int(os.environ.get('ZSTD_LEVEL', '3'))
+
+
+class CompressionError(ValueError):
+    """A compressed payload was corrupt or would inflate past the size limit."""
+
+
+class ZlibCodec:
+    name = 'zlib'
+
+    def __init__(self, level=ZLIB_LEVEL):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data, max_size):
+        inflater = zlib.decompressobj()
+        try:
+            out = inflater.decompress(data, max_size)
+        except zlib.error as e:
+            raise CompressionError(f"Corrupt zlib payload: {e}") from None
+        if inflater.unconsumed_tail:
+            raise CompressionError(f"Compressed payload inflates past {max_size} bytes")
+        if not inflater.eof:
+            raise CompressionError("Truncated zlib payload")
+        return out
+
+
+class ZstdCodec:
+    name = 'zstd'
+
+    def __init__(self, level=ZSTD_LEVEL):
+        self.level = level
+        # A zstandard compressor must not be used by two threads at once.
+        self._lock = threading.Lock()
+        if zstandard is not None:
+            self._compressor = zstandard.ZstdCompressor(level=level)
+
+    def compress(self, data):
+        if zstandard is None:
+            return stdlib_zstd.compress(data, level=self.level)
+        with self._lock:
+            return self._compressor.compress(data)
+
+    def decompress(self, data, max_size):
+        try:
+            if zstandard is None:
+                inflater = stdlib_zstd.ZstdDecompressor()
+                out = inflater.decompress(data, max_length=max_size)
+                if not inflater.eof:
+                    raise CompressionError(f"Compressed payload inflates past {max_size} bytes")
+                return out
+            # The frame header carries the content size; reading past max_size
+            # raises instead of allocating it.
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+        except CompressionError:
+            raise
+        except Exception as e:
+            raise CompressionError(f"Corrupt zstd payload: {e}") from None
+
+
+CODECS = {'zlib': ZlibCodec()}
+if zstandard is not None or stdlib_zstd is not None:
+    CODECS['zstd'] = ZstdCodec()
+
+# The server's preference order, limited to codecs that are available here.
+PREFERENCE = [name.strip() for name in COMPRESSION.split(',') if name.strip() in CODECS]
+
+
+def negotiate(offered):
+    """Picks the codec for a client that offered `offered`; None if there is no match."""
+    if not isinstance(offered, list):
+        return None
+    for name in PREFERENCE:
+        if name in offered:
+            return name
+    return None
+
+
+def get(name):
+    """The codec object for a negotiated name, or None."""
+    return CODECS.get(name) if name else None
@@ -0,0 +1,341 @@
+# federation.py
+# Links between independent chat servers (nodes), e.g. several containers
+# behind one load balancer. Each node listens for peer links on
+# FEDERATION_PORT and keeps a persistent link to every address in
+# FEDERATION_PEERS, redialing with backoff when one drops.
+#
+# A room broadcast crosses each link once, as one RELAY frame, however many
+# of the peer's users are in the room; the peer fans it out locally. Frames
+# queued for a link while it is busy are written together in one send.
+#
+# Loops: every relayed message names its origin and the nodes it has already
+# been sent to. A node forwards a message it received only to peers outside
+# that set, adding them to it, so a full mesh forwards nothing and a chain
+# forwards exactly once per hop. A bounded set of recently seen message IDs
+# drops anything that still arrives twice, and MAX_HOPS caps the rest.
+#
+# Trust: a relayed message is delivered as if its sender were local, so a
+# link is only accepted from a node that proves it belongs. With
+# FEDERATION_SECRET set, each end's PEER carries a fresh nonce and the other
+# end answers with an AUTH frame holding HMAC(secret, nonce | its node id);
+# nothing else is read, and no existing link is replaced, until that checks
+# out. Without a secret, only the FEDERATION_PEERS addresses may link in.
+# The listener binds FEDERATION_HOST, loopback unless configured otherwise.
+
+import hashlib
+import hmac
+import os
+import random
+import secrets
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import log
+import outbound
+import protocol
+import storage
+
+# --- Configuration ---
+# Port peers connect to; 0 disables federation.
+FEDERATION_PORT = int(os.environ.get('FEDERATION_PORT', '0'))
+# Comma-separated host:port list of peers to dial.
+FEDERATION_PEERS = os.environ.get('FEDERATION_PEERS', '')
+# Unique name of this node; defaults to hostname:FEDERATION_PORT.
+NODE_ID = os.environ.get('NODE_ID', '')
+# Address the peer listener binds; nodes on other hosts need e.g. 0.0.0.0.
+FEDERATION_HOST = os.environ.get('FEDERATION_HOST', '127.0.0.1')
+# Shared by every node of the federation; see "Trust" above.
+FEDERATION_SECRET = os.environ.get('FEDERATION_SECRET', '')
+
+# Links carry every room's traffic, so they queue far more than a client.
+LINK_QUEUE_LIMIT = 100000
+SEEN_LIMIT = 100000
+MAX_HOPS = 8
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 30.0
+# Seconds a new link has to finish PEER (and AUTH) before it is dropped.
+HANDSHAKE_TIMEOUT = 5.0
+
+
+def parse_peers(text):
+    """'host:port,host:port' -> [(host, port), ...]"""
+    peers = []
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.rpartition(':')
+        if not host or not port.isdigit():
+            raise ValueError(f"Peer address must be host:port, got {item!r}")
+        peers.append((host, int(port)))
+    return peers
+
+
+class SeenIds:
+    """Bounded set of recently relayed message IDs, oldest evicted first."""
+
+    def __init__(self, limit=SEEN_LIMIT):
+        self.limit = limit
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, message_id):
+        """Records `message_id`; returns False if it was already there."""
+        with self._lock:
+            if message_id in self._ids:
+                return False
+            self._ids[message_id] = None
+            if len(self._ids) > self.limit:
+                self._ids.popitem(last=False)
+            return True
+
+
+class PeerLink:
+    """One TCP link to another node, in either direction."""
+
+    def __init__(self, sock, addr, dialed):
+        self.sock = sock
+        self.addr = addr
+        # Which side opened the link; settles duplicates (see Federation._register).
+        self.dialed = dialed
+        # The node id its PEER claimed, and `node` once the handshake is done.
+        self.claimed = None
+        self.node = None
+        outbound.tune_socket(sock)
+        self.outbox = outbound.ThreadedOutbox(sock, limit=LINK_QUEUE_LIMIT, policy=outbound.DROP_OLDEST)
+
+    def send(self, frame):
+        self.outbox.put(frame)
+
+    def close(self):
+        self.outbox.close()
+        outbound.shutdown_socket(self.sock)
+        self.sock.close()
+
+
+class Federation:
+    """This node's peer links. Plugs into the hub as `relay`.
+
+    publish() sends a local room broadcast to every peer; broadcasts from
+    peers are handed to `on_message(room, outgoing)` on a link's thread.
+    """
+
+    def __init__(self, on_message, listen_port=FEDERATION_PORT, peers=(), node_id=NODE_ID, host=FEDERATION_HOST,
+                 secret=FEDERATION_SECRET):
+        self.on_message = on_message
+        self.node_id = node_id or f"{socket.gethostname()}:{listen_port}"
+        self.host = host
+        self.secret = secret.encode('utf-8')
+        self.listen_port = listen_port
+        self.peers = list(peers)
+        self.seen = SeenIds()
+        # peer node id -> PeerLink, for links that finished the handshake.
+        self.links = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self.listener = None
+        self.published = 0
+        self.received = 0
+        self.duplicates = 0
+        self.forwarded = 0
+
+    def start(self):
+        if self.listen_port:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind((self.host, self.listen_port))
+            self.listener.listen()
+            threading.Thread(target=self._accept_loop, name='federation-accept', daemon=True).start()
+            log.info('FEDERATION', f"Node {self.node_id} listening for peers on {self.host}:{self.listen_port}")
+            if not self.secret:
+                log.warning('FEDERATION', "FEDERATION_SECRET is not set; only FEDERATION_PEERS may link in.")
+        for address in self.peers:
+            threading.Thread(target=self._dial_loop, args=(address,), name='federation-dial', daemon=True).start()
+
+    # --- Outgoing traffic ---
+
+    def publish(self, room, outgoing):
+        fields = outgoing.to_dict()
+        fields['room'] = room
+        # System announcements have no ID of their own but still need deduplicating.
+        fields['id'] = fields['id'] or storage.new_message_id()
+        fields['origin'] = self.node_id
+        fields['hops'] = 0
+        self.seen.add(fields['id'])
+        if self._send(fields, exclude=(self.node_id,)):
+            self.published += 1
+
+    def _send(self, fields, exclude):
+        """Sends to every linked peer not in `exclude`; returns how many there were."""
+        with self._lock:
+            targets = [link for node, link in self.links.items() if node not in exclude]
+        if not targets:
+            return 0
+        fields['sent_to'] = sorted(set(exclude) | {link.node for link in targets})
+        frame = protocol.encode_json(protocol.RELAY, fields)
+        for link in targets:
+            link.send(frame)
+        return len(targets)
+
+    # --- Incoming traffic ---
+
+    def _receive(self, link, fields):
+        if not self.seen.add(fields['id']):
+            self.duplicates += 1
+            return
+        self.received += 1
+        self.on_message(fields['room'], protocol.Outgoing.from_dict(fields))
+        if fields['hops'] + 1 < MAX_HOPS:
+            fields['hops'] += 1
+            if self._send(fields, exclude=fields['sent_to']):
+                self.forwarded += 1
+
+    # --- Links ---
+
+    def _accept_loop(self):
+        while not self._closed:
+            try:
+                sock, addr = self.listener.accept()
+            except OSError:
+                return
+            if not self.secret and addr[0] not in self._peer_ips():
+                log.warning('FEDERATION ERROR', f"Refused a link from {addr[0]}:{addr[1]}, which is not a peer.")
+                sock.close()
+                continue
+            link = PeerLink(sock, addr, dialed=False)
+            threading.Thread(target=self._run_link, args=(link,), daemon=True).start()
+
+    def _peer_ips(self):
+        # Resolved on every accept: a peer's address may change while we run.
+        ips = set()
+        for host, port in self.peers:
+            try:
+                ips.update(info[4][0] for info in socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP))
+            except OSError:
+                continue
+        return ips
+
+    def _dial_loop(self, address):
+        delay = RECONNECT_MIN
+        while not self._closed:
+            try:
+                sock = socket.create_connection(address, timeout=5)
+                sock.settimeout(None)
+            except OSError:
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, RECONNECT_MAX)
+                continue
+            link = PeerLink(sock, address, dialed=True)
+            if self._run_link(link) in ('duplicate', 'self'):
+                # The peer dials us as well and that link won (or the address
+                # is our own); check back later.
+                time.sleep(RECONNECT_MAX)
+            elif link.node is None:
+                # Turned away in the handshake (e.g. a different secret): back off.
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, RECONNECT_MAX)
+            else:
+                delay = RECONNECT_MIN
+                time.sleep(RECONNECT_MIN)
+
+    def _run_link(self, link):
+        """Handshakes and reads one link until it drops. Returns why it ended."""
+        host, port = link.addr[:2]
+        decoder = protocol.FrameDecoder()
+        nonce = secrets.token_hex(16)
+        link.sock.settimeout(HANDSHAKE_TIMEOUT)
+        link.send(protocol.encode_json(protocol.PEER, {'node': self.node_id, 'nonce': nonce}))
+        reason = 'closed'
+        try:
+            while decoder.recv_into(link.sock):
+                for ftype, payload in decoder.frames():
+                    if link.node is None:
+                        outcome = self._handshake(link, ftype, protocol.decode_json(payload), nonce)
+                        if outcome is None:
+                            continue
+                        reason = outcome
+                        if reason != 'registered':
+                            return reason
+                        link.sock.settimeout(None)
+                        log.info('FEDERATION', f"Linked to node {link.node} ({host}:{port}).")
+                    elif ftype == protocol.RELAY:
+                        self._receive(link, protocol.decode_json(payload))
+        except (OSError, protocol.ProtocolError, KeyError, TypeError) as e:
+            if not self._closed:
+                log.error('FEDERATION ERROR', f"Link to {host}:{port} failed: {e}")
+            reason = 'failed'
+        finally:
+            with self._lock:
+                if link.node is not None and self.links.get(link.node) is link:
+                    del self.links[link.node]
+                    if not self._closed:
+                        log.warning('FEDERATION', f"Lost node {link.node} ({host}:{port}).")
+            link.close()
+        return reason
+
+    def _handshake(self, link, ftype, fields, nonce):
+        """Takes the peer's PEER, then its AUTH if there is a secret. Returns
+        None while more is expected, else how the handshake ended."""
+        if link.claimed is None:
+            if ftype != protocol.PEER:
+                raise protocol.ProtocolError("Expected PEER as the first frame")
+            node, peer_nonce = fields.get('node'), fields.get('nonce')
+            if not isinstance(node, str) or not node:
+                raise protocol.ProtocolError("PEER must carry a node id")
+            if node == self.node_id:
+                log.warning('FEDERATION ERROR', f"{link.addr[0]}:{link.addr[1]} is this node; not linking to itself.")
+                return 'self'
+            link.claimed = node
+            if not self.secret:
+                return self._register(link)
+            if not isinstance(peer_nonce, str) or not peer_nonce:
+                raise protocol.ProtocolError("PEER must carry a nonce")
+            link.send(protocol.encode_json(protocol.AUTH, {'mac': self._mac(peer_nonce, self.node_id)}))
+            return None
+        if ftype != protocol.AUTH:
+            raise protocol.ProtocolError("Expected AUTH after PEER")
+        mac = fields.get('mac')
+        if not isinstance(mac, str) or not hmac.compare_digest(mac, self._mac(nonce, link.claimed)):
+            raise protocol.ProtocolError(f"Node {link.claimed} did not prove the federation secret")
+        return self._register(link)
+
+    def _mac(self, nonce, node):
+        return hmac.new(self.secret, f"{nonce}|{node}".encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def _register(self, link):
+        node = link.claimed
+        with self._lock:
+            existing = self.links.get(node)
+            if existing is not None:
+                # Both nodes dialed each other. Keep the link opened by the
+                # node with the smaller id; both ends reach the same answer.
+                keep_dialed = self.node_id < node
+                if link.dialed != keep_dialed:
+                    return 'duplicate'
+                existing.close()
+            link.node = node
+            self.links[node] = link
+        return 'registered'
+
+    def stats(self):
+        with self._lock:
+            links = sorted(self.links)
+        return {
+            'node': self.node_id,
+            'links': links,
+            'published': self.published,
+            'received': self.received,
+            'duplicates': self.duplicates,
+            'forwarded': self.forwarded,
+        }
+
+    def close(self):
+        self._closed = True
+        if self.listener is not None:
+            self.listener.close()
+        with self._lock:
+            links = list(self.links.values())
+        for link in links:
+            link.close()
@@ -0,0 +1,165 @@
+# files.py
+# File sharing: "/send <file>" on the client uploads a file in CHUNK frames,
+# and "/get <id>" streams it back to anyone in the room.
+#
+# Files never go near chat_history. They are kept in a local
+# content-addressed store under BLOB_DIR, one file per SHA-256 digest
+# (BLOB_DIR/ab/abcdef...), so a file shared twice is stored once. It is still
+# uploaded twice: the digest is public (every /get id abbreviates one), so
+# knowing it proves nothing, and sharing a file takes its content. Only the
+# announcement ("alice shared report.pdf ...") is a chat message.
+#
+# Uploads are flow-controlled: the server acknowledges received bytes with
+# CREDIT frames and the client keeps at most UPLOAD_WINDOW unacknowledged
+# bytes in flight. Chunks are written to disk straight from the receive
+# buffer and hashed as they arrive. Downloads are sent with sendfile() a
+# CHUNK_SIZE slice at a time by the connection's outbox, which only starts a
+# slice when no chat frame is waiting (outbound.py), and the client
+# acknowledges them the same way, so no more than DOWNLOAD_WINDOW bytes of a
+# download can be queued in the kernel ahead of a chat line.
+
+import hashlib
+import os
+import re
+import tempfile
+
+import protocol
+
+# --- Configuration ---
+FILES_ENABLED = os.environ.get('FILES_ENABLED', '1') != '0'
+BLOB_DIR = os.environ.get('BLOB_DIR', 'chat_blobs')
+MAX_FILE_SIZE = int(os.environ.get('MAX_FILE_SIZE', str(100 * 2**20)))
+# Bytes per download CHUNK frame, and so the longest a chat frame can wait behind one.
+CHUNK_SIZE = min(int(os.environ.get('FILE_CHUNK_SIZE', '65536')), protocol.MAX_PAYLOAD - protocol.CHUNK_ID.size)
+# Unacknowledged upload bytes a client may have in flight.
+UPLOAD_WINDOW = int(os.environ.get('UPLOAD_WINDOW', '262144'))
+# Unacknowledged download bytes the server keeps in flight per download. It
+# bounds how much file data can sit in socket buffers ahead of a chat line.
+DOWNLOAD_WINDOW = int(os.environ.get('DOWNLOAD_WINDOW', '262144'))
+# Uploads, and downloads, one connection may run at once.
+MAX_TRANSFERS = 4
+# Shortest blob id prefix /get accepts.
+MIN_PREFIX = 8
+
+DIGEST = re.compile(r'^[0-9a-f]{64}$')
+PREFIX = re.compile(r'^[0-9a-f]+$')
+
+
+class BlobError(Exception):
+    """An upload or download that cannot go ahead; str() is the reason given to the client."""
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+class BlobWriter:
+    """One upload in progress: a temporary file, hashed as it is written."""
+
+    __slots__ = ('name', 'size', 'digest', 'received', 'acked', '_fd', '_path', '_hash')
+
+    def __init__(self, directory, name, size, digest):
+        self.name = name
+        self.size = size
+        # What the client says the content hashes to; checked at the end.
+        self.digest = digest
+        self.received = 0
+        self.acked = 0
+        self._fd, self._path = tempfile.mkstemp(dir=directory, prefix='upload-')
+        self._hash = hashlib.sha256()
+
+    def write(self, data):
+        """Appends a chunk (any buffer, e.g. a view of the receive buffer)."""
+        if self.received + len(data) > self.size:
+            raise BlobError(f"More than the announced {self.size} bytes.")
+        self._hash.update(data)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+        self.received += len(data)
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+    def abort(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            os.unlink(self._path)
+
+
+class BlobStore:
+    """Files by SHA-256 digest under `root`."""
+
+    def __init__(self, root=BLOB_DIR):
+        self.root = root
+        self.incoming = os.path.join(root, 'incoming')
+        os.makedirs(self.incoming, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def begin(self, name, size, digest):
+        """Starts an upload; raises BlobError if it is not acceptable.
+
+        Content the store already has is uploaded all the same, and
+        commit() drops the second copy once it has checked the digest.
+        """
+        if not DIGEST.match(digest):
+            raise BlobError("The file digest must be 64 lowercase hex digits (SHA-256).")
+        if size > MAX_FILE_SIZE:
+            raise BlobError(f"Files are limited to {format_size(MAX_FILE_SIZE)}.")
+        return BlobWriter(self.incoming, name, size, digest)
+
+    def commit(self, writer):
+        """Checks a finished upload and moves it into place. Blocks on fsync; run it offloaded."""
+        fd, writer._fd = writer._fd, None
+        target = self.path(writer.digest)
+        stored = os.path.exists(target)
+        try:
+            if writer._hash.hexdigest() != writer.digest:
+                raise BlobError("The upload does not match its digest.")
+            if not stored:
+                os.fsync(fd)
+        except BaseException:
+            os.close(fd)
+            os.unlink(writer._path)
+            raise
+        os.close(fd)
+        if stored:
+            # Kept already; the upload only showed that the sender has the file.
+            os.unlink(writer._path)
+            return writer.digest
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Same content under the same name: replacing an existing copy is harmless.
+        os.replace(writer._path, target)
+        return writer.digest
+
+    def find(self, prefix):
+        """The digest `prefix` abbreviates; raises BlobError if none or several."""
+        prefix = prefix.lower()
+        if len(prefix) < MIN_PREFIX or not PREFIX.match(prefix):
+            raise BlobError(f"Give at least {MIN_PREFIX} hex digits of the file id.")
+        try:
+            names = os.listdir(os.path.join(self.root, prefix[:2]))
+        except FileNotFoundError:
+            names = []
+        matches = [name for name in names if name.startswith(prefix)]
+        if not matches:
+            raise BlobError(f"No file {prefix}.")
+        if len(matches) > 1:
+            raise BlobError(f"{prefix} matches {len(matches)} files; give more digits.")
+        return matches[0]
+
+    def open(self, digest):
+        """(file object, size) for streaming a stored blob."""
+        f = open(self.path(digest), 'rb')
+        return f, os.fstat(f.fileno()).st_size
@@ -0,0 +1,364 @@
+# handoff.py
+# Zero-downtime reload. A new server process started with --takeover
+# connects to the running one over the Unix socket RELOAD_SOCKET and is
+# handed, with SCM_RIGHTS, the listening socket and every client connection,
+# with what the server knows about each: the name and room, what the client
+# negotiated at HELLO, the start of a frame that had only partly arrived,
+# frames not yet written and downloads in progress. Clients keep their TCP
+# connections throughout; all they see is a pause.
+#
+# The old process stops accepting and reading, cancels uploads in progress
+# (the client is told and can send again), gives every send queue until
+# HANDOFF_DRAIN_TIMEOUT to empty and writes out the persistence queue, so
+# nothing is in flight while the descriptors move. Once the new process has
+# confirmed it holds them, the old one forgets the connections without a
+# "has left" and exits; the new one waits for that before it opens the
+# history store, search index and ports of its own. If anything fails before
+# the confirmation, the old process carries on as if nothing had happened.
+#
+# A connection still stuck writing to a client that stopped reading when the
+# drain time is up is not handed over; it is closed and the client reconnects.
+
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+import log
+import outbound
+import storage
+
+# --- Configuration ---
+# Off unless set, e.g. RELOAD_SOCKET=/run/chat/reload.sock.
+RELOAD_SOCKET = os.environ.get('RELOAD_SOCKET', '')
+# How long the old process waits for reads to stop and send queues to empty.
+HANDOFF_DRAIN_TIMEOUT = float(os.environ.get('HANDOFF_DRAIN_TIMEOUT', '5'))
+# How long either side waits for the other.
+HANDOFF_TIMEOUT = float(os.environ.get('HANDOFF_TIMEOUT', '30'))
+# How often the threaded engine's blocked reads wake up to notice a handoff.
+HANDOFF_POLL = float(os.environ.get('HANDOFF_POLL', '0.2'))
+
+# Descriptors, and payload bytes, per message on the control socket.
+FDS_PER_MESSAGE = 200
+MESSAGE_BYTES = 65536
+
+
+class HandoffError(Exception):
+    """The handoff cannot go on; str() says why."""
+
+
+def _send(sock, header, payload=b'', fds=()):
+    """One JSON header message, carrying `fds`, then `payload` in MESSAGE_BYTES pieces."""
+    header = dict(header, size=len(payload))
+    socket.send_fds(sock, [json.dumps(header).encode('utf-8')], list(fds))
+    view = memoryview(payload)
+    for start in range(0, len(view), MESSAGE_BYTES):
+        sock.send(view[start:start + MESSAGE_BYTES])
+
+
+def _recv(sock):
+    """(header, payload, fds) of the next message sent with _send()."""
+    data, fds, flags, _ = socket.recv_fds(sock, MESSAGE_BYTES, FDS_PER_MESSAGE)
+    if not data:
+        raise HandoffError("the other process closed the control socket")
+    if flags & socket.MSG_CTRUNC:
+        for fd in fds:
+            os.close(fd)
+        raise HandoffError("descriptors were lost in transit")
+    header = json.loads(data)
+    parts, received = [], 0
+    while received < header['size']:
+        part = sock.recv(MESSAGE_BYTES)
+        if not part:
+            raise HandoffError("the other process closed the control socket")
+        parts.append(part)
+        received += len(part)
+    return header, b''.join(parts), fds
+
+
+def poll_reads(sock):
+    """Makes blocking reads and accepts on `sock` give up after HANDOFF_POLL
+    seconds (BlockingIOError), so the threaded engine's threads can notice a
+    handoff. Only the kernel times out: Python adds no poll() per call."""
+    seconds, fraction = divmod(HANDOFF_POLL, 1.0)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack('ll', int(seconds), int(fraction * 1e6)))
+
+
+# --- The old process ---
+
+def departure(hub, conn, reader, sock):
+    """(conn, state, fd, data) for handing over one connection whose reads
+    have stopped and whose outbox is frozen; `data` is its unparsed input
+    followed by its unsent output."""
+    pending = reader.decoder.pending()
+    output, downloads = conn.outbox.snapshot() if conn.outbox is not None else (b'', [])
+    cursor = conn.history_cursor
+    state = {
+        'addr': list(conn.addr[:2]),
+        'reader': reader.export(),
+        'token': conn.token,
+        'room': hub.rooms.room_of(conn),
+        'cursor': storage.to_epoch(cursor) if cursor is not None else None,
+        'downloads': [{'transfer': job.transfer, 'blob': os.path.basename(job.file.name),
+                       'offset': job.offset, 'acked': job.acked, 'remaining': job.remaining,
+                       'window': job.window, 'chunk_size': job.chunk_size} for job in downloads],
+        'input': len(pending),
+        'output': len(output),
+    }
+    return conn, state, sock.fileno(), pending + output
+
+
+def send_state(control, listener, departures, hub_state):
+    _send(control, {'op': 'listener'}, fds=[listener.fileno()])
+    for start in range(0, len(departures), FDS_PER_MESSAGE):
+        batch = departures[start:start + FDS_PER_MESSAGE]
+        states = json.dumps([state for _, state, _, _ in batch]).encode('utf-8')
+        _send(control, {'op': 'sessions', 'states': len(states)},
+              states + b''.join(data for _, _, _, data in batch), [fd for _, _, fd, _ in batch])
+    _send(control, {'op': 'done'}, json.dumps(hub_state).encode('utf-8'))
+
+
+class Gate:
+    """Where the threaded engine's reader and accept threads stop for a handoff.
+
+    Each thread tracks what it serves; once `requested` is set it calls
+    park() at its next chance, which blocks until the handoff is over.
+    """
+
+    def __init__(self):
+        self.requested = False
+        self._cond = threading.Condition()
+        self._tracked = {}
+        self._parked = 0
+        self._round = 0
+        self._outcome = False
+
+    def track(self, key, value=None):
+        with self._cond:
+            self._tracked[key] = value
+
+    def untrack(self, key):
+        with self._cond:
+            self._tracked.pop(key, None)
+            self._cond.notify_all()
+
+    def park(self):
+        """Waits out a handoff; True if it went through and the caller's connection is gone."""
+        with self._cond:
+            if not self.requested:
+                return False
+            current = self._round
+            self._parked += 1
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: self._round != current)
+            self._parked -= 1
+            return self._outcome
+
+    def close(self, deadline):
+        """Asks every thread to park; {key: value} of what they serve, or None
+        if some did not stop by `deadline` (time.monotonic())."""
+        with self._cond:
+            self.requested = True
+            if not self._cond.wait_for(lambda: self._parked >= len(self._tracked),
+                                       max(0.0, deadline - time.monotonic())):
+                return None
+            return dict(self._tracked)
+
+    def open(self, handed_over):
+        """Lets the parked threads go; `handed_over` is what park() returns them."""
+        with self._cond:
+            self.requested = False
+            self._outcome = handed_over
+            self._round += 1
+            self._cond.notify_all()
+
+
+class Handoff:
+    """The running process's side: waits on `path` for a successor and hands everything over.
+
+    `flush(timeout)` writes out the persistence queue, False if it could not
+    in time. The engine passed to start() does the connection work:
+
+        listener            the listening socket
+        quiesce(deadline)   stop accepting and reading; False if reads did not stop
+        drain(deadline)     cancel uploads, let send queues empty, freeze them;
+                            returns departure() of every connection to hand over
+        resume()            undo both, the handoff having failed
+        finish(conns)       forget the handed-over connections and stop serving
+    """
+
+    def __init__(self, path, hub, flush):
+        self.path = path
+        self.hub = hub
+        self.flush = flush
+
+    def start(self, engine):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        listener.bind(self.path)
+        listener.listen(1)
+        threading.Thread(target=self._serve, args=(listener, engine), name='handoff', daemon=True).start()
+        log.info('HANDOFF', "Accepting a successor on {path}.", path=self.path)
+
+    def _serve(self, listener, engine):
+        while True:
+            control, _ = listener.accept()
+            if self._hand_over(control, engine):
+                # The descriptor stays open until this process has exited,
+                # which the successor waits for.
+                control.detach()
+                listener.close()
+                return
+            control.close()
+
+    def _hand_over(self, control, engine):
+        control.settimeout(HANDOFF_TIMEOUT)
+        try:
+            request, _, fds = _recv(control)
+        except (OSError, ValueError, KeyError, HandoffError) as e:
+            log.warning('HANDOFF', "Ignoring a bad takeover request: {error}", error=str(e))
+            return False
+        for fd in fds:
+            os.close(fd)
+        if request.get('op') != 'takeover':
+            return False
+        pid = request.get('pid')
+        log.info('HANDOFF', "Process {pid} is taking over.", pid=pid)
+        started = time.perf_counter()
+        deadline = time.monotonic() + HANDOFF_DRAIN_TIMEOUT
+        try:
+            if not engine.quiesce(deadline):
+                raise HandoffError("reads did not stop in time")
+            quiesced = time.perf_counter()
+            departures = engine.drain(deadline)
+            drained = time.perf_counter()
+            if not self.flush(max(0.0, deadline - time.monotonic())):
+                raise HandoffError("the persistence queue did not drain in time")
+            flushed = time.perf_counter()
+            send_state(control, engine.listener, departures, self.hub.export_state())
+            reply, _, _ = _recv(control)
+            if reply.get('op') != 'ok':
+                raise HandoffError(f"unexpected reply {reply.get('op')!r}")
+        except (OSError, ValueError, KeyError, HandoffError) as e:
+            log.error('HANDOFF ERROR', "Handing over to process {pid} failed: {error}. Carrying on.",
+                      pid=pid, error=str(e))
+            engine.resume()
+            return False
+        done = time.perf_counter()
+        engine.finish([conn for conn, _, _, _ in departures])
+        log.info('HANDOFF', "Handed {count} connections to process {pid} in {total:.3f}s "
+                            "(quiesce {quiesce:.3f}s, drain {drain:.3f}s, flush {flush:.3f}s, transfer {transfer:.3f}s).",
+                 count=len(departures), pid=pid, total=done - started, quiesce=quiesced - started,
+                 drain=drained - quiesced, flush=flushed - drained, transfer=done - flushed)
+        return True
+
+
+# --- The new process ---
+
+class Arrival:
+    """One connection as the old process left it."""
+
+    __slots__ = ('state', 'sock', 'input', 'output')
+
+    def __init__(self, state, sock, input, output):
+        self.state = state
+        self.sock = sock
+        self.input = input
+        self.output = output
+
+    @property
+    def addr(self):
+        return tuple(self.state['addr'])
+
+
+class Inherited:
+    """Everything take_over() received: the listener, the connections and the hub's state."""
+
+    def __init__(self, control, listener, arrivals, hub_state, started):
+        self.control = control
+        self.listener = listener
+        self.arrivals = arrivals
+        self.hub_state = hub_state
+        # perf_counter() when the takeover was asked for.
+        self.started = started
+
+    def wait_released(self, timeout=HANDOFF_TIMEOUT):
+        """Blocks until the old process has exited, so its ports and files are free."""
+        self.control.settimeout(timeout)
+        try:
+            while self.control.recv(1):
+                pass
+        except OSError as e:
+            log.warning('HANDOFF', "The old process has not exited: {error}", error=str(e))
+        self.control.close()
+
+
+def take_over(path, timeout=HANDOFF_TIMEOUT):
+    """Asks the process serving on `path` for its connections; an Inherited, or None."""
+    started = time.perf_counter()
+    control = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    control.settimeout(timeout)
+    listener, arrivals = None, []
+    try:
+        control.connect(path)
+        _send(control, {'op': 'takeover', 'pid': os.getpid()})
+        while True:
+            header, payload, fds = _recv(control)
+            op = header.get('op')
+            if op == 'listener':
+                listener = socket.socket(fileno=fds[0])
+            elif op == 'sessions':
+                states = json.loads(payload[:header['states']])
+                data = memoryview(payload)[header['states']:]
+                for state, fd in zip(states, fds):
+                    input_end = state['input']
+                    output_end = input_end + state['output']
+                    arrivals.append(Arrival(state, socket.socket(fileno=fd),
+                                            bytes(data[:input_end]), bytes(data[input_end:output_end])))
+                    data = data[output_end:]
+            elif op == 'done':
+                hub_state = json.loads(payload)
+                break
+        if listener is None:
+            raise HandoffError("no listening socket was sent")
+        _send(control, {'op': 'ok'})
+    except (OSError, ValueError, KeyError, HandoffError) as e:
+        log.error('HANDOFF ERROR', "Could not take over from {path}: {error}", path=path, error=str(e))
+        # Closing our copies leaves the connections with the old process.
+        for sock in [listener] + [arrival.sock for arrival in arrivals]:
+            if sock is not None:
+                sock.close()
+        control.close()
+        return None
+    log.info('HANDOFF', "Took over {count} connections.", count=len(arrivals))
+    return Inherited(control, listener, arrivals, hub_state, started)
+
+
+def restore(hub, conn, arrival):
+    """Puts a handed-over connection back where it was. An engine calls this
+    once `conn` has its name and outbox from the restored reader."""
+    state = arrival.state
+    conn.token = state.get('token')
+    if state['cursor'] is not None:
+        conn.history_cursor = storage.from_epoch(state['cursor'])
+    if conn.name is None:
+        # It had not sent HELLO yet; it joins the usual way.
+        return
+    if arrival.output:
+        conn.outbox.put(arrival.output)
+    for fields in state['downloads']:
+        try:
+            f, size = hub.blobs.open(fields['blob'])
+        except (AttributeError, OSError) as e:
+            log.error('DOWNLOAD ERROR', "Could not resume a download of {blob}: {error}",
+                      blob=fields['blob'], error=str(e))
+            continue
+        job = outbound.FileSend(fields['transfer'], f, size, fields['window'], fields['chunk_size'])
+        job.offset, job.remaining, job.acked = fields['offset'], fields['remaining'], fields['acked']
+        conn.outbox.put_file(job)
+    hub.adopt(conn, state['room'])
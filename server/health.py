@@ -0,0 +1,122 @@
+# health.py
+# Liveness and readiness for the container orchestrator, and how long this
+# process took to start serving. Served next to /metrics (METRICS_PORT):
+#
+#   /healthz  200 while the engine is turning over: the session monitor has
+#             run within LIVENESS_STALL seconds. 503 means restart me.
+#   /readyz   200 once the chat port is listening, until shutdown begins.
+#             With READY_REQUIRES_STORE=1 the history store must be
+#             connected too; by default a server that relays chat and
+#             journals history meanwhile counts as ready.
+#
+# Both answer with a small JSON body describing the state.
+
+import os
+import threading
+import time
+
+import metrics
+
+# --- Configuration ---
+LIVENESS_STALL = float(os.environ.get('LIVENESS_STALL', '30'))
+READY_REQUIRES_STORE = os.environ.get('READY_REQUIRES_STORE', '0') != '0'
+
+# Store states.
+CONNECTING = 'connecting'
+CONNECTED = 'connected'
+NONE = 'none'
+
+
+def _process_started():
+    """time.monotonic() at which this process was exec'd, interpreter startup included."""
+    try:
+        with open('/proc/self/stat') as f:
+            started_ticks = int(f.read().rpartition(')')[2].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return time.monotonic()
+    # CLOCK_MONOTONIC and /proc/uptime both count from boot.
+    return time.monotonic() - (uptime - started_ticks / os.sysconf('SC_CLK_TCK'))
+
+
+class Health:
+    """Startup milestones and the state the probes report."""
+
+    def __init__(self, started_at=None):
+        self.started_at = _process_started() if started_at is None else started_at
+        self.listening_at = None
+        self.first_accept_at = None
+        self.store_ready_at = None
+        self.store = NONE
+        self.draining = False
+        self.last_tick = time.monotonic()
+        self._lock = threading.Lock()
+
+    def since_start(self, at):
+        return round(at - self.started_at, 3) if at is not None else None
+
+    def listening(self):
+        """The chat port is bound; returns seconds since the process started."""
+        self.listening_at = time.monotonic()
+        return self.since_start(self.listening_at)
+
+    def accepted(self):
+        # One attribute test per accept after the first.
+        if self.first_accept_at is None:
+            with self._lock:
+                if self.first_accept_at is None:
+                    self.first_accept_at = time.monotonic()
+
+    def store_connecting(self):
+        self.store = CONNECTING
+
+    def store_connected(self):
+        self.store = CONNECTED
+        self.store_ready_at = time.monotonic()
+        return self.since_start(self.store_ready_at)
+
+    def tick(self):
+        self.last_tick = time.monotonic()
+
+    def live(self):
+        stalled = time.monotonic() - self.last_tick
+        return stalled < LIVENESS_STALL, {'stalled_seconds': round(stalled, 3)}
+
+    def ready(self):
+        ok = (self.listening_at is not None and not self.draining
+              and (self.store == CONNECTED or not READY_REQUIRES_STORE))
+        return ok, {
+            'listening': self.listening_at is not None,
+            'draining': self.draining,
+            'store': self.store,
+            'startup': {
+                'listening_seconds': self.since_start(self.listening_at),
+                'first_accept_seconds': self.since_start(self.first_accept_at),
+                'store_ready_seconds': self.since_start(self.store_ready_at),
+            },
+        }
+
+
+HEALTH = Health()
+
+metrics.route('/healthz', HEALTH.live)
+metrics.route('/readyz', HEALTH.ready)
+metrics.gauge('chat_startup_listening_seconds', "Seconds from process start to the chat port listening.",
+              lambda: HEALTH.since_start(HEALTH.listening_at) or 0)
+metrics.gauge('chat_startup_first_accept_seconds', "Seconds from process start to the first accepted connection.",
+              lambda: HEALTH.since_start(HEALTH.first_accept_at) or 0)
+metrics.gauge('chat_store_connected', "1 once the history store is connected.",
+              lambda: int(HEALTH.store == CONNECTED))
+
+
+def listening():
+    return HEALTH.listening()
+
+
+def accepted():
+    HEALTH.accepted()
+
+
+def tick():
+    HEALTH.tick()
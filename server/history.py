@@ -0,0 +1,53 @@
+# history.py
+# Per-room ring buffers of the most recent chat messages. They hold the
+# Outgoing objects that were broadcast, whose wire encodings are already
+# cached, so replaying them to a joining client is a few list operations and
+# never touches the database.
+
+import os
+import threading
+from collections import deque
+
+RING_SIZE = int(os.environ.get('HISTORY_RING_SIZE', '50'))
+
+
+class RecentHistory:
+    """room -> the last `size` chat messages sent in it, oldest first."""
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self._rings = {}
+        self._lock = threading.Lock()
+
+    def append(self, room, outgoing):
+        with self._lock:
+            ring = self._rings.get(room)
+            if ring is None:
+                ring = self._rings[room] = deque(maxlen=self.size)
+            ring.append(outgoing)
+
+    def extend(self, room, outgoings):
+        for outgoing in outgoings:
+            self.append(room, outgoing)
+
+    def seed(self, room, outgoings):
+        """Puts older messages (oldest first) in front of those already in the ring.
+
+        For filling a ring from the store after live messages have arrived;
+        messages the ring already holds are skipped.
+        """
+        with self._lock:
+            ring = self._rings.get(room)
+            current = list(ring) if ring else []
+            held = {outgoing.message_id for outgoing in current}
+            older = [outgoing for outgoing in outgoings if outgoing.message_id not in held]
+            self._rings[room] = deque(older + current, maxlen=self.size)
+
+    def rooms(self):
+        with self._lock:
+            return list(self._rings)
+
+    def snapshot(self, room):
+        with self._lock:
+            ring = self._rings.get(room)
+            return list(ring) if ring else []
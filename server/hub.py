@@ -0,0 +1,600 @@
+# hub.py
+# Engine-independent chat logic: who is connected, which room each client is
+# in, and what happens when a client joins, talks or leaves. Both engines
+# (server.py's threads and aio_server.py's event loop) feed it connection
+# objects derived from session.Session, with a non-blocking `send()`.
+
+import hmac
+import itertools
+import os
+import secrets
+import threading
+import time
+from datetime import datetime
+
+import files
+import log
+import metrics
+import outbound
+import protocol
+import search
+import storage
+from history import RecentHistory
+from names import NameIndex
+from rooms import DEFAULT_ROOM, DIRECT, RoomIndex, normalize_room
+
+# Default and maximum page size for /older.
+HISTORY_PAGE = int(os.environ.get('HISTORY_PAGE', '50'))
+HISTORY_PAGE_MAX = 500
+# Names /who lists before summarising the rest as a count.
+WHO_LIMIT = 100
+
+
+def run_inline(fn, callback):
+    """Default `offload`: runs blocking work on the calling thread."""
+    try:
+        result = fn()
+    except Exception as e:
+        callback(None, e)
+    else:
+        callback(result, None)
+
+
+class ChatHub:
+    """Connected clients, their rooms, and the commands they can run."""
+
+    def __init__(self, save_message, store=None):
+        self.save_message = save_message
+        # History backend for /older; None when running without one.
+        self.store = store
+        # search.SearchIndex for /search, or None.
+        self.search = None
+        # files.BlobStore for /send and /get, or None.
+        self.blobs = None
+        self._downloads = itertools.count(1)
+        # offload(fn, callback) runs blocking work such as a history query
+        # and calls callback(result, error) back on the engine's own terms.
+        self.offload = run_inline
+        # call_soon(fn, *args) runs fn on the engine's own thread; used for
+        # work arriving from other threads, like the worker bus.
+        self.call_soon = lambda fn, *args: fn(*args)
+        # Link to the other worker processes (bus.BusClient) or to other
+        # nodes (federation.Federation), if any.
+        self.relay = None
+        # Sessions that have sent HELLO and not yet left.
+        self.clients = set()
+        self.clients_lock = threading.Lock()
+        self.rooms = RoomIndex()
+        self.names = NameIndex()
+        self.recent = RecentHistory()
+        self.commands = {
+            'join': self.cmd_join,
+            'leave': self.cmd_leave,
+            'rooms': self.cmd_rooms,
+            'older': self.cmd_older,
+            'search': self.cmd_search,
+            'msg': self.cmd_msg,
+            'who': self.cmd_who,
+            'dms': self.cmd_dms,
+            'send': self.cmd_send,
+            'get': self.cmd_get,
+            'help': self.cmd_help,
+        }
+
+    def warm_recent(self):
+        """Seeds the ring buffer of every room with stored history from the store, e.g. after a restart.
+
+        Safe to call while clients are already talking: stored messages go
+        in front of the live ones.
+        """
+        if self.store is None:
+            return
+        for room in sorted(self.store.rooms() | {DEFAULT_ROOM}):
+            docs = self.store.history(limit=self.recent.size, room=room)
+            self.recent.seed(room, [self._from_document(doc) for doc in docs])
+
+    # --- Connection lifecycle ---
+
+    def claim(self, conn):
+        """Reserves the name a client sent in HELLO; returns why it cannot have it, or None.
+
+        Engines call this before WELCOME, and turn the client away on a
+        refusal. A reconnect takes its name back from a session that has not
+        yet been noticed dead, which is dropped, only if it presents that
+        session's resume token (or the session is already closed).
+        """
+        while not self.names.claim(conn):
+            holder = self.names.get(conn.name)
+            if holder is None:
+                # Released in the meantime; try again.
+                continue
+            if not self._resumes(conn, holder) or not self.names.replace(holder, conn):
+                return f"The name {conn.name} is taken."
+            log.info('RECONNECTED', "{name} reconnected; dropping the old session.", name=conn.name)
+            holder.replaced = True
+            holder.expire('replaced by a reconnect')
+            break
+        conn.token = secrets.token_urlsafe(16)
+        return None
+
+    @staticmethod
+    def _resumes(conn, holder):
+        if holder.closed:
+            return True
+        token = conn.resume['token'] if conn.resume is not None else None
+        return token is not None and holder.token is not None and hmac.compare_digest(token, holder.token)
+
+    def join(self, conn):
+        # A reconnecting client goes back to its room and is sent only what it missed.
+        room, after = DEFAULT_ROOM, None
+        if conn.resume is not None:
+            room = normalize_room(conn.resume['room'] or '') or DEFAULT_ROOM
+            after = conn.resume['after']
+        with self.clients_lock:
+            self.clients.add(conn)
+        self.rooms.add(conn, room)
+        ip, port = conn.addr[:2]
+        log.info('NEW CONNECTION', "{name} ({ip}:{port}) connected.", name=conn.name, ip=ip, port=port)
+        self.replay_recent(conn, room, after)
+        announcement = protocol.Outgoing.system(f"[SERVER] {conn.name} has joined the chat.")
+        self.broadcast(announcement, conn, room)
+
+    def leave(self, conn):
+        # Before the membership test: a client can claim its name and drop before joining.
+        self.names.release(conn)
+        self.cancel_uploads(conn)
+        with self.clients_lock:
+            if conn not in self.clients:
+                return
+            self.clients.remove(conn)
+        name = conn.name
+        room = self.rooms.remove(conn)
+        if not conn.replaced:
+            # A replaced session's user is still online, under the new one.
+            departure_message = protocol.Outgoing.system(f"[SERVER] {name} has left the chat.")
+            self.broadcast(departure_message, None, room)
+        ip, port = conn.addr[:2]
+        if conn.outbox.dropped:
+            log.info('DISCONNECTED', "{name} ({ip}:{port}) disconnected. ({dropped} messages dropped)",
+                     name=name, ip=ip, port=port, dropped=conn.outbox.dropped)
+        else:
+            log.info('DISCONNECTED', "{name} ({ip}:{port}) disconnected.", name=name, ip=ip, port=port)
+
+    def adopt(self, conn, room):
+        """Takes in a client handed over by the previous server process (handoff.py), unannounced."""
+        self.names.claim(conn)
+        with self.clients_lock:
+            self.clients.add(conn)
+        self.rooms.add(conn, room or DEFAULT_ROOM)
+
+    def detach(self, conn):
+        """Forgets a client handed over to the next server process, unannounced."""
+        if conn.name is None:
+            # Had not sent HELLO.
+            return
+        self.names.release(conn)
+        with self.clients_lock:
+            self.clients.discard(conn)
+        self.rooms.remove(conn)
+
+    def export_state(self):
+        """What a successor process needs besides the connections: the recent-message rings."""
+        return {
+            'recent': {room: [outgoing.to_dict() for outgoing in self.recent.snapshot(room)]
+                       for room in self.recent.rooms()},
+            # Download ids carry on, so none clashes with a handed-over download.
+            'next_download': next(self._downloads),
+        }
+
+    def restore_state(self, state):
+        for room, messages in state['recent'].items():
+            self.recent.extend(room, [protocol.Outgoing.from_dict(fields) for fields in messages])
+        self._downloads = itertools.count(state['next_download'])
+
+    # --- Messages ---
+
+    def handle_message(self, conn, text, received_at=None):
+        """Runs a command or broadcasts a chat message.
+
+        `received_at` is the perf_counter() reading taken when the engine read
+        the message off the socket, for the recv-to-broadcast histogram.
+        """
+        conn.messages_in += 1
+        limits = conn.limits
+        if limits is not None and not limits.allow_message():
+            metrics.MESSAGES_RATE_LIMITED.inc()
+            # One notice per run of drops, not one per dropped line.
+            if not limits.dropping:
+                limits.dropping = True
+                log.warning('RATE LIMITED', "{name} is over the message rate; dropping.", name=conn.name)
+                self.reply(conn, "You are sending messages too fast; some were dropped.")
+            return
+        if limits is not None:
+            limits.dropping = False
+        if text.startswith('/'):
+            self.handle_command(conn, text)
+            return
+        room = self.rooms.room_of(conn)
+        message_id, timestamp = storage.new_message_id(), datetime.utcnow()
+        if metrics.ENABLED:
+            metrics.MESSAGES_RECEIVED.inc()
+            start = time.perf_counter()
+            self.save_message(conn.name, text, room, message_id, timestamp)
+            metrics.SAVE_MESSAGE.observe(time.perf_counter() - start)
+        else:
+            self.save_message(conn.name, text, room, message_id, timestamp)
+        log.info('BROADCAST', "{name} in #{room}: {text}", name=conn.name, room=room, text=text)
+        outgoing = protocol.Outgoing.chat(conn.name, text, room, message_id, timestamp)
+        self.recent.append(room, outgoing)
+        self.broadcast(outgoing, conn, room)
+        if received_at is not None and metrics.ENABLED:
+            metrics.RECV_TO_BROADCAST.observe(time.perf_counter() - received_at)
+
+    def broadcast(self, message, sender, room):
+        """Queues `message` for every member of `room` except `sender`.
+
+        In multi-process or federated mode the message is also published to
+        the other workers or nodes, which deliver it to their own members.
+        """
+        self.deliver(message, sender, room)
+        if self.relay is not None:
+            self.relay.publish(room, message)
+
+    def deliver(self, message, sender, room):
+        members = self.rooms.members(room)
+        # Timing the whole fan-out and dividing keeps the clock reads off the
+        # per-recipient loop.
+        start = time.perf_counter()
+        recipients = 0
+        for member in members:
+            if member is not sender:
+                member.send(message)
+                recipients += 1
+        if recipients and metrics.ENABLED:
+            metrics.RECIPIENT_SEND.observe((time.perf_counter() - start) / recipients)
+
+    def deliver_remote(self, room, message):
+        """Delivers a broadcast from another worker or node; never relays it again."""
+        self.call_soon(self._deliver_remote, room, message)
+
+    def _deliver_remote(self, room, message):
+        if room == DIRECT:
+            # From a process running an older version: the local holder of
+            # the name need not be the user it was meant for.
+            return
+        if message.ftype == protocol.MESSAGE:
+            self.recent.append(room, message)
+        self.deliver(message, None, room)
+
+    def reply(self, conn, text):
+        conn.send(protocol.Outgoing.system(f"[SERVER] {text}"))
+
+    # --- Files ---
+
+    def begin_upload(self, conn, upload):
+        """Starts the upload a client announced with UPLOAD (protocol.parse_upload)."""
+        transfer = upload['transfer']
+        if self.blobs is None:
+            conn.outbox.put(protocol.credit_frame(transfer, 0, error="File sharing is not available on this server."))
+            return
+        uploads = conn.uploads or {}
+        if transfer in uploads or len(uploads) >= files.MAX_TRANSFERS:
+            conn.outbox.put(protocol.credit_frame(
+                transfer, 0, error=f"At most {files.MAX_TRANSFERS} uploads at a time, with distinct ids."))
+            return
+        try:
+            writer = self.blobs.begin(upload['name'], upload['size'], upload['sha256'])
+        except (files.BlobError, OSError) as e:
+            conn.outbox.put(protocol.credit_frame(transfer, 0, error=str(e)))
+            return
+        log.info('UPLOAD', "{name} is sending {file} ({size}).",
+                 name=conn.name, file=writer.name, size=files.format_size(writer.size))
+        if writer.complete:
+            self._store(conn, transfer, writer)
+            return
+        uploads[transfer] = writer
+        conn.uploads = uploads
+        conn.outbox.put(protocol.credit_frame(transfer, 0, window=files.UPLOAD_WINDOW))
+
+    def cancel_uploads(self, conn, reason=None):
+        """Abandons a client's uploads in progress; with `reason`, tells the client why."""
+        if not conn.uploads:
+            return
+        for transfer, writer in conn.uploads.items():
+            writer.abort()
+            if reason is not None:
+                conn.outbox.put(protocol.credit_frame(transfer, writer.received, error=reason))
+        conn.uploads = None
+
+    def upload_chunk(self, conn, transfer, data):
+        """Writes a CHUNK to its upload; `data` is a view of the receive buffer.
+
+        Returns True if the bytes went into an upload. Those are paced by the
+        credit window instead of the connection's byte rate, which engines
+        charge only with the rest.
+        """
+        writer = conn.uploads.get(transfer) if conn.uploads else None
+        if writer is None:
+            # Chunks still in flight after a failed upload.
+            return False
+        try:
+            writer.write(data)
+        except (files.BlobError, OSError) as e:
+            del conn.uploads[transfer]
+            writer.abort()
+            conn.outbox.put(protocol.credit_frame(transfer, writer.received, error=str(e)))
+            return False
+        metrics.FILE_BYTES_RECEIVED.inc(len(data))
+        if writer.complete:
+            del conn.uploads[transfer]
+            self._store(conn, transfer, writer)
+        elif writer.received - writer.acked >= files.UPLOAD_WINDOW // 2:
+            # Credit in half-window steps keeps the client sending without a CREDIT per chunk.
+            writer.acked = writer.received
+            conn.outbox.put(protocol.credit_frame(transfer, writer.received))
+        return True
+
+    def _store(self, conn, transfer, writer):
+        def stored(digest, error):
+            if error is not None:
+                if isinstance(error, files.BlobError):
+                    log.warning('UPLOAD REFUSED', "{name}'s {file}: {error}", name=conn.name, file=writer.name, error=error)
+                    reason = str(error)
+                else:
+                    log.error('UPLOAD ERROR', "{name}'s {file}: {error}", name=conn.name, file=writer.name, error=error)
+                    reason = "Could not store the file."
+                conn.outbox.put(protocol.credit_frame(transfer, writer.received, error=reason))
+                return
+            metrics.FILES_STORED.inc()
+            conn.outbox.put(protocol.credit_frame(transfer, writer.received, blob=digest))
+            if not conn.closed:
+                self._share(conn, writer.name, writer.size, digest)
+
+        self.offload(lambda: self.blobs.commit(writer), stored)
+
+    def _share(self, conn, name, size, digest):
+        """Announces a stored file to the sender's room as a chat message."""
+        room = self.rooms.room_of(conn)
+        if room is None:
+            return
+        text = f"shared {name} ({files.format_size(size)}): /get {digest[:12]}"
+        message_id, timestamp = storage.new_message_id(), datetime.utcnow()
+        attachment = {'blob': digest, 'name': name, 'size': size}
+        self.save_message(conn.name, text, room, message_id, timestamp, attachment=attachment)
+        log.info('BROADCAST', "{name} in #{room}: {text}", name=conn.name, room=room, text=text)
+        outgoing = protocol.Outgoing.chat(conn.name, text, room, message_id, timestamp, attachment)
+        self.recent.append(room, outgoing)
+        self.broadcast(outgoing, conn, room)
+        conn.send(outgoing)
+
+    # --- History ---
+
+    def replay_recent(self, conn, room, after=None):
+        """Sends the room's ring buffer to a client that just entered it.
+
+        With `after`, the id of the last message the client saw, only the
+        messages that followed it are sent. If that id has already left the
+        ring the whole ring is sent, and the client drops what it has.
+        """
+        recent = self.recent.snapshot(room)
+        # /older continues from the oldest message the client has been shown.
+        conn.history_cursor = recent[0].timestamp if recent else datetime.utcnow()
+        ids = [outgoing.message_id for outgoing in recent] if after is not None else ()
+        if after in ids:
+            missed = recent[ids.index(after) + 1:]
+            if missed:
+                self.reply(conn, f"{len(missed)} missed messages in #{room}:")
+                for outgoing in missed:
+                    conn.send(outgoing)
+            return
+        if recent:
+            self.reply(conn, f"Last {len(recent)} messages in #{room}:")
+            for outgoing in recent:
+                conn.send(outgoing)
+
+    @staticmethod
+    def _from_document(doc):
+        if doc.get('recipient') is not None:
+            return protocol.Outgoing.direct(doc['sender_name'], doc['recipient'], doc['message'],
+                                            doc['_id'], doc['timestamp'])
+        return protocol.Outgoing.chat(doc['sender_name'], doc['message'], doc['room'],
+                                      doc['_id'], doc['timestamp'], doc.get('file'))
+
+    # --- Commands ---
+
+    def handle_command(self, conn, text):
+        command, _, argument = text[1:].partition(' ')
+        handler = self.commands.get(command.lower())
+        if handler is None:
+            self.reply(conn, f"Unknown command /{command}. Try /help.")
+            return
+        handler(conn, argument.strip())
+
+    def cmd_join(self, conn, argument):
+        room = normalize_room(argument)
+        if room is None:
+            self.reply(conn, "Usage: /join <room> (letters, digits, '-' and '_', up to 32).")
+            return
+        self._move(conn, room)
+
+    def cmd_leave(self, conn, argument):
+        if self.rooms.room_of(conn) == DEFAULT_ROOM:
+            self.reply(conn, f"You are already in #{DEFAULT_ROOM}.")
+            return
+        self._move(conn, DEFAULT_ROOM)
+
+    def cmd_rooms(self, conn, argument):
+        listing = ', '.join(f"#{room} ({count})" for room, count in self.rooms.listing())
+        self.reply(conn, f"Rooms: {listing}")
+
+    def cmd_older(self, conn, argument):
+        try:
+            limit = min(int(argument), HISTORY_PAGE_MAX) if argument else HISTORY_PAGE
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            self.reply(conn, "Usage: /older [count]")
+            return
+        if self.store is None:
+            self.reply(conn, "History is not available right now.")
+            return
+        room, before = self.rooms.room_of(conn), conn.history_cursor
+
+        def fetch():
+            return self.store.history(limit=limit, before=before, room=room)
+
+        def deliver(docs, error):
+            if self.rooms.room_of(conn) != room:
+                return
+            if error is not None:
+                log.error('DATABASE ERROR', f"History query failed: {error}")
+                self.reply(conn, "History is unavailable right now.")
+                return
+            if not docs:
+                self.reply(conn, f"No older messages in #{room}.")
+                return
+            conn.history_cursor = docs[0]['timestamp']
+            self.reply(conn, f"{len(docs)} older messages in #{room}:")
+            for doc in docs:
+                conn.send(self._from_document(doc))
+
+        self.offload(fetch, deliver)
+
+    def cmd_search(self, conn, argument):
+        if self.search is None:
+            self.reply(conn, "Search is not available on this server.")
+            return
+        try:
+            query = search.parse_query(argument)
+        except ValueError as e:
+            self.reply(conn, f"{e} Usage: /search <words> [in:<room>] [from:<name>] [since:7d] [until:2024-05-01]")
+            return
+
+        def deliver(hits, error):
+            if error is not None:
+                log.error('SEARCH ERROR', f"Search failed: {error}")
+                self.reply(conn, "Search is unavailable right now.")
+                return
+            if not hits:
+                self.reply(conn, f"No messages match '{argument}'.")
+                return
+            self.reply(conn, f"{len(hits)} most recent {'match' if len(hits) == 1 else 'matches'} for '{argument}':")
+            for hit in hits:
+                when = storage.from_epoch(hit.timestamp).strftime('%Y-%m-%d %H:%M')
+                self.reply(conn, f"#{hit.room} {when} {hit.sender}: {hit.text}")
+
+        self.offload(lambda: self.search.search(query), deliver)
+
+    def cmd_msg(self, conn, argument):
+        name, _, text = argument.partition(' ')
+        text = text.strip()
+        if not name or not text:
+            self.reply(conn, "Usage: /msg <name> <message>")
+            return
+        target = self.names.get(name)
+        if target is conn:
+            self.reply(conn, "That is you.")
+            return
+        if target is None:
+            # Names are only unique within one process (names.py), so a name
+            # elsewhere may be someone else's: direct messages stay local.
+            where = "on this server" if self.relay is not None else "online"
+            self.reply(conn, f"No one called {name} is {where}.")
+            return
+        recipient = target.name
+        message_id, timestamp = storage.new_message_id(), datetime.utcnow()
+        self.save_message(conn.name, text, DIRECT, message_id, timestamp, recipient)
+        # Only who wrote to whom: the text of a direct message stays out of the logs.
+        log.info('DIRECT', "{name} -> {recipient} ({id})", name=conn.name, recipient=recipient, id=message_id)
+        outgoing = protocol.Outgoing.direct(conn.name, recipient, text, message_id, timestamp)
+        target.send(outgoing)
+        conn.send(outgoing)
+
+    def cmd_who(self, conn, argument):
+        if argument:
+            room = normalize_room(argument)
+            if room is None:
+                self.reply(conn, "Usage: /who [room]")
+                return
+            names = sorted((member.name for member in self.rooms.members(room)), key=str.casefold)
+            where = f"in #{room}"
+        else:
+            names = self.names.names()
+            where = "online"
+        if self.relay is not None:
+            # Membership and names are only known for this process.
+            where += " on this server"
+        if not names:
+            self.reply(conn, f"No one is {where}.")
+            return
+        listing = ', '.join(names[:WHO_LIMIT])
+        if len(names) > WHO_LIMIT:
+            listing += f" and {len(names) - WHO_LIMIT} more"
+        self.reply(conn, f"{len(names)} {where}: {listing}")
+
+    def cmd_dms(self, conn, argument):
+        if self.store is None:
+            self.reply(conn, "History is not available right now.")
+            return
+        user, peer = conn.name, argument or None
+
+        def fetch():
+            return self.store.direct_history(user, limit=HISTORY_PAGE, peer=peer)
+
+        def deliver(docs, error):
+            if error is not None:
+                log.error('DATABASE ERROR', f"Direct message query failed: {error}")
+                self.reply(conn, "History is unavailable right now.")
+                return
+            with_peer = f" with {peer}" if peer else ""
+            if not docs:
+                self.reply(conn, f"No direct messages{with_peer}.")
+                return
+            self.reply(conn, f"Last {len(docs)} direct messages{with_peer}:")
+            for doc in docs:
+                conn.send(self._from_document(doc))
+
+        self.offload(fetch, deliver)
+
+    def cmd_send(self, conn, argument):
+        # Clients that support files handle /send themselves.
+        self.reply(conn, "Your client cannot send files.")
+
+    def cmd_get(self, conn, argument):
+        if self.blobs is None:
+            self.reply(conn, "File sharing is not available on this server.")
+            return
+        if not conn.framed:
+            self.reply(conn, "Your client cannot receive files.")
+            return
+        if conn.outbox.downloads >= files.MAX_TRANSFERS:
+            self.reply(conn, f"At most {files.MAX_TRANSFERS} downloads at a time.")
+            return
+        try:
+            digest = self.blobs.find(argument)
+            f, size = self.blobs.open(digest)
+        except files.BlobError as e:
+            self.reply(conn, f"{e} Usage: /get <file id>")
+            return
+        except OSError as e:
+            log.error('DOWNLOAD ERROR', f"Could not open {argument}: {e}")
+            self.reply(conn, "That file cannot be read right now.")
+            return
+        transfer = next(self._downloads) % 2**32
+        conn.outbox.put(protocol.download_frame(transfer, digest, size, files.DOWNLOAD_WINDOW))
+        conn.outbox.put_file(outbound.FileSend(transfer, f, size, files.DOWNLOAD_WINDOW, files.CHUNK_SIZE))
+
+    def cmd_help(self, conn, argument):
+        self.reply(conn, "Commands: /join <room>, /leave, /rooms, /who [room], /msg <name> <message>, "
+                         "/dms [name], /older [count], /send <file>, /get <file id>, "
+                         "/search <words> [in:<room>] [from:<name>] [since:<time>], /help")
+
+    def _move(self, conn, room):
+        old = self.rooms.move(conn, room)
+        if old == room:
+            self.reply(conn, f"You are already in #{room}.")
+            return
+        self.broadcast(protocol.Outgoing.system(f"[SERVER] {conn.name} has left #{old}."), conn, old)
+        self.broadcast(protocol.Outgoing.system(f"[SERVER] {conn.name} has joined #{room}."), conn, room)
+        self.reply(conn, f"You are now in #{room} ({self.rooms.size(room)} members).")
+        self.replay_recent(conn, room)
@@ -0,0 +1,220 @@
+# log.py
+# Structured, non-blocking logging. Call sites hand over a tag, a template
+# and its fields; a background thread does the formatting and writes whole
+# batches to stdout, so a chat message never waits on a terminal or a
+# container log pipe.
+#
+#   log.info('NEW CONNECTION', "{name} ({ip}:{port}) connected.", name=..., ip=..., port=...)
+#
+# prints "[NEW CONNECTION] alice (10.0.0.2:50412) connected." (LOG_FORMAT=text)
+# or one JSON object per line (LOG_FORMAT=json).
+#
+# The buffer is bounded: when the writer falls behind, new records are
+# dropped and counted rather than blocking the caller. High-volume tags can
+# be sampled with LOG_SAMPLE, e.g. "broadcast=100" keeps one in a hundred.
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import metrics
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
+# 'async' formats and writes on the background thread; 'sync' writes inline
+# like print() did, which is handy when debugging a crash.
+ASYNC = 'async'
+SYNC = 'sync'
+LOG_MODES = (ASYNC, SYNC)
+LOG_FORMATS = ('text', 'json')
+
+# --- Configuration ---
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'info').lower()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_MODE = os.environ.get('LOG_MODE', ASYNC)
+LOG_BUFFER = int(os.environ.get('LOG_BUFFER', '10000'))
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', '0.1'))
+# tag=N pairs: keep one record in N for that tag. Tags match case-insensitively
+# with '_' standing for a space, so "new_connection=10" samples [NEW CONNECTION].
+LOG_SAMPLE = os.environ.get('LOG_SAMPLE', 'broadcast=100,not_saved=100,refused=100')
+if LOG_LEVEL not in LEVELS:
+    raise ValueError(f"LOG_LEVEL must be one of {tuple(LEVELS)}, got {LOG_LEVEL!r}")
+if LOG_MODE not in LOG_MODES:
+    raise ValueError(f"LOG_MODE must be one of {LOG_MODES}, got {LOG_MODE!r}")
+if LOG_FORMAT not in LOG_FORMATS:
+    raise ValueError(f"LOG_FORMAT must be one of {LOG_FORMATS}, got {LOG_FORMAT!r}")
+
+
+def parse_sampling(text):
+    """'broadcast=100,new_connection=10' -> {'BROADCAST': 100, 'NEW CONNECTION': 10}"""
+    sampling = {}
+    for item in text.split(','):
+        key, _, every = item.strip().partition('=')
+        if not key:
+            continue
+        if not every.isdigit() or int(every) < 1:
+            raise ValueError(f"LOG_SAMPLE entries must look like tag=N, got {item.strip()!r}")
+        sampling[key.strip().upper().replace('_', ' ').replace('-', ' ')] = int(every)
+    return sampling
+
+
+class Logger:
+    """Level filter, sampler and bounded queue in front of one writer thread."""
+
+    def __init__(self, level=INFO, fmt='text', mode=ASYNC, buffer_size=LOG_BUFFER,
+                 flush_interval=LOG_FLUSH_INTERVAL, sampling=None, stream=None):
+        self.level = level
+        self.format = fmt
+        self.mode = mode
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.sampling = sampling or {}
+        # None means whatever sys.stdout is at write time.
+        self.stream = stream
+        self._queue = deque()
+        self._seen = {}
+        self._wake = threading.Event()
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self._reported_drops = 0
+
+    def log(self, level, tag, template, fields):
+        if level < self.level:
+            return
+        every = self.sampling.get(tag)
+        if every is not None:
+            seen = self._seen[tag] = self._seen.get(tag, 0) + 1
+            if seen % every:
+                self.sampled_out += 1
+                return
+        record = (time.time(), level, tag, template, fields)
+        if self.mode == SYNC:
+            self._write([record])
+            return
+        if len(self._queue) >= self.buffer_size:
+            self.dropped += 1
+            metrics.LOG_DROPPED.inc()
+            return
+        self._queue.append(record)
+        if self._thread is None:
+            self._start()
+        if level >= ERROR:
+            # Errors go out now rather than at the next tick.
+            self._wake.set()
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Writes everything queued so far; safe from any thread."""
+        with self._write_lock:
+            records = []
+            while True:
+                try:
+                    records.append(self._queue.popleft())
+                except IndexError:
+                    break
+            if records or self.dropped != self._reported_drops:
+                self._emit(records)
+
+    def _write(self, records):
+        with self._write_lock:
+            self._emit(records)
+
+    def _emit(self, records):
+        # Called with _write_lock held, so batches never interleave.
+        lines = [self._format(record) for record in records]
+        dropped = self.dropped - self._reported_drops
+        if dropped:
+            self._reported_drops += dropped
+            lines.append(self._format((time.time(), WARNING, 'LOG',
+                                       "Dropped {count} log records; the writer fell behind.",
+                                       {'count': dropped})))
+        stream = self.stream or sys.stdout
+        try:
+            stream.write(''.join(lines))
+            stream.flush()
+        except (OSError, ValueError):
+            # A closed or broken stdout must not take the server down.
+            return
+        self.written += len(records)
+
+    def _format(self, record):
+        ts, level, tag, template, fields = record
+        try:
+            message = template.format(**fields) if fields else template
+        except (KeyError, IndexError, ValueError) as e:
+            message = f"{template} (bad log template: {e!r})"
+        if self.format == 'json':
+            entry = {'ts': datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec='milliseconds'),
+                     'level': LEVEL_NAMES.get(level, str(level)), 'event': tag, 'msg': message}
+            entry.update(fields)
+            return json.dumps(entry, ensure_ascii=False, default=str) + '\n'
+        return f"[{tag}] {message}\n"
+
+    def queue_depth(self):
+        return len(self._queue)
+
+    def stats(self):
+        return {
+            'queued': len(self._queue),
+            'written': self.written,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+        }
+
+    def _after_fork(self):
+        # The parent writes what it had queued; the child starts empty and
+        # gets its own writer thread on its first record.
+        self._queue = deque()
+        self._wake = threading.Event()
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._reported_drops = self.dropped
+
+
+LOGGER = Logger(LEVELS[LOG_LEVEL], LOG_FORMAT, LOG_MODE, LOG_BUFFER, LOG_FLUSH_INTERVAL,
+                parse_sampling(LOG_SAMPLE))
+os.register_at_fork(after_in_child=lambda: LOGGER._after_fork())
+atexit.register(lambda: LOGGER.flush())
+
+
+def debug(tag, template, **fields):
+    LOGGER.log(DEBUG, tag, template, fields)
+
+
+def info(tag, template, **fields):
+    LOGGER.log(INFO, tag, template, fields)
+
+
+def warning(tag, template, **fields):
+    LOGGER.log(WARNING, tag, template, fields)
+
+
+def error(tag, template, **fields):
+    LOGGER.log(ERROR, tag, template, fields)
+
+
+def flush():
+    LOGGER.flush()
@@ -0,0 +1,220 @@
+# metrics.py
+# In-process counters, gauges and latency histograms, served in Prometheus
+# text format on a small local HTTP endpoint (METRICS_PORT, /metrics), which
+# also answers the health probes (health.py).
+#
+# Recording is meant to stay on in production: a counter bump is one add and
+# a histogram observation one bisect over a short tuple. Updates take no
+# lock; in the threaded engine a thread switch between read and write can
+# very occasionally lose an increment, which monitoring tolerates, and the
+# asyncio engine never races at all. Gauges are callbacks evaluated only when
+# the endpoint is scraped, so queue depths and connection counts cost nothing
+# on the hot path. bench/bench_metrics.py measures the overhead.
+
+import bisect
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Configuration ---
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+# 0 disables the endpoint. Worker processes listen on METRICS_PORT + their index.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+
+# Checked at every instrumentation point; benchmarks flip it to compare.
+ENABLED = METRICS_ENABLED
+
+# Seconds; spans a queue append (microseconds) to a stalled database (seconds).
+LATENCY_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter:
+    """A value that only goes up."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Gauge:
+    """A value read from `fn()` at scrape time."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, fn):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+
+    def samples(self):
+        yield self.name, self.fn()
+
+
+class Histogram:
+    """Observation counts per upper bound, plus their sum and count."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.bounds = tuple(buckets)
+        # One slot per bound plus the +Inf overflow.
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.bounds, counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound:g}"}}', cumulative
+        cumulative += counts[-1]
+        yield f'{self.name}_bucket{{le="+Inf"}}', cumulative
+        yield f'{self.name}_sum', total
+        yield f'{self.name}_count', cumulative
+
+
+class Registry:
+    """Every metric this process exports, in registration order."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            # Re-registering a gauge (e.g. a new store after a restart) replaces it.
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(f"{name} {value}" for name, value in metric.samples())
+            except Exception as e:
+                # A broken gauge callback must not take the whole scrape down.
+                lines.append(f"# {metric.name} unavailable: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help_text):
+    return REGISTRY.register(Counter(name, help_text))
+
+
+def gauge(name, help_text, fn):
+    return REGISTRY.register(Gauge(name, help_text, fn))
+
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, help_text, buckets))
+
+
+# --- Hot-path metrics ---
+CONNECTIONS_ACCEPTED = counter('chat_connections_accepted_total', "TCP connections accepted.")
+MESSAGES_RECEIVED = counter('chat_messages_received_total', "Chat messages received from clients.")
+RECV_TO_BROADCAST = histogram('chat_recv_to_broadcast_seconds',
+                              "From reading a chat message off the socket to queueing it for every recipient.")
+RECIPIENT_SEND = histogram('chat_recipient_send_seconds',
+                           "Time to queue one message for one recipient, averaged over each broadcast.")
+SAVE_MESSAGE = histogram('chat_save_message_seconds', "Time save_message() holds up the receive path.")
+STORE_WRITE = histogram('chat_store_write_seconds', "Time of one batched write to the history store.")
+FRAMES_ENCODED = counter('chat_frames_encoded_total', "Outgoing messages encoded (once per wire format, not per recipient).")
+FRAMES_WRITTEN = counter('chat_frames_written_total', "Frames handed to client and peer sockets.")
+SOCKET_WRITES = counter('chat_socket_writes_total',
+                        "Socket writes: sendmsg() calls in the threaded engine, transport writes in asyncio.")
+BYTES_WRITTEN = counter('chat_bytes_written_total', "Bytes handed to client and peer sockets.")
+BYTES_COPIED = counter('chat_bytes_copied_total', "Bytes copied to join buffers on the way to a socket.")
+FRAMES_COMPRESSED = counter('chat_frames_compressed_total', "Outgoing messages compressed (once per codec).")
+BYTES_SAVED_BY_COMPRESSION = counter('chat_bytes_saved_by_compression_total',
+                                     "Payload bytes compression saved, counted once per message.")
+PINGS_SENT = counter('chat_pings_sent_total', "Heartbeat PINGs sent to quiet clients.")
+SESSIONS_EXPIRED = counter('chat_sessions_expired_total',
+                           "Connections dropped for missing HELLO, an unfinished frame or heartbeat silence.")
+CONNECTIONS_REFUSED_FULL = counter('chat_connections_refused_full_total',
+                                   "Connections refused because MAX_CONNECTIONS were already open.")
+CONNECTIONS_REFUSED_PER_IP = counter('chat_connections_refused_per_ip_total',
+                                     "Connections refused because their address had MAX_CONNECTIONS_PER_IP open.")
+MESSAGES_RATE_LIMITED = counter('chat_messages_rate_limited_total',
+                                "Chat messages dropped for exceeding the connection's or the address's message rate.")
+READS_THROTTLED = counter('chat_reads_throttled_total', "Times reading from a client paused for its byte rate.")
+READ_THROTTLED_SECONDS = counter('chat_read_throttled_seconds_total',
+                                 "Seconds reading from clients was paused for their byte rate.")
+FILE_BYTES_RECEIVED = counter('chat_file_bytes_received_total', "File upload bytes received in CHUNK frames.")
+FILE_BYTES_SENT = counter('chat_file_bytes_sent_total', "File download bytes sent with sendfile().")
+FILES_STORED = counter('chat_files_stored_total', "Uploads verified and added to the blob store.")
+LOG_DROPPED = counter('chat_log_dropped_total', "Log records dropped because the log writer fell behind.")
+
+
+# --- HTTP endpoint ---
+
+# path -> fn() returning (ok, fields): probes such as health.py's /healthz,
+# answered with 200 or 503 and the fields as JSON.
+ROUTES = {}
+
+
+def route(path, fn):
+    ROUTES[path] = fn
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            self._reply(200, REGISTRY.render().encode('utf-8'), CONTENT_TYPE)
+            return
+        probe = ROUTES.get(path)
+        if probe is None:
+            self.send_error(404)
+            return
+        ok, fields = probe()
+        self._reply(200 if ok else 503, json.dumps(fields).encode('utf-8'), 'application/json')
+
+    def _reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the chat log.
+        pass
+
+
+def serve_http(host=METRICS_HOST, port=METRICS_PORT):
+    """Serves /metrics and the ROUTES on a daemon thread; returns the HTTP server."""
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='metrics-http', daemon=True).start()
+    # Imported here: log.py records its drops in this module's counters.
+    import log
+    log.info('METRICS', "Serving Prometheus metrics on http://{host}:{port}/metrics",
+             host=host, port=httpd.server_address[1])
+    return httpd
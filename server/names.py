@@ -0,0 +1,61 @@
+# names.py
+# Who is online under which name. Names are unique per server process,
+# compared case-insensitively, so finding a user for /msg, checking a name
+# at HELLO and listing /who each cost a dict operation or one pass over the
+# names instead of a scan of every connection.
+#
+# Nothing reserves a name across supervisor workers or federated nodes, so
+# two processes may each have an "alice". /msg and /who therefore only
+# cover the sender's own process; direct messages are never relayed.
+
+import threading
+
+
+def name_key(name):
+    return name.casefold()
+
+
+class NameIndex:
+    """name -> session, kept consistent with the connection set under one lock."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def claim(self, member):
+        """Registers `member` under its name; False if someone else holds it."""
+        key = name_key(member.name)
+        with self._lock:
+            if key in self._sessions:
+                return False
+            self._sessions[key] = member
+            return True
+
+    def replace(self, holder, member):
+        """Hands `holder`'s name to `member`; False if `holder` no longer has it."""
+        key = name_key(member.name)
+        with self._lock:
+            if self._sessions.get(key) is not holder:
+                return False
+            self._sessions[key] = member
+            return True
+
+    def release(self, member):
+        """Forgets `member`'s name, unless another session has taken it since."""
+        key = name_key(member.name)
+        with self._lock:
+            if self._sessions.get(key) is member:
+                del self._sessions[key]
+
+    def get(self, name):
+        return self._sessions.get(name_key(name))
+
+    def names(self):
+        """Every online name, sorted case-insensitively."""
+        with self._lock:
+            names = [member.name for member in self._sessions.values()]
+        names.sort(key=name_key)
+        return names
+
+    def __len__(self):
+        return len(self._sessions)
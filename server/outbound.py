@@ -0,0 +1,447 @@
+# outbound.py
+# Per-client bounded send queues. Broadcasting only appends encoded frames
+# to each recipient's queue; a per-connection writer drains it, so a client
+# with a full TCP window only ever delays itself.
+#
+# Queue entries are bytes or tuples of buffers (see Outgoing.buffers()), all
+# shared between recipients. Writers gather whatever is pending into one
+# sendmsg() (threaded) or one transport write per event-loop tick (asyncio)
+# instead of joining it, so a burst of messages costs one syscall.
+#
+# File downloads (files.py) queue a FileSend next to the frames. The kernel
+# copies the file to the socket with sendfile(), one chunk at a time, and a
+# chunk is only started when no frame is waiting and the client has
+# acknowledged enough of the earlier ones: chat overtakes a download at every
+# chunk boundary, and never has more than the download window ahead of it.
+#
+# For a reload (handoff.py) an outbox is first `holding`, sending what is
+# queued but starting no download chunk, and then `frozen`, writing nothing
+# at all; snapshot() then gives what is left to the next process.
+
+import os
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+import metrics
+import protocol
+
+# --- Configuration ---
+OUTBOX_LIMIT = int(os.environ.get('OUTBOX_LIMIT', '1000'))
+# What to do when a client's queue is full:
+#   'drop-oldest' discards the oldest queued frame to make room.
+#   'disconnect'  drops the slow consumer entirely.
+DROP_OLDEST = 'drop-oldest'
+DISCONNECT = 'disconnect'
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT)
+OVERFLOW_POLICY = os.environ.get('OUTBOX_OVERFLOW', DROP_OLDEST)
+if OVERFLOW_POLICY not in OVERFLOW_POLICIES:
+    raise ValueError(f"OUTBOX_OVERFLOW must be one of {OVERFLOW_POLICIES}, got {OVERFLOW_POLICY!r}")
+# Writes are already coalesced, so Nagle's algorithm would only add delay.
+TCP_NODELAY = os.environ.get('TCP_NODELAY', '1') != '0'
+# Kernel keepalive probes after this many idle seconds (0 = off). They catch
+# half-open connections of clients that do not take part in heartbeats.
+TCP_KEEPALIVE_IDLE = int(os.environ.get('TCP_KEEPALIVE_IDLE', '60'))
+
+# Buffers per sendmsg() call; the kernel refuses more than IOV_MAX.
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+# Before 3.12, asyncio's writelines() joins its buffers into one bytes object.
+WRITELINES_COPIES = sys.version_info < (3, 12)
+# Holds a CHUNK header back until the file bytes behind it join it in one segment.
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+
+def tune_socket(sock):
+    """Applies the TCP options every client and peer connection gets."""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if TCP_NODELAY else 0)
+        if TCP_KEEPALIVE_IDLE:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                # Three probes ten seconds apart, then the connection is reset.
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPALIVE_IDLE)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+    except (OSError, AttributeError):
+        # Unix domain sockets have no TCP options.
+        pass
+
+
+def gather(entries):
+    """Flattens queue entries into one list of buffers."""
+    buffers = []
+    for entry in entries:
+        if type(entry) is tuple:
+            buffers.extend(entry)
+        else:
+            buffers.append(entry)
+    return buffers
+
+
+def send_buffers(sock, buffers, frames=None):
+    """Writes every buffer with sendmsg(), resuming after partial writes.
+
+    Nothing is joined: each call hands the kernel up to IOV_MAX buffers.
+    """
+    total = sum(len(b) for b in buffers)
+    start = 0
+    while start < len(buffers):
+        sent = sock.sendmsg(buffers[start:start + IOV_MAX])
+        metrics.SOCKET_WRITES.inc()
+        while sent:
+            size = len(buffers[start])
+            if sent >= size:
+                sent -= size
+                start += 1
+            else:
+                buffers[start] = memoryview(buffers[start])[sent:]
+                sent = 0
+    metrics.FRAMES_WRITTEN.inc(len(buffers) if frames is None else frames)
+    metrics.BYTES_WRITTEN.inc(total)
+
+
+class FileSend:
+    """One download in progress: what is left of an open file, sent as CHUNK frames."""
+
+    __slots__ = ('transfer', 'file', 'offset', 'remaining', 'acked', 'window', 'chunk_size')
+
+    def __init__(self, transfer, file, size, window, chunk_size):
+        self.transfer = transfer
+        self.file = file
+        self.offset = 0
+        self.remaining = size
+        # Bytes the client has acknowledged; at most `window` past that are sent.
+        self.acked = 0
+        self.window = window
+        self.chunk_size = chunk_size
+
+    @property
+    def ready(self):
+        """True if a chunk can go now: nothing left means one empty last call."""
+        return not self.remaining or self.offset - self.acked < self.window
+
+    def next_chunk(self):
+        """(CHUNK header, file offset, byte count) of the next chunk."""
+        count = min(self.chunk_size, self.remaining, self.acked + self.window - self.offset)
+        return protocol.chunk_header(self.transfer, count), self.offset, count
+
+    def advance(self, count):
+        self.offset += count
+        self.remaining -= count
+        metrics.FILE_BYTES_SENT.inc(count)
+
+
+def check_sent(sent, count):
+    # A short sendfile() means the file shrank; the CHUNK header already
+    # promised `count` bytes, so the stream cannot continue.
+    if sent != count:
+        raise OSError(f"sendfile() sent {sent} of {count} bytes")
+
+
+class Outbox:
+    """Bounded FIFO of encoded frames waiting to be written to one client,
+    and the downloads (FileSend) that go out whenever it is empty.
+
+    Not thread-safe on its own; the engine-specific subclasses below add the
+    locking or event-loop integration they need.
+    """
+
+    def __init__(self, limit=None, policy=None):
+        self.queue = deque()
+        self.files = deque()
+        self.limit = limit or OUTBOX_LIMIT
+        self.policy = policy or OVERFLOW_POLICY
+        self.dropped = 0
+        self.holding = False
+        self.frozen = False
+
+    def _push(self, data):
+        """Queues `data`; returns False if the client should be disconnected."""
+        if len(self.queue) >= self.limit:
+            if self.policy == DISCONNECT:
+                return False
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(data)
+        return True
+
+    def __len__(self):
+        return len(self.queue)
+
+    @property
+    def downloads(self):
+        return len(self.files)
+
+    def _next_file(self):
+        """The next download with a chunk to send, taking turns; None if all wait for credit."""
+        for _ in range(len(self.files)):
+            job = self.files[0]
+            self.files.rotate(-1)
+            if job.ready:
+                return job
+        return None
+
+    def _credit(self, transfer, received):
+        for job in self.files:
+            if job.transfer == transfer:
+                job.acked = max(job.acked, min(received, job.offset))
+                return True
+        return False
+
+    def snapshot(self):
+        """(queued frames as bytes, downloads in progress), leaving both in place."""
+        return b''.join(gather(self.queue)), list(self.files)
+
+    def _drop_files(self, keep=None):
+        for job in self.files:
+            if job is not keep:
+                job.file.close()
+        self.files.clear()
+
+
+class ThreadedOutbox(Outbox):
+    """Outbox drained by a dedicated writer thread (threaded engine)."""
+
+    def __init__(self, sock, limit=None, policy=None):
+        super().__init__(limit, policy)
+        self.sock = sock
+        lock = threading.Lock()
+        self._cond = threading.Condition(lock)
+        # Signalled after each write while holding, for hold().
+        self._idle = threading.Condition(lock)
+        self._writing = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, data):
+        with self._cond:
+            if self._closed:
+                return True
+            if not self._push(data):
+                # Report the overflow once; the reader thread tears down the rest.
+                self._closed = True
+                self.queue.clear()
+                self._cond.notify()
+                return False
+            self._cond.notify()
+        return True
+
+    def put_file(self, job):
+        """Queues a download behind whatever frames are waiting."""
+        with self._cond:
+            if self._closed:
+                job.file.close()
+                return
+            self.files.append(job)
+            self._cond.notify()
+
+    def credit(self, transfer, received):
+        """The client has `received` bytes of download `transfer`."""
+        with self._cond:
+            if self._credit(transfer, received):
+                self._cond.notify()
+
+    def hold(self, deadline):
+        """Lets the writer send what is queued until `deadline` (time.monotonic()),
+        then freezes it. False if it is still stuck in a write to a client
+        that stopped reading, or the connection is gone."""
+        with self._cond:
+            self.holding = True
+            self._idle.wait_for(lambda: self._closed or not self.queue and not self._writing,
+                                max(0.0, deadline - time.monotonic()))
+            self.frozen = True
+            return not self._writing and not self._closed
+
+    def release(self):
+        """Lets a held writer carry on (the handoff did not happen)."""
+        with self._cond:
+            self.holding = self.frozen = False
+            self._cond.notify()
+
+    def snapshot(self):
+        with self._cond:
+            return super().snapshot()
+
+    def _run(self):
+        while True:
+            job = None
+            with self._cond:
+                while (not self._closed and (self.frozen or not self.queue)
+                       and (self.holding or (job := self._next_file()) is None)):
+                    self._cond.wait()
+                if self.queue and not self.frozen:
+                    frames = len(self.queue)
+                    buffers = gather(self.queue)
+                    self.queue.clear()
+                elif job is None or self._closed:
+                    # Closed, or handed over to another process when frozen.
+                    self._drop_files()
+                    return
+                self._writing = True
+            try:
+                if job is None:
+                    send_buffers(self.sock, buffers, frames)
+                else:
+                    self._send_chunk(job)
+            except OSError:
+                with self._cond:
+                    self._closed = True
+                    self._writing = False
+                    self.queue.clear()
+                    self._drop_files()
+                    self._idle.notify_all()
+                return
+            with self._cond:
+                self._writing = False
+                if self.holding:
+                    self._idle.notify_all()
+
+    def _send_chunk(self, job):
+        header, offset, count = job.next_chunk()
+        if count:
+            self.sock.sendall(header, MSG_MORE)
+            check_sent(self.sock.sendfile(job.file, offset, count), count)
+            metrics.SOCKET_WRITES.inc(2)
+        job.advance(count)
+        if not job.remaining:
+            with self._cond:
+                self.files.remove(job)
+            job.file.close()
+
+    def close(self, timeout=1.0):
+        """Stops accepting frames and waits briefly for the queue to drain."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+
+class AsyncOutbox(Outbox):
+    """Outbox in front of an asyncio transport (asyncio engine).
+
+    Frames queued during one event-loop tick go out together in a single
+    transport write at the end of it. While the transport is paused at its
+    high-water mark they wait here, bounded.
+    """
+
+    def __init__(self, transport, loop, limit=None, policy=None):
+        super().__init__(limit, policy)
+        self.transport = transport
+        self.loop = loop
+        self.paused = False
+        self._scheduled = False
+        # The FileSend whose chunk is being sent; the transport refuses writes meanwhile.
+        self._sending = None
+
+    def put(self, data):
+        if not self._push(data):
+            return False
+        if not self.paused and not self._scheduled:
+            self._scheduled = True
+            self.loop.call_soon(self.flush)
+        return True
+
+    def put_file(self, job):
+        """Queues a download behind whatever frames are waiting."""
+        if self.transport.is_closing():
+            job.file.close()
+            return
+        self.files.append(job)
+        if not self.paused and not self._scheduled:
+            self._scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        """Writes everything queued now; also runs once per tick after put().
+
+        With no frame left and the transport not backed up, starts the next
+        download chunk.
+        """
+        self._scheduled = False
+        if self.paused or self.frozen or self._sending is not None or self.transport.is_closing():
+            return
+        if self.queue:
+            self._write_queue()
+        if self.files and not self.paused and not self.holding:
+            job = self._next_file()
+            if job is not None:
+                self._sending = job
+                self.loop.create_task(self._send_chunk(job))
+
+    def credit(self, transfer, received):
+        """The client has `received` bytes of download `transfer`."""
+        if self._credit(transfer, received) and not self._scheduled:
+            self._scheduled = True
+            self.loop.call_soon(self.flush)
+
+    async def _send_chunk(self, job):
+        header, offset, count = job.next_chunk()
+        try:
+            if count:
+                self.transport.write(header)
+                # Pauses reading, waits for the write buffer to empty, then
+                # hands the socket to sendfile() for this chunk.
+                check_sent(await self.loop.sendfile(self.transport, job.file, offset, count), count)
+                metrics.SOCKET_WRITES.inc(2)
+        except (OSError, RuntimeError):
+            self._sending = None
+            job.file.close()
+            self.transport.abort()
+            return
+        self._sending = None
+        job.advance(count)
+        if not job.remaining or self.transport.is_closing():
+            if job in self.files:
+                self.files.remove(job)
+            job.file.close()
+        # Frames queued during the chunk go first.
+        self.flush()
+
+    def _write_queue(self):
+        frames = len(self.queue)
+        buffers = gather(self.queue)
+        self.queue.clear()
+        size = sum(len(b) for b in buffers)
+        # write() may pause the transport; later frames then wait in the queue.
+        if len(buffers) == 1:
+            self.transport.write(buffers[0])
+        else:
+            self.transport.writelines(buffers)
+            if WRITELINES_COPIES:
+                metrics.BYTES_COPIED.inc(size)
+        metrics.SOCKET_WRITES.inc()
+        metrics.FRAMES_WRITTEN.inc(frames)
+        metrics.BYTES_WRITTEN.inc(size)
+
+    @property
+    def drained(self):
+        """True if nothing is queued or mid-write here or in the transport (for a handoff)."""
+        return not self.queue and self._sending is None and not self.transport.get_write_buffer_size()
+
+    def release(self):
+        """Lets a held outbox carry on (the handoff did not happen)."""
+        self.holding = self.frozen = False
+        self.flush()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self.flush()
+
+    def close(self):
+        """Closes the files of unfinished downloads; call when the connection is lost."""
+        self._drop_files(keep=self._sending)
+
+
+def shutdown_socket(sock):
+    """Wakes a thread blocked in recv() on `sock` so it can clean up."""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
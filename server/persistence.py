@@ -0,0 +1,298 @@
+# persistence.py
+# Write-behind pipeline for chat history. save_message() only queues the
+# document; a background thread flushes batches to the history store (see
+# storage.py), so the receive path never waits on a database round trip.
+#
+# If the database rejects a batch it is appended to a local journal instead
+# of being dropped, and the journal is replayed once the database is back.
+# The same happens from startup until the store is attached, so the server
+# can take chat before the database answers.
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import log
+import metrics
+import storage
+
+# --- Configuration ---
+BATCH_SIZE = int(os.environ.get('PERSIST_BATCH_SIZE', '500'))
+FLUSH_INTERVAL = float(os.environ.get('PERSIST_FLUSH_INTERVAL', '0.2'))
+QUEUE_LIMIT = int(os.environ.get('PERSIST_QUEUE_LIMIT', '100000'))
+JOURNAL_PATH = os.environ.get('PERSIST_JOURNAL', 'chat_journal.jsonl')
+REPLAY_INTERVAL = float(os.environ.get('PERSIST_REPLAY_INTERVAL', '5'))
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'$date': storage.to_epoch(value)}
+    raise TypeError(f"Cannot journal {type(value).__name__}")
+
+
+def _decode_object(obj):
+    if len(obj) == 1 and '$date' in obj:
+        return storage.from_epoch(obj['$date'])
+    return obj
+
+
+class Journal:
+    """Append-only JSON-lines spill file for documents the database did not take."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, documents):
+        lines = ''.join(json.dumps(doc, default=_encode_value) + '\n' for doc in documents)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def has_entries(self):
+        return os.path.exists(self.path) and os.path.getsize(self.path) > 0
+
+    def replay(self, insert, batch_size):
+        """Feeds journaled documents to `insert` in batches; returns how many.
+
+        The journal is moved aside first so new spills keep appending while the
+        old ones replay. If `insert` raises, the moved-aside file is kept and
+        the next replay starts over from it; documents carry their _id, so the
+        ones that did get through are not stored twice.
+        """
+        replaying = self.path + '.replaying'
+        replayed = 0
+        while True:
+            with self._lock:
+                if not os.path.exists(replaying):
+                    if not self.has_entries():
+                        return replayed
+                    os.replace(self.path, replaying)
+            with open(replaying, encoding='utf-8') as f:
+                batch = []
+                for line in f:
+                    try:
+                        batch.append(json.loads(line, object_hook=_decode_object))
+                    except ValueError:
+                        # A torn final line from a crash mid-append.
+                        continue
+                    if len(batch) >= batch_size:
+                        insert(batch)
+                        replayed += len(batch)
+                        batch = []
+                if batch:
+                    insert(batch)
+                    replayed += len(batch)
+            os.remove(replaying)
+
+
+class WriteBehind:
+    """Buffers chat documents and writes them to `store` in batches."""
+
+    def __init__(self, store, journal_path=JOURNAL_PATH, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, queue_limit=QUEUE_LIMIT, on_batch=None):
+        self.store = store
+        # Called on the flusher thread with every batch once it is stored or
+        # journaled (e.g. search.SearchIndex.add); journal replays are not
+        # passed again.
+        self.on_batch = on_batch
+        self.journal = Journal(journal_path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_limit = queue_limit
+
+        self._queue = deque()
+        lock = threading.Lock()
+        self._cond = threading.Condition(lock)
+        # Signalled whenever a batch is done, for flush().
+        self._idle = threading.Condition(lock)
+        self._flushing = False
+        self._flush_waiters = 0
+        self._closing = False
+        # Without a store yet, everything is journaled until attach().
+        self._degraded = store is None
+        self._next_replay = 0.0
+        # Documents submit() spilled to the journal, for the flusher to pass to on_batch.
+        self._spilled_docs = []
+
+        # Backpressure and health counters, read with stats().
+        self.enqueued = 0
+        self.inserted = 0
+        self.batches = 0
+        self.journaled = 0
+        self.replayed = 0
+        self.spilled = 0
+        self.failures = 0
+        self.max_queue_depth = 0
+        self.last_flush_ms = 0.0
+        self.last_error = None
+
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def submit(self, document):
+        """Queues one document; never blocks on the database."""
+        # The _id is assigned up front so a batch retried from the journal
+        # cannot be inserted twice.
+        document.setdefault('_id', storage.new_message_id())
+        with self._cond:
+            if len(self._queue) < self.queue_limit:
+                self._queue.append(document)
+                self.enqueued += 1
+                depth = len(self._queue)
+                if depth > self.max_queue_depth:
+                    self.max_queue_depth = depth
+                if depth >= self.batch_size:
+                    self._cond.notify()
+                return
+            self.spilled += 1
+        # The queue is full (the database is far behind): spill to disk
+        # rather than holding an unbounded backlog in memory.
+        self.journal.append([document])
+        if self.on_batch is not None:
+            with self._cond:
+                self._spilled_docs.append(document)
+
+    def attach(self, store):
+        """Starts writing to `store`, replaying what was journaled while there was none.
+
+        The replay runs on the caller's thread, so when this returns the
+        store holds what earlier runs left in the journal and anything
+        reading it from then on (search backfill, recent history) sees it.
+        Messages journaled meanwhile follow from the flusher.
+        """
+        try:
+            replayed = self.journal.replay(store.insert_many, self.batch_size)
+        except Exception as e:
+            # The flusher keeps retrying once the store is attached.
+            self.failures += 1
+            self.last_error = str(e)
+            log.error('DATABASE ERROR', f"Could not replay the journal: {e}")
+        else:
+            if replayed:
+                log.info('DATABASE', f"Replayed {replayed} journaled messages.")
+            self.replayed += replayed
+        with self._cond:
+            self.store = store
+            self._next_replay = 0.0
+            self._cond.notify()
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._queue)
+
+    def stats(self):
+        with self._cond:
+            depth = len(self._queue)
+        return {
+            'queue_depth': depth,
+            'max_queue_depth': self.max_queue_depth,
+            'enqueued': self.enqueued,
+            'inserted': self.inserted,
+            'batches': self.batches,
+            'journaled': self.journaled,
+            'replayed': self.replayed,
+            'spilled': self.spilled,
+            'failures': self.failures,
+            'last_flush_ms': round(self.last_flush_ms, 3),
+            'degraded': self._degraded,
+        }
+
+    def flush(self, timeout=10.0):
+        """Writes out everything queued so far without stopping; False if that took over `timeout`."""
+        with self._cond:
+            self._flush_waiters += 1
+            self._cond.notify()
+            try:
+                return self._idle.wait_for(lambda: not self._queue and not self._flushing, timeout)
+            finally:
+                self._flush_waiters -= 1
+
+    def close(self, timeout=10.0):
+        """Flushes everything still queued, then stops the flusher thread."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    # --- Flusher thread ---
+
+    def _run(self):
+        self._try_replay()
+        while True:
+            with self._cond:
+                self._flushing = False
+                if self._flush_waiters:
+                    self._idle.notify_all()
+                if not self._closing and not (self._flush_waiters and self._queue) and len(self._queue) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                closing = self._closing
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                self._flushing = bool(batch)
+                spilled, self._spilled_docs = self._spilled_docs, []
+            if spilled:
+                self.on_batch(spilled)
+            if batch:
+                self._flush(batch)
+            elif closing:
+                return
+            if self._degraded and not closing and time.monotonic() >= self._next_replay:
+                self._try_replay()
+
+    def _insert(self, documents):
+        if self.store is None:
+            raise ConnectionError("Not connected to the database.")
+        self.store.insert_many(documents)
+
+    def _flush(self, batch):
+        if self._degraded:
+            self._spill(batch)
+        else:
+            self._store_batch(batch)
+        # Only once the batch is safely somewhere.
+        if self.on_batch is not None:
+            self.on_batch(batch)
+
+    def _store_batch(self, batch):
+        start = time.perf_counter()
+        try:
+            self._insert(batch)
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            log.error('DATABASE ERROR', f"Could not save {len(batch)} messages, journaling them: {e}")
+            self._degraded = True
+            self._next_replay = time.monotonic() + REPLAY_INTERVAL
+            self._spill(batch)
+            return
+        elapsed = time.perf_counter() - start
+        self.last_flush_ms = elapsed * 1e3
+        if metrics.ENABLED:
+            metrics.STORE_WRITE.observe(elapsed)
+        self.inserted += len(batch)
+        self.batches += 1
+
+    def _spill(self, batch):
+        self.journal.append(batch)
+        self.journaled += len(batch)
+
+    def _try_replay(self):
+        if self.store is None:
+            self._next_replay = time.monotonic() + REPLAY_INTERVAL
+            return
+        try:
+            replayed = self.journal.replay(self._insert, self.batch_size)
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            self._degraded = True
+            self._next_replay = time.monotonic() + REPLAY_INTERVAL
+            return
+        if replayed:
+            log.info('DATABASE', f"Replayed {replayed} journaled messages.")
+        self.replayed += replayed
+        self._degraded = False
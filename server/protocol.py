@@ -0,0 +1,553 @@
+# protocol.py
+# Length-prefixed wire protocol shared by the server engines.
+#
+# Every frame is a 6 byte header followed by the payload:
+#
+#   version (1 byte) | type (1 byte) | payload length (4 bytes, big endian)
+#
+# The low 7 bits of the type byte carry the frame type; the high bit flags a
+# payload compressed with the codec negotiated in HELLO/WELCOME (see
+# compressors.py). Clients that predate framing send their name
+# as raw UTF-8 text, which never starts with the version byte, so the server
+# can tell the two apart from the first byte it receives and fall back to the
+# old one-recv-per-message behaviour for them.
+
+import codecs
+import json
+import struct
+from datetime import datetime, timezone
+
+import compressors
+import metrics
+
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!BBI')
+HEADER_SIZE = HEADER.size
+TYPE_MASK = 0x7F
+FLAG_COMPRESSED = 0x80
+MAX_PAYLOAD = 1 << 20
+
+# --- Frame types ---
+HELLO = 1      # client -> server, JSON: {"name", "version", optional "compression", "resume", "heartbeat"}
+WELCOME = 2    # server -> client, JSON: {"version", "compression", "heartbeat", "resume_token"}
+CHAT = 3       # client -> server, UTF-8 text
+MESSAGE = 4    # server -> client, JSON: {"id", "from", "text", "room", "ts"}, plus "to" for a direct message
+SYSTEM = 5     # server -> client, UTF-8 text (announcements)
+ERROR = 6      # server -> client, UTF-8 text, connection closes afterwards
+PING = 7       # either way, no payload; the receiver answers with a PONG
+PONG = 8       # either way, no payload
+REJECT = 9     # server -> client, JSON: {"reason", "retry_after"}, instead of WELCOME; connection closes
+# File transfer (files.py).
+UPLOAD = 10    # client -> server, JSON: {"transfer", "name", "size", "sha256"}, starts an upload
+CHUNK = 11     # either way, transfer id (4 bytes, big endian) then file bytes
+CREDIT = 12    # either way, JSON: {"transfer", "received", ...}, acknowledges CHUNKs; see credit_frame()
+DOWNLOAD = 13  # server -> client, JSON: {"transfer", "blob", "size", "window"}, CHUNKs of that transfer follow
+
+# Server <-> server frames, never sent to clients.
+RELAY = 16     # JSON: Outgoing.to_dict(), a room broadcast to repeat locally
+PEER = 17      # JSON: {"node", "nonce"}, first frame on a federation link
+AUTH = 18      # JSON: {"mac"}, answers the other end's PEER nonce (federation.py)
+
+# Per-connection receive buffers start small so idle clients stay cheap; a
+# buffer only grows while a frame larger than it is being received, and is
+# let go entirely whenever it has been parsed empty.
+DEFAULT_BUFFER_SIZE = 4096
+CHUNK_ID = struct.Struct('!I')
+
+
+class ProtocolError(Exception):
+    """The peer sent something that is not a valid frame."""
+
+
+def encode_frame(ftype, payload=b''):
+    return HEADER.pack(PROTOCOL_VERSION, ftype, len(payload)) + payload
+
+
+def frame_parts(ftype, payload=b''):
+    """(header, payload) of a frame, for writers that gather buffers instead of joining them."""
+    return HEADER.pack(PROTOCOL_VERSION, ftype, len(payload)), payload
+
+
+def json_payload(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def encode_json(ftype, obj):
+    return encode_frame(ftype, json_payload(obj))
+
+
+def decode_json(payload):
+    try:
+        return json.loads(str(payload, 'utf-8'))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ProtocolError(f"Malformed JSON payload: {e}") from None
+
+
+def is_framed(first_byte):
+    """True if a connection whose first byte is `first_byte` speaks the framed protocol."""
+    return first_byte == PROTOCOL_VERSION
+
+
+def is_unsupported_version(first_byte):
+    # Control characters never start a legacy name, so treat them as some
+    # other protocol version rather than as text.
+    return first_byte != PROTOCOL_VERSION and first_byte < 0x20
+
+
+class FrameDecoder:
+    """Incremental frame parser over a reusable receive buffer.
+
+    Data is received straight into the buffer (recv_into() for sockets,
+    get_buffer()/buffer_updated() for asyncio.BufferedProtocol) and frames are
+    parsed in place with memoryview slices, so one read can yield many frames
+    without copying. A payload view is only valid until the next call that
+    receives more data.
+    """
+
+    def __init__(self, size=DEFAULT_BUFFER_SIZE):
+        self._initial_size = size
+        # The negotiated compressors codec; compressed frames are refused without one.
+        self.codec = None
+        self._reset(size)
+
+    def _reset(self, size):
+        # None until the next read: an idle connection holds no buffer at all.
+        # (The asyncio engine only asks for one once data is waiting.)
+        self._buf = bytearray(size) if size else None
+        self._view = memoryview(self._buf) if size else None
+        self._start = 0
+        self._end = 0
+        self._needed = HEADER_SIZE
+
+    def __len__(self):
+        return self._end - self._start
+
+    def first_byte(self):
+        return self._buf[self._start] if self._end > self._start else None
+
+    def get_buffer(self, sizehint=-1):
+        """Returns a writable view of the free space, making room first if needed."""
+        if self._buf is None:
+            self._reset(max(self._initial_size, self._needed))
+        pending = self._end - self._start
+        if self._start and (self._end == len(self._buf) or pending == 0):
+            # Slide unparsed bytes to the front; same-size slice assignment is
+            # allowed while views are exported.
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._start, self._end = 0, pending
+        if self._needed > len(self._buf) or self._end == len(self._buf):
+            size = max(self._needed, len(self._buf) * 2)
+            old = self._view[self._start:self._end]
+            self._buf = bytearray(size)
+            self._buf[:pending] = old
+            self._view = memoryview(self._buf)
+            self._start, self._end = 0, pending
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+
+    def recv_into(self, sock):
+        nbytes = sock.recv_into(self.get_buffer())
+        self.buffer_updated(nbytes)
+        return nbytes
+
+    def feed(self, data):
+        data = memoryview(data)
+        while data:
+            buf = self.get_buffer()
+            n = min(len(buf), len(data))
+            buf[:n] = data[:n]
+            self.buffer_updated(n)
+            data = data[n:]
+
+    def pending(self):
+        """The buffered bytes not parsed yet, e.g. the start of a frame still arriving."""
+        return bytes(self._view[self._start:self._end]) if self._buf is not None else b''
+
+    def take_raw(self):
+        """Returns and consumes every buffered byte unparsed (legacy clients)."""
+        data = bytes(self._view[self._start:self._end])
+        self._reset(0)
+        return data
+
+    def next_frame(self):
+        """Returns (type, payload view) for the next complete frame, or None."""
+        available = self._end - self._start
+        if available < HEADER_SIZE:
+            self._needed = HEADER_SIZE
+            self._shrink_if_idle()
+            return None
+        version, ftype, length = HEADER.unpack_from(self._buf, self._start)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        if length > MAX_PAYLOAD:
+            raise ProtocolError(f"Frame of {length} bytes exceeds the {MAX_PAYLOAD} byte limit")
+        total = HEADER_SIZE + length
+        if available < total:
+            self._needed = total
+            return None
+        payload = self._view[self._start + HEADER_SIZE:self._start + total]
+        self._start += total
+        self._needed = HEADER_SIZE
+        if ftype & FLAG_COMPRESSED:
+            payload = self._decompress(payload)
+        return ftype & TYPE_MASK, payload
+
+    def _decompress(self, payload):
+        if self.codec is None:
+            raise ProtocolError("Compressed frame, but no compression was negotiated")
+        try:
+            return self.codec.decompress(payload, MAX_PAYLOAD)
+        except compressors.CompressionError as e:
+            raise ProtocolError(str(e)) from None
+
+    def frames(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def _shrink_if_idle(self):
+        # Give the buffer back once it is drained, including one that grew for a large frame.
+        if self._start == self._end and self._buf is not None:
+            self._reset(0)
+
+
+# --- Server -> client messages ---
+
+def _epoch(timestamp):
+    return round(timestamp.replace(tzinfo=timezone.utc).timestamp(), 6)
+
+
+def _from_epoch(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+
+
+class Outgoing:
+    """A server-to-client message, encoded at most once per wire format.
+
+    Broadcasting hands the same Outgoing to every recipient; framed and legacy
+    clients each take the encoding they understand. buffers() is what the
+    outboxes queue: the framed header and payload stay separate objects that
+    every recipient shares and the writers gather, so fanning a message out
+    copies nothing.
+    """
+
+    __slots__ = ('ftype', 'sender', 'text', 'room', 'message_id', 'timestamp', 'recipient', 'attachment',
+                 '_parts', '_compressed', '_framed', '_legacy')
+
+    def __init__(self, ftype, text, sender=None, room=None, message_id=None, timestamp=None, recipient=None,
+                 attachment=None):
+        self.ftype = ftype
+        self.sender = sender
+        self.text = text
+        self.room = room
+        self.message_id = message_id
+        # Naive UTC datetime, like the persisted documents.
+        self.timestamp = timestamp
+        # The addressee of a direct message; None for room messages.
+        self.recipient = recipient
+        # {"blob", "name", "size"} of a shared file; None for plain messages.
+        self.attachment = attachment
+        self._parts = None
+        # codec name -> parts; compressed once per message, not per recipient.
+        self._compressed = None
+        self._framed = None
+        self._legacy = None
+
+    @classmethod
+    def chat(cls, sender, text, room=None, message_id=None, timestamp=None, attachment=None):
+        return cls(MESSAGE, text, sender, room, message_id, timestamp, attachment=attachment)
+
+    @classmethod
+    def direct(cls, sender, recipient, text, message_id=None, timestamp=None):
+        return cls(MESSAGE, text, sender, None, message_id, timestamp, recipient)
+
+    @classmethod
+    def system(cls, text):
+        return cls(SYSTEM, text)
+
+    @classmethod
+    def error(cls, text):
+        return cls(ERROR, text)
+
+    def framed_parts(self):
+        if self._parts is None:
+            if self.ftype == MESSAGE:
+                fields = {
+                    'id': self.message_id,
+                    'from': self.sender,
+                    'text': self.text,
+                    'room': self.room,
+                    'ts': _epoch(self.timestamp) if self.timestamp else None,
+                }
+                if self.recipient is not None:
+                    fields['to'] = self.recipient
+                if self.attachment is not None:
+                    fields['file'] = self.attachment
+                payload = json_payload(fields)
+            else:
+                payload = self.text.encode('utf-8')
+            self._parts = frame_parts(self.ftype, payload)
+            metrics.FRAMES_ENCODED.inc()
+        return self._parts
+
+    def framed(self):
+        """The frame as one bytes object, for callers that need it contiguous."""
+        if self._framed is None:
+            self._framed = b''.join(self.framed_parts())
+        return self._framed
+
+    def legacy(self):
+        if self._legacy is None:
+            if self.ftype == MESSAGE and self.recipient is not None:
+                self._legacy = f"[{self.sender} -> {self.recipient}]: {self.text}".encode('utf-8')
+            elif self.ftype == MESSAGE:
+                self._legacy = f"[{self.sender}]: {self.text}".encode('utf-8')
+            else:
+                self._legacy = self.text.encode('utf-8')
+            metrics.FRAMES_ENCODED.inc()
+        return self._legacy
+
+    def encoded(self, framed):
+        return self.framed() if framed else self.legacy()
+
+    def buffers(self, framed, codec=None):
+        """The encoding as a tuple of buffers to queue on an outbox.
+
+        With a `codec`, payloads of COMPRESS_THRESHOLD bytes or more go out
+        compressed if that makes them smaller.
+        """
+        if not framed:
+            return (self.legacy(),)
+        parts = self.framed_parts()
+        if codec is None or len(parts[1]) < compressors.COMPRESS_THRESHOLD:
+            return parts
+        if self._compressed is None:
+            self._compressed = {}
+        compressed = self._compressed.get(codec.name)
+        if compressed is None:
+            compressed = self._compressed[codec.name] = self._compress(parts, codec)
+        return compressed
+
+    def _compress(self, parts, codec):
+        payload = parts[1]
+        data = codec.compress(payload)
+        if len(data) >= len(payload):
+            return parts
+        metrics.FRAMES_COMPRESSED.inc()
+        metrics.BYTES_SAVED_BY_COMPRESSION.inc(len(payload) - len(data))
+        return HEADER.pack(PROTOCOL_VERSION, self.ftype | FLAG_COMPRESSED, len(data)), data
+
+    def to_dict(self):
+        """Plain fields for relaying this message to another server process."""
+        return {
+            'type': self.ftype,
+            'text': self.text,
+            'from': self.sender,
+            'room': self.room,
+            'id': self.message_id,
+            'ts': _epoch(self.timestamp) if self.timestamp else None,
+            'to': self.recipient,
+            'file': self.attachment,
+        }
+
+    @classmethod
+    def from_dict(cls, fields):
+        ts = fields.get('ts')
+        return cls(fields['type'], fields['text'], fields.get('from'), fields.get('room'),
+                   fields.get('id'), _from_epoch(ts) if ts is not None else None, fields.get('to'),
+                   fields.get('file'))
+
+
+PING_FRAME = encode_frame(PING)
+PONG_FRAME = encode_frame(PONG)
+
+
+def welcome_frame(compression=None, heartbeat=None, token=None):
+    """WELCOME, naming the negotiated codec (null when frames stay uncompressed),
+    for heartbeat clients the seconds of silence after which to expect a PING,
+    and the token a reconnect sends back in "resume" to reclaim the name."""
+    return encode_json(WELCOME, {'version': PROTOCOL_VERSION, 'compression': compression,
+                                 'heartbeat': heartbeat, 'resume_token': token})
+
+
+def reject_frame(reason, retry_after):
+    """REJECT: the connection was not admitted; try again after `retry_after` seconds."""
+    return encode_json(REJECT, {'reason': reason, 'retry_after': retry_after})
+
+
+def credit_frame(transfer, received, **fields):
+    """CREDIT: `received` bytes of upload `transfer` are in. The first one also
+    carries "window", the last "blob" (the stored file's id), a failed upload "error"."""
+    return encode_json(CREDIT, dict(fields, transfer=transfer, received=received))
+
+
+def download_frame(transfer, blob, size, window):
+    """DOWNLOAD: the client acknowledges the CHUNKs that follow with CREDITs and
+    the server never has more than `window` unacknowledged bytes out."""
+    return encode_json(DOWNLOAD, {'transfer': transfer, 'blob': blob, 'size': size, 'window': window})
+
+
+def chunk_header(transfer, count):
+    """Frame header and transfer id of a CHUNK carrying `count` file bytes, which follow it."""
+    return HEADER.pack(PROTOCOL_VERSION, CHUNK, CHUNK_ID.size + count) + CHUNK_ID.pack(transfer)
+
+
+def parse_upload(payload):
+    """Validates an UPLOAD payload; the file name is reduced to its last path component."""
+    upload = decode_json(payload)
+    if not isinstance(upload, dict):
+        raise ProtocolError("UPLOAD payload must be a JSON object")
+    transfer, size, digest = upload.get('transfer'), upload.get('size'), upload.get('sha256')
+    name = upload.get('name')
+    if not isinstance(transfer, int) or not 0 <= transfer < 2**32:
+        raise ProtocolError("UPLOAD must carry a transfer id between 0 and 2**32-1")
+    if not isinstance(size, int) or size < 0:
+        raise ProtocolError("UPLOAD must carry a non-negative size")
+    if not isinstance(digest, str):
+        raise ProtocolError("UPLOAD must carry a sha256 digest")
+    name = name.replace('\\', '/').rpartition('/')[2].strip() if isinstance(name, str) else ''
+    if name in ('.', '..'):
+        name = ''
+    return {'transfer': transfer, 'name': name[:255] or 'file', 'size': size, 'sha256': digest.lower()}
+
+
+def parse_credit(payload):
+    """(transfer id, bytes received) of a client's CREDIT for a download."""
+    credit = decode_json(payload)
+    transfer = credit.get('transfer') if isinstance(credit, dict) else None
+    received = credit.get('received') if isinstance(credit, dict) else None
+    if not isinstance(transfer, int) or not isinstance(received, int):
+        raise ProtocolError("CREDIT must carry integer transfer and received fields")
+    return transfer, received
+
+
+def parse_chunk(payload):
+    """(transfer id, file bytes view) of a CHUNK payload."""
+    if len(payload) < CHUNK_ID.size:
+        raise ProtocolError("CHUNK too short for its transfer id")
+    return CHUNK_ID.unpack_from(payload)[0], payload[CHUNK_ID.size:]
+
+
+def parse_hello(payload):
+    """Validates a HELLO payload; returns its fields with the name stripped."""
+    hello = decode_json(payload)
+    if not isinstance(hello, dict):
+        raise ProtocolError("HELLO payload must be a JSON object")
+    name = hello.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ProtocolError("HELLO must carry a non-empty name")
+    hello['name'] = name.strip()
+    return hello
+
+
+def parse_resume(value):
+    """HELLO's optional "resume": {"room": ..., "after": <last message id seen>,
+    "token": <resume_token from the last WELCOME>}.
+
+    A reconnecting client sends it to return to its room and be replayed only
+    what it missed. Returns {'room', 'after', 'token'} (any may be None), or None.
+    """
+    if not isinstance(value, dict):
+        return None
+    room, after, token = value.get('room'), value.get('after'), value.get('token')
+    return {'room': room if isinstance(room, str) else None,
+            'after': after if isinstance(after, str) else None,
+            'token': token if isinstance(token, str) else None}
+
+
+class ClientReader:
+    """Server-side parser for everything one client sends, independent of I/O.
+
+    The engine receives into `decoder` and then drains events(), which yields
+    (HELLO, name) once, then (CHAT, text) for every message, (PING, None)
+    for every PING, (UPLOAD, fields) and (CHUNK, (transfer, view)) for file
+    uploads and (CREDIT, (transfer, received)) for downloads; a CHUNK's view
+    is only valid until the next read. Whether
+    the client is framed or legacy is settled by the first byte it sends; the
+    codec, if any, by the HELLO (`compression` is the negotiated name), as are
+    `resume` (see parse_resume) and `heartbeat`.
+    """
+
+    def __init__(self):
+        self.decoder = FrameDecoder()
+        self.framed = None
+        self.name = None
+        self.compression = None
+        self.resume = None
+        self.heartbeat = False
+        # Legacy clients send bare UTF-8 with no boundaries, so a multibyte
+        # character split across two reads must be carried over.
+        self._text = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def export(self):
+        """What the reader has negotiated, as plain fields (for handoff.py); the
+        unparsed input is decoder.pending()."""
+        return {'framed': self.framed, 'name': self.name, 'compression': self.compression,
+                'heartbeat': self.heartbeat, 'text': self._text.getstate()[0].hex()}
+
+    @classmethod
+    def restore(cls, fields, pending=b''):
+        """A reader that carries on where an exported one stopped."""
+        reader = cls()
+        reader.framed = fields['framed']
+        reader.name = fields['name']
+        reader.compression = fields['compression']
+        reader.decoder.codec = compressors.get(reader.compression)
+        reader.heartbeat = fields['heartbeat']
+        reader._text.setstate((bytes.fromhex(fields['text']), 0))
+        if pending:
+            reader.decoder.feed(pending)
+        return reader
+
+    def events(self):
+        if self.framed is None:
+            first = self.decoder.first_byte()
+            if first is None:
+                return
+            if is_unsupported_version(first):
+                raise ProtocolError(f"Unsupported protocol version {first}")
+            self.framed = is_framed(first)
+        if self.framed:
+            yield from self._framed_events()
+        else:
+            yield from self._legacy_events()
+
+    def _framed_events(self):
+        for ftype, payload in self.decoder.frames():
+            if self.name is None:
+                if ftype != HELLO:
+                    raise ProtocolError("Expected HELLO as the first frame")
+                hello = parse_hello(payload)
+                self.name = hello['name']
+                self.compression = compressors.negotiate(hello.get('compression'))
+                self.decoder.codec = compressors.get(self.compression)
+                self.resume = parse_resume(hello.get('resume'))
+                self.heartbeat = hello.get('heartbeat') is True
+                yield HELLO, self.name
+            elif ftype == CHAT:
+                yield CHAT, str(payload, 'utf-8', 'replace')
+            elif ftype == PING:
+                yield PING, None
+            elif ftype == CHUNK:
+                yield CHUNK, parse_chunk(payload)
+            elif ftype == UPLOAD:
+                yield UPLOAD, parse_upload(payload)
+            elif ftype == CREDIT:
+                yield CREDIT, parse_credit(payload)
+            # Unknown frame types are ignored so newer clients can add some.
+
+    def _legacy_events(self):
+        data = self.decoder.take_raw()
+        if self.name is None:
+            self.name = data.decode('utf-8', 'replace').strip()
+            if not self.name:
+                raise ProtocolError("Client did not provide a name.")
+            yield HELLO, self.name
+            return
+        text = self._text.decode(data)
+        if text:
+            yield CHAT, text
@@ -0,0 +1,75 @@
+# rooms.py
+# Room membership index. Every connected client is in exactly one room, and
+# each room keeps its own member set, so a broadcast costs O(members of the
+# room) instead of O(everyone connected). Members carry their current room
+# in a `room` attribute (session.Session), so no second map is kept.
+
+import re
+import threading
+
+DEFAULT_ROOM = 'lobby'
+# Stored and relayed as the room of direct messages; never a valid room name,
+# so room history and broadcasts cannot include them.
+DIRECT = '@direct'
+ROOM_NAME = re.compile(r'^[a-z0-9][a-z0-9_-]{0,31}$')
+
+
+def normalize_room(name):
+    """Returns the canonical room name, or None if `name` is not a valid one."""
+    name = name.strip().lstrip('#').lower()
+    return name if ROOM_NAME.match(name) else None
+
+
+class RoomIndex:
+    """room -> members and member.room, kept consistent under one lock."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._members = {DEFAULT_ROOM: set()}
+
+    def add(self, member, room=DEFAULT_ROOM):
+        with self._lock:
+            member.room = room
+            self._members.setdefault(room, set()).add(member)
+
+    def move(self, member, room):
+        """Moves `member` to `room`; returns the room it left."""
+        with self._lock:
+            old = member.room
+            if old is not None:
+                self._discard(member, old)
+            member.room = room
+            self._members.setdefault(room, set()).add(member)
+            return old
+
+    def remove(self, member):
+        """Forgets `member`; returns the room it was in, or None."""
+        with self._lock:
+            room, member.room = member.room, None
+            if room is not None:
+                self._discard(member, room)
+            return room
+
+    def _discard(self, member, room):
+        members = self._members[room]
+        members.discard(member)
+        if not members and room != DEFAULT_ROOM:
+            del self._members[room]
+
+    def room_of(self, member):
+        return member.room
+
+    def members(self, room):
+        """A snapshot of the room's members, safe to iterate without the lock."""
+        with self._lock:
+            return list(self._members.get(room, ()))
+
+    def size(self, room):
+        return len(self._members.get(room, ()))
+
+    def listing(self):
+        """[(room, member count)] for every room, largest first."""
+        with self._lock:
+            rooms = [(room, len(members)) for room, members in self._members.items()]
+        rooms.sort(key=lambda item: (-item[1], item[0]))
+        return rooms
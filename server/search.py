@@ -0,0 +1,696 @@
+# search.py
+# Full-text search over chat history: an inverted index kept next to the
+# history store and fed by the write-behind stage (persistence.py), so every
+# message is searchable a moment after it is persisted.
+#
+# New messages are tokenized into an in-memory segment. Once it holds
+# SEARCH_SEGMENT_DOCS messages, or SEARCH_FLUSH_INTERVAL seconds have passed,
+# it is written out as an immutable segment file; whenever the newest
+# SEARCH_MERGE_FACTOR segments are of a size, they are merged into one, so
+# a query only ever opens a logarithmic number of segments. A manifest names
+# the live ones and is replaced atomically after each flush or merge.
+#
+# Messages are numbered in the order they are indexed, and each segment
+# covers a contiguous range of those numbers. Postings are stored as sorted
+# arrays of the global numbers, which has two consequences: merging is plain
+# concatenation, and a query walks the rarest term's postings newest first,
+# bisecting the others. Segment files are mmapped and read through
+# memoryviews, so opening one does not load its dictionary. Room and sender
+# are indexed as the terms '#room' and '@sender', which the word tokenizer
+# never produces, so those filters narrow the postings like any other term.
+#
+# Messages stored before this process started (everything, for a new index,
+# or what a crash lost from the memory segment) are backfilled from the
+# history store once it is connected. Live messages are indexed meanwhile;
+# the backfill writes its own segments, oldest first, so every segment stays
+# in time order, and segments are only merged while their time ranges
+# follow each other. With several workers the first one backfills from the
+# point the most behind index had reached; a message found in two indexes
+# is returned once.
+#
+# Segment layout: a header with the doc number range, the time range, whether
+# timestamps are in order and the offset of each section, followed by 8-byte
+# aligned sections:
+#   ts        float64 per message, epoch seconds
+#   ids       12 bytes per message, the binary message id
+#   rec_off   uint64 per message + 1, offsets into records
+#   records   UTF-8 "sender \x1f room \x1f text" per message
+#   postings  uint32 message numbers, term after term
+#   post_off  uint64 per term + 1, offsets into postings (in entries)
+#   terms     UTF-8 terms, sorted
+#   term_off  uint64 per term + 1, offsets into terms
+
+import glob
+import heapq
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import deque
+from datetime import datetime, timedelta
+
+import log
+import storage
+
+# --- Configuration ---
+SEARCH_ENABLED = os.environ.get('SEARCH_ENABLED', '1') != '0'
+# One directory per server process is created under this one.
+SEARCH_DIR = os.environ.get('SEARCH_DIR', 'chat_search')
+SEARCH_SEGMENT_DOCS = int(os.environ.get('SEARCH_SEGMENT_DOCS', '20000'))
+SEARCH_FLUSH_INTERVAL = float(os.environ.get('SEARCH_FLUSH_INTERVAL', '10'))
+SEARCH_MERGE_FACTOR = int(os.environ.get('SEARCH_MERGE_FACTOR', '8'))
+SEARCH_RESULTS = 20
+BACKFILL_BATCH = 1000
+
+MAGIC = b'CHATSEG1'
+SECTIONS = ('ts', 'ids', 'rec_off', 'records', 'postings', 'post_off', 'terms', 'term_off')
+HEADER = struct.Struct('<8sQQQddQ' + 'Q' * len(SECTIONS))
+MANIFEST = 'manifest.json'
+SEPARATOR = '\x1f'
+POSTING_SIZE = 4
+
+TOKEN = re.compile(r'\w+')
+MAX_TOKEN = 40
+
+
+def tokenize(text):
+    """The distinct lowercase words of `text`."""
+    return {token for token in TOKEN.findall(text.lower()) if len(token) <= MAX_TOKEN}
+
+
+def room_term(room):
+    return '#' + room
+
+
+def sender_term(sender):
+    return '@' + sender.lower()
+
+
+def _id_bytes(message_id):
+    try:
+        raw = bytes.fromhex(message_id)
+    except (TypeError, ValueError):
+        raw = b''
+    return raw[:12].ljust(12, b'\0')
+
+
+class Hit:
+    """One search result."""
+
+    __slots__ = ('message_id', 'sender', 'room', 'text', 'timestamp')
+
+    def __init__(self, message_id, sender, room, text, timestamp):
+        self.message_id = message_id
+        self.sender = sender
+        self.room = room
+        self.text = text
+        # Epoch seconds.
+        self.timestamp = timestamp
+
+
+class Query:
+    """Words that must all occur, and optional room, sender and time bounds."""
+
+    def __init__(self, words=(), room=None, sender=None, since=None, until=None):
+        self.words = set(words)
+        self.room = room
+        self.sender = sender
+        self.since = since
+        self.until = until
+
+    def terms(self):
+        terms = set(self.words)
+        if self.room is not None:
+            terms.add(room_term(self.room))
+        if self.sender is not None:
+            terms.add(sender_term(self.sender))
+        return terms
+
+    def matches_time(self, ts):
+        return (self.since is None or ts >= self.since) and (self.until is None or ts < self.until)
+
+    def overlaps(self, min_ts, max_ts):
+        return (self.since is None or max_ts >= self.since) and (self.until is None or min_ts < self.until)
+
+
+RELATIVE = re.compile(r'^(\d+)([mhdw])$')
+UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+
+
+def parse_time(value, now):
+    """'7d', '12h', '2024-05-01' or '2024-05-01T12:00' -> epoch seconds (UTC)."""
+    match = RELATIVE.match(value)
+    if match:
+        return storage.to_epoch(now - timedelta(**{UNITS[match.group(2)]: int(match.group(1))}))
+    try:
+        return storage.to_epoch(datetime.fromisoformat(value))
+    except ValueError:
+        raise ValueError(f"Cannot read {value!r} as a time; use e.g. 7d, 12h or 2024-05-01.") from None
+
+
+def parse_query(text, now=None):
+    """Parses "/search" arguments: words plus in:<room>, from:<name>, since:<time>, until:<time>."""
+    now = now or datetime.utcnow()
+    query = Query()
+    for part in text.split():
+        key, sep, value = part.partition(':')
+        key = key.lower()
+        if sep and value and key == 'in':
+            query.room = value.lstrip('#').lower()
+        elif sep and value and key == 'from':
+            query.sender = value
+        elif sep and value and key == 'since':
+            query.since = parse_time(value, now)
+        elif sep and value and key == 'until':
+            query.until = parse_time(value, now)
+        else:
+            query.words |= tokenize(part)
+    if not query.terms():
+        raise ValueError("Search for at least one word, a room (in:) or a sender (from:).")
+    return query
+
+
+# --- Segments ---
+
+class MemorySegment:
+    """Messages indexed since the last flush, searchable straight away."""
+
+    def __init__(self, base):
+        self.base = base
+        self.ts = array('d')
+        self.ids = bytearray()
+        self.records = []
+        # term -> array of message numbers, ascending.
+        self.postings = {}
+        self.min_ts = float('inf')
+        self.max_ts = float('-inf')
+        # Timestamps non-decreasing, so a time range is a range of numbers.
+        self.ordered = True
+
+    def __len__(self):
+        return len(self.ts)
+
+    def add(self, document):
+        number = self.base + len(self.ts)
+        ts = storage.to_epoch(document['timestamp'])
+        room = document.get('room') or 'lobby'
+        sender, text = document['sender_name'], document['message']
+        self.ts.append(ts)
+        self.ids += _id_bytes(document['_id'])
+        self.records.append(SEPARATOR.join((sender, room, text)).encode('utf-8'))
+        self.ordered = self.ordered and ts >= self.max_ts
+        self.min_ts, self.max_ts = min(self.min_ts, ts), max(self.max_ts, ts)
+        terms = tokenize(text)
+        terms.add(room_term(room))
+        terms.add(sender_term(sender))
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array('I')
+            postings.append(number)
+
+    def lookup(self, term):
+        return self.postings.get(term)
+
+    def timestamp(self, number):
+        return self.ts[number - self.base]
+
+    def hit(self, number):
+        local = number - self.base
+        return _hit(self.ids[local * 12:local * 12 + 12], self.records[local], self.ts[local])
+
+
+def _hit(raw_id, record, ts):
+    sender, room, text = str(record, 'utf-8').split(SEPARATOR, 2)
+    return Hit(bytes(raw_id).hex(), sender, room, text, ts)
+
+
+class Segment:
+    """An immutable, mmapped segment file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        fields = HEADER.unpack_from(self._map, 0)
+        if fields[0] != MAGIC:
+            raise ValueError(f"{path} is not a search segment")
+        _, self.base, self.ndocs, self.nterms, self.min_ts, self.max_ts, ordered = fields[:7]
+        self.ordered = bool(ordered)
+        offsets = dict(zip(SECTIONS, fields[7:]))
+        view = memoryview(self._map)
+
+        def section(name, fmt, count):
+            start = offsets[name]
+            size = struct.calcsize(fmt) if fmt else 1
+            return view[start:start + count * size].cast(fmt) if fmt else view[start:start + count]
+
+        self.ts = section('ts', 'd', self.ndocs)
+        self.ids = section('ids', None, self.ndocs * 12)
+        self.rec_off = section('rec_off', 'Q', self.ndocs + 1)
+        self.records = section('records', None, self.rec_off[self.ndocs])
+        self.post_off = section('post_off', 'Q', self.nterms + 1)
+        self.postings = section('postings', 'I', self.post_off[self.nterms])
+        self.term_off = section('term_off', 'Q', self.nterms + 1)
+        self.terms = section('terms', None, self.term_off[self.nterms])
+        self.size = len(self._map)
+
+    def __len__(self):
+        return self.ndocs
+
+    def term(self, i):
+        return bytes(self.terms[self.term_off[i]:self.term_off[i + 1]])
+
+    def lookup(self, term):
+        """The postings of `term` as a memoryview of uint32, or None."""
+        key = term.encode('utf-8')
+        lo, hi = 0, self.nterms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.nterms and self.term(lo) == key:
+            return self.postings[self.post_off[lo]:self.post_off[lo + 1]]
+        return None
+
+    def iter_terms(self, tag=0):
+        for i in range(self.nterms):
+            yield self.term(i), tag, i
+
+    def term_postings(self, i):
+        return self.postings[self.post_off[i]:self.post_off[i + 1]]
+
+    def timestamp(self, number):
+        return self.ts[number - self.base]
+
+    def hit(self, number):
+        local = number - self.base
+        return _hit(self.ids[local * 12:local * 12 + 12],
+                    self.records[self.rec_off[local]:self.rec_off[local + 1]], self.ts[local])
+
+
+class SegmentWriter:
+    """Streams the sections of a new segment to a temporary file, then renames it into place."""
+
+    def __init__(self, path):
+        self.path = path
+        self._tmp = path + '.tmp'
+        self._file = open(self._tmp, 'wb')
+        self._file.write(b'\0' * HEADER.size)
+        self.offsets = {}
+
+    def section(self, name, *chunks):
+        pad = -self._file.tell() % 8
+        self._file.write(b'\0' * pad)
+        self.offsets[name] = self._file.tell()
+        for chunk in chunks:
+            self._file.write(chunk)
+
+    def postings(self, terms):
+        """Writes (term, [postings chunks as bytes]) pairs, terms ascending, and the three sections they make up."""
+        self.section('postings')
+        post_off, term_off, blob = array('Q', [0]), array('Q', [0]), bytearray()
+        count = 0
+        for term, chunks in terms:
+            for chunk in chunks:
+                self._file.write(chunk)
+                count += len(chunk) // POSTING_SIZE
+            post_off.append(count)
+            blob += term
+            term_off.append(len(blob))
+        self.section('post_off', post_off)
+        self.section('terms', blob)
+        self.section('term_off', term_off)
+        return len(post_off) - 1
+
+    def finish(self, base, ndocs, nterms, min_ts, max_ts, ordered):
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, base, ndocs, nterms, min_ts, max_ts, ordered,
+                                     *(self.offsets[name] for name in SECTIONS)))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._tmp, self.path)
+        return Segment(self.path)
+
+
+def write_memory_segment(path, mem):
+    writer = SegmentWriter(path)
+    rec_off = array('Q', [0])
+    for record in mem.records:
+        rec_off.append(rec_off[-1] + len(record))
+    writer.section('ts', mem.ts)
+    writer.section('ids', mem.ids)
+    writer.section('rec_off', rec_off)
+    writer.section('records', *mem.records)
+    # Postings arrays hold uint32 items; the file stores them as raw bytes.
+    nterms = writer.postings((term.encode('utf-8'), (memoryview(mem.postings[term]).cast('B'),))
+                             for term in sorted(mem.postings, key=lambda t: t.encode('utf-8')))
+    return writer.finish(mem.base, len(mem), nterms, mem.min_ts, mem.max_ts, mem.ordered)
+
+
+def merge_segments(path, segments):
+    """Writes one segment covering `segments`, which must be consecutive and in order."""
+    writer = SegmentWriter(path)
+    writer.section('ts', *(s.ts.cast('B') for s in segments))
+    writer.section('ids', *(s.ids for s in segments))
+    rec_off, shift = array('Q', [0]), 0
+    for s in segments:
+        rec_off.extend(offset + shift for offset in s.rec_off[1:])
+        shift += s.rec_off[s.ndocs]
+    writer.section('rec_off', rec_off)
+    writer.section('records', *(s.records for s in segments))
+
+    def merged_terms():
+        # (term, segment index, term index): equal terms come out in segment order.
+        streams = [s.iter_terms(index) for index, s in enumerate(segments)]
+        current, chunks = None, []
+        for term, index, i in heapq.merge(*streams):
+            if term != current:
+                if current is not None:
+                    yield current, chunks
+                current, chunks = term, []
+            chunks.append(segments[index].term_postings(i).cast('B'))
+        if current is not None:
+            yield current, chunks
+
+    nterms = writer.postings(merged_terms())
+    return writer.finish(segments[0].base, sum(s.ndocs for s in segments), nterms,
+                         min(s.min_ts for s in segments), max(s.max_ts for s in segments),
+                         all(s.ordered for s in segments)
+                         and all(a.max_ts <= b.min_ts for a, b in zip(segments, segments[1:])))
+
+
+def search_segments(segments, query, limit):
+    """Newest-first hits of `query` in `segments` (any mix of memory and file segments).
+
+    Within a segment, recency is the order messages were indexed in, which
+    matches their timestamps unless the clock stepped back. A message found in
+    several segments (two workers' indexes, after a backfill) counts once.
+    """
+    terms = query.terms()
+    hits = []
+    seen = set()
+    # Newest segment first; once `limit` hits are in hand, older segments can only add older ones.
+    for segment in sorted(segments, key=lambda s: s.max_ts, reverse=True):
+        if not len(segment) or not query.overlaps(segment.min_ts, segment.max_ts):
+            continue
+        if len(hits) >= limit and segment.max_ts < hits[limit - 1].timestamp:
+            break
+        lists = []
+        for term in terms:
+            postings = segment.lookup(term)
+            if not postings:
+                break
+            lists.append(postings)
+        else:
+            lists.sort(key=len)
+            rarest, others = lists[0], lists[1:]
+            first, last = _time_window(segment, rarest, query)
+            found = 0
+            for k in range(last - 1, first - 1, -1):
+                number = rarest[k]
+                if not all(_contains(other, number) for other in others):
+                    continue
+                if not query.matches_time(segment.timestamp(number)):
+                    continue
+                hit = segment.hit(number)
+                if hit.message_id in seen:
+                    continue
+                seen.add(hit.message_id)
+                hits.append(hit)
+                found += 1
+                if found >= limit:
+                    break
+            hits.sort(key=lambda hit: hit.timestamp, reverse=True)
+    return hits[:limit]
+
+
+def _time_window(segment, postings, query):
+    """The slice of `postings` that can fall within the query's time range."""
+    if not segment.ordered or (query.since is None and query.until is None):
+        return 0, len(postings)
+    first, last = segment.base, segment.base + len(segment)
+    if query.since is not None:
+        first += bisect_left(segment.ts, query.since)
+    if query.until is not None:
+        last = segment.base + bisect_left(segment.ts, query.until)
+    return bisect_left(postings, first), bisect_left(postings, last)
+
+
+def _contains(postings, number):
+    i = bisect_left(postings, number)
+    return i < len(postings) and postings[i] == number
+
+
+# --- Index ---
+
+class SearchIndex:
+    """The segments of one server process, and an indexer thread that maintains them.
+
+    add() only queues documents. Other processes' directories under the
+    same parent (one per supervisor worker) are searched too, read-only.
+    With `backfill`, backfill_from() also indexes what the store holds from
+    before this index was opened.
+    """
+
+    def __init__(self, path, segment_docs=SEARCH_SEGMENT_DOCS, flush_interval=SEARCH_FLUSH_INTERVAL,
+                 merge_factor=SEARCH_MERGE_FACTOR, backfill=False):
+        self.path = path
+        self.segment_docs = segment_docs
+        self.flush_interval = flush_interval
+        self.merge_factor = merge_factor
+        os.makedirs(path, exist_ok=True)
+        manifest = self._read_manifest(path)
+        self.segments = [Segment(os.path.join(path, name)) for name in manifest['segments']]
+        self._next_segment = manifest['next_segment']
+        self._remove_orphans(manifest['segments'])
+        base = self.segments[-1].base + self.segments[-1].ndocs if self.segments else 0
+        self._mem = MemorySegment(base)
+        # The memory segment being written out, still searched until its file is live.
+        self._frozen = None
+        self._queue = deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._lock = threading.Lock()
+        self._closing = False
+        self._siblings = {}
+        # Live messages are all timestamped after this; the backfill covers
+        # what the store holds between `_backfill_since` and it.
+        self._opened = datetime.utcnow()
+        self._backfill = backfill
+        self._backfill_since = self._indexed_until() if backfill else None
+        self._store = None
+        self.indexed = 0
+        self.backfilled = 0
+        self.flushes = 0
+        self.merges = 0
+        self._thread = threading.Thread(target=self._run, name='search-indexer', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _read_manifest(path):
+        try:
+            with open(os.path.join(path, MANIFEST), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'segments': [], 'next_segment': 0}
+
+    def _remove_orphans(self, live):
+        # Left behind by a crash between writing a file and the manifest.
+        for path in glob.glob(os.path.join(self.path, 'seg-*')):
+            if os.path.basename(path) not in live:
+                os.remove(path)
+
+    def _write_manifest(self):
+        tmp = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'segments': [s.name for s in self.segments], 'next_segment': self._next_segment}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    def _new_path(self):
+        self._next_segment += 1
+        return os.path.join(self.path, f"seg-{self._next_segment:08d}.idx")
+
+    # --- Writing ---
+
+    def add(self, documents):
+        """Queues persisted documents for indexing; never blocks on the indexer."""
+        # Direct messages are private to their two parties; /search covers rooms.
+        documents = [document for document in documents if document.get('recipient') is None]
+        with self._cond:
+            self._queue.extend(documents)
+            self._cond.notify()
+
+    def backfill_from(self, store):
+        """Hands over the history store; a `backfill` index starts on it, others ignore it."""
+        with self._cond:
+            self._store = store
+            self._cond.notify()
+
+    def _run(self):
+        flush_at = time.monotonic() + self.flush_interval
+        while True:
+            with self._cond:
+                if not self._queue and not self._closing and self._store is None:
+                    self._cond.wait(max(0.0, flush_at - time.monotonic()))
+                batch, self._queue = self._queue, deque()
+                closing = self._closing
+                store, self._store = self._store, None
+            if store is not None and self._backfill and not closing:
+                self._run_backfill(store)
+            self._index(batch)
+            now = time.monotonic()
+            if len(self._mem) and (now >= flush_at or closing):
+                self._write_out()
+            if now >= flush_at:
+                flush_at = now + self.flush_interval
+            if closing:
+                return
+
+    def _index(self, batch):
+        while batch:
+            with self._lock:
+                while batch and len(self._mem) < self.segment_docs:
+                    self._mem.add(batch.popleft())
+                    self.indexed += 1
+            if len(self._mem) >= self.segment_docs:
+                self._write_out()
+
+    def _indexed_until(self):
+        """Epoch seconds up to which every index under the parent directory had
+        written segments out, or None if one of them has none."""
+        newest = [max(s.max_ts for s in self.segments) if self.segments else None]
+        newest += [max(s.max_ts for s in segments) for segments in self._sibling_indexes().values()]
+        return None if None in newest else min(newest)
+
+    def _run_backfill(self, store):
+        # Older messages must not share a segment with the live ones indexed so far.
+        if len(self._mem):
+            self._write_out()
+        start = time.monotonic()
+        after = storage.from_epoch(self._backfill_since) if self._backfill_since is not None else None
+        # Ids already indexed at the `after` a page starts from; it is inclusive.
+        boundary = set()
+        try:
+            while not self._closing:
+                docs = store.oldest(self._opened, BACKFILL_BATCH, after)
+                fresh = [doc for doc in docs if doc['_id'] not in boundary and doc.get('recipient') is None
+                         and (self._backfill_since is None or storage.to_epoch(doc['timestamp']) > self._backfill_since)]
+                self._index(deque(fresh))
+                self.backfilled += len(fresh)
+                if len(docs) < BACKFILL_BATCH:
+                    break
+                last = docs[-1]['timestamp']
+                if last == after:
+                    log.error('SEARCH ERROR', f"Backfill stopped: over {BACKFILL_BATCH} messages share one timestamp.")
+                    break
+                after, boundary = last, {doc['_id'] for doc in docs if doc['timestamp'] == last}
+        except Exception as e:
+            log.error('SEARCH ERROR', f"Could not backfill the search index: {e}")
+        if len(self._mem):
+            self._write_out()
+        if self.backfilled:
+            log.info('SEARCH', f"Indexed {self.backfilled} stored messages in {time.monotonic() - start:.1f}s.")
+
+    def _write_out(self):
+        try:
+            self._flush()
+            self._maybe_merge()
+        except OSError as e:
+            log.error('SEARCH ERROR', f"Could not write a search segment: {e}")
+
+    def _flush(self):
+        with self._lock:
+            mem, self._frozen = self._mem, self._mem
+            self._mem = MemorySegment(mem.base + len(mem))
+        segment = write_memory_segment(self._new_path(), mem)
+        with self._lock:
+            self.segments = self.segments + [segment]
+            self._frozen = None
+        self._write_manifest()
+        self.flushes += 1
+
+    def _tier(self, segment):
+        tier, size = 0, self.segment_docs
+        while segment.ndocs > size:
+            tier, size = tier + 1, size * self.merge_factor
+        return tier
+
+    def _maybe_merge(self):
+        # The newest `merge_factor` segments of one size become one segment of
+        # the next size up, like carrying in a counter.
+        while len(self.segments) >= self.merge_factor:
+            tail = self.segments[-self.merge_factor:]
+            if len({self._tier(s) for s in tail}) != 1:
+                return
+            if any(b.max_ts < a.max_ts for a, b in zip(tail, tail[1:])):
+                # Backfilled segments after newer live ones: merged, message
+                # numbers would no longer follow time.
+                return
+            merged = merge_segments(self._new_path(), tail)
+            with self._lock:
+                self.segments = self.segments[:-self.merge_factor] + [merged]
+            self._write_manifest()
+            for s in tail:
+                # Queries still holding the old list keep their mappings until they finish.
+                os.remove(s.path)
+            self.merges += 1
+
+    def close(self, timeout=30.0):
+        """Indexes what is queued, writes the memory segment out and stops."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    # --- Reading ---
+
+    def search(self, query, limit=SEARCH_RESULTS):
+        with self._lock:
+            # The memory segment grows under this lock; the others never change.
+            hits = search_segments([self._mem], query, limit)
+            segments = ([self._frozen] if self._frozen is not None else []) + self.segments
+        for siblings in self._sibling_indexes().values():
+            segments = segments + siblings
+        hits += search_segments(segments, query, limit)
+        # The memory segment can hold a message a sibling index also has.
+        unique = {hit.message_id: hit for hit in hits}
+        return heapq.nlargest(limit, unique.values(), key=lambda hit: hit.timestamp)
+
+    def _sibling_indexes(self):
+        """Directory -> segments of the other worker processes' indexes, reloaded when their manifests change."""
+        indexes = {}
+        parent = os.path.dirname(os.path.abspath(self.path))
+        for manifest in glob.glob(os.path.join(parent, '*', MANIFEST)):
+            path = os.path.dirname(manifest)
+            if os.path.abspath(path) == os.path.abspath(self.path):
+                continue
+            try:
+                mtime = os.stat(manifest).st_mtime_ns
+                with self._lock:
+                    cached = self._siblings.get(path)
+                if cached is None or cached[0] != mtime:
+                    names = self._read_manifest(path)['segments']
+                    cached = (mtime, [Segment(os.path.join(path, n)) for n in names])
+                    with self._lock:
+                        self._siblings[path] = cached
+            except (OSError, ValueError):
+                # Mid-merge in the other process; next query will see the new manifest.
+                continue
+            indexes[path] = cached[1]
+        return indexes
+
+    def stats(self):
+        segments = self.segments
+        return {'indexed': self.indexed, 'segments': len(segments), 'memory_docs': len(self._mem),
+                'bytes': sum(s.size for s in segments), 'flushes': self.flushes, 'merges': self.merges}
@@ -1,122 +1,556 @@
 # chat_server_docker.py
-# This server relays messages and saves chat history to a MongoDB container.
+# This server relays messages and saves chat history to a MongoDB container
+# (or to an embedded SQLite file, see storage.py).
 
 import socket
 import threading
-from pymongo import MongoClient
 from datetime import datetime
 import time
 import os
+import argparse
+import random
+import signal
+import sys
+
+import admission
+import archive
+import bus
+import federation
+import files
+import handoff
+import health
+import hub
+import log
+import metrics
+import outbound
+import persistence
+import protocol
+import rooms
+import search
+import session
+import storage
+import supervisor
 
 # --- Configuration ---
 HOST = '0.0.0.0'
-PORT = 65432
+PORT = int(os.environ.get('SERVER_PORT', '65432'))
+# 'threaded' runs one thread per connection; 'asyncio' multiplexes every
+# connection on a single event loop (see aio_server.py).
+SERVER_MODE = os.environ.get('SERVER_MODE', 'threaded')
+SERVER_MODES = ('threaded', 'asyncio')
+# More than one worker runs a supervisor that forks that many server
+# processes sharing the port (see supervisor.py).
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', '1'))
+
+# Where chat history is kept: 'mongo' or 'sqlite' (SQLITE_PATH, no service needed).
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo')
+# The chat port opens straight away and the store is connected in the
+# background, retrying after a random wait below
+# min(STORE_RETRY_MAX, STORE_RETRY_BASE * 2**attempt) seconds.
+STORE_RETRY_BASE = float(os.environ.get('STORE_RETRY_BASE', '0.5'))
+STORE_RETRY_MAX = float(os.environ.get('STORE_RETRY_MAX', '30'))
 
 MONGO_URI = os.environ.get('MONGO_DATABASE_URI', None)
 # MONGO_URI = os.environ.get('MONGO_DATABASE_URI', 'mongodb://localhost:27017/chat_application')
 MONGO_CLIENT = None
 DB = None
 CHAT_COLLECTION = None
+# The open history backend, the write-behind stage in front of it, and the
+# search index it feeds; the archive of aged history and the archiver that
+# moves messages into it (archive.py), with HISTORY_RETENTION_DAYS set.
+STORE = None
+PERSISTENCE = None
+SEARCH = None
+ARCHIVE = None
+ARCHIVER = None
+# Set at shutdown so a store that connects late is closed, not attached.
+STOPPING = threading.Event()
+STORE_LOCK = threading.Lock()
 
 def connect_to_mongo():
-    """Tries to connect to MongoDB using the URI, retrying if it fails."""
+    """Connects to MongoDB using the URI; raises if it does not answer."""
     global MONGO_CLIENT, DB, CHAT_COLLECTION
-    retries = 10
-    for i in range(retries):
+    # Use the MONGO_URI variable to connect
+    store = storage.MongoStore(MONGO_URI)
+    try:
+        store.ping()
+        store.ensure_indexes()
+    except Exception:
+        store.close()
+        raise
+    MONGO_CLIENT, DB, CHAT_COLLECTION = store.client, store.db, store.collection
+    log.info('DATABASE', "Connected to MongoDB successfully.")
+    return store
+
+def open_store(backend=STORAGE_BACKEND):
+    """Opens the configured history backend; raises if it is unavailable."""
+    if backend == storage.MongoStore.name:
+        return connect_to_mongo()
+    store = storage.BACKENDS[backend]()
+    log.info('DATABASE', f"Using the {backend} history store.")
+    return store
+
+def connect_store(backend=STORAGE_BACKEND):
+    """Opens the store with backoff until it answers, then puts it to use.
+
+    Runs on its own thread while the server is already taking chat; until
+    then the write-behind stage journals every message.
+    """
+    global STORE, ARCHIVER
+    health.HEALTH.store_connecting()
+    attempt = 0
+    while not STOPPING.is_set():
         try:
-            # Use the MONGO_URI variable to connect
-            MONGO_CLIENT = MongoClient(MONGO_URI)
-            DB = MONGO_CLIENT['chat_application']
-            CHAT_COLLECTION = DB['chat_history']
-            # The ismaster command is cheap and does not require auth.
-            MONGO_CLIENT.admin.command('ismaster')
-            print("[DATABASE] Connected to MongoDB successfully.")
-            return True
+            store = open_store(backend)
         except Exception as e:
-            print(f"[DATABASE ERROR] Could not connect to MongoDB: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
-    print("[DATABASE ERROR] Could not connect to MongoDB after several retries. Exiting.")
-    return False
+            delay = random.uniform(0, min(STORE_RETRY_MAX, STORE_RETRY_BASE * 2 ** attempt))
+            attempt += 1
+            log.error('DATABASE ERROR', f"Could not open the {backend} history store: {e}. "
+                                        f"Journaling messages; retrying in {delay:.1f}s...")
+            STOPPING.wait(delay)
+            continue
+        with STORE_LOCK:
+            if STOPPING.is_set():
+                store.close()
+                return
+            STORE = store
+            if ARCHIVE is not None and ARCHIVE.writable:
+                ARCHIVER = archive.Archiver(store, ARCHIVE, archive.HISTORY_RETENTION_DAYS * 86400)
+        HUB.store = archive.ArchivedStore(store, ARCHIVE) if ARCHIVE is not None else store
+        # First, so that what the journal held is in the store for the
+        # recent-message rings and the search backfill.
+        PERSISTENCE.attach(store)
+        try:
+            HUB.warm_recent()
+        except Exception as e:
+            log.error('DATABASE ERROR', f"Could not load recent history: {e}")
+        if SEARCH is not None:
+            SEARCH.backfill_from(store)
+        if ARCHIVER is not None:
+            ARCHIVER.start()
+        log.info('DATABASE', f"History store ready {health.HEALTH.store_connected():.2f}s after start.")
+        return
 
-# --- State ---
-clients = {}
-clients_lock = threading.Lock()
+class ClientConn(session.Session):
+    """A connected socket and its session; the send queue starts at HELLO."""
+
+    __slots__ = ('sock',)
+
+    def __init__(self, sock, addr):
+        super().__init__(addr)
+        self.sock = sock
+
+    def start(self, reader):
+        """Takes what the client negotiated in HELLO and starts its writer."""
+        self.name = reader.name
+        self.framed = reader.framed
+        self.codec = reader.decoder.codec
+        self.resume = reader.resume
+        self.heartbeat = reader.heartbeat
+        self.outbox = outbound.ThreadedOutbox(self.sock)
+
+    def send(self, outgoing):
+        """Queues a message for this client without blocking on its socket."""
+        if not self.outbox.put(outgoing.buffers(self.framed, self.codec)):
+            log.warning('SLOW CONSUMER', "Disconnecting {name}: send queue full.", name=self.name)
+            outbound.shutdown_socket(self.sock)
+
+    def ping(self):
+        self.outbox.put(protocol.PING_FRAME)
+
+    def expire(self, reason):
+        # The reader thread wakes from recv() and tears the connection down.
+        outbound.shutdown_socket(self.sock)
 
 # --- Functions ---
-def broadcast(message, sender_conn):
-    with clients_lock:
-        for client_conn in clients:
-            if client_conn != sender_conn:
-                try:
-                    client_conn.send(message)
-                except socket.error:
-                    print("Failed to send message to a client.")
-
-def save_message(name, message_text):
-    if not CHAT_COLLECTION:
-        print("[DATABASE ERROR] Not connected to DB. Cannot save message.")
+def save_message(name, message_text, room=rooms.DEFAULT_ROOM, message_id=None, timestamp=None, recipient=None,
+                 attachment=None):
+    """Queues a chat message for the write-behind stage; never waits on the database.
+
+    Direct messages name their `recipient` and are stored under the room rooms.DIRECT.
+    File announcements keep their `attachment` ({"blob", "name", "size"}) as "file".
+    """
+    # pymongo collections refuse truth-value testing, so compare with None.
+    if PERSISTENCE is None:
+        log.warning('NOT SAVED', "Not connected to DB. Cannot save message from {name}.", name=name)
         return
-    try:
-        message_document = {
-            "sender_name": name,
-            "message": message_text,
-            "timestamp": datetime.utcnow()
-        }
-        CHAT_COLLECTION.insert_one(message_document)
-    except Exception as e:
-        print(f"[DATABASE ERROR] Could not save message to MongoDB: {e}")
-
-def handle_client(conn, addr):
-    ip, port = addr
-    name = None
-    try:
-        name = conn.recv(1024).decode('utf-8')
-        if not name:
-            raise ConnectionError("Client did not provide a name.")
-
-        print(f"[NEW CONNECTION] {name} ({ip}:{port}) connected.")
-        
-        with clients_lock:
-            clients[conn] = name
-        
-        announcement = f"[SERVER] {name} has joined the chat.".encode('utf-8')
-        broadcast(announcement, conn)
+    message_document = {
+        "_id": message_id or storage.new_message_id(),
+        "sender_name": name,
+        "message": message_text,
+        "room": room,
+        "timestamp": timestamp or datetime.utcnow()
+    }
+    if recipient is not None:
+        message_document["recipient"] = recipient
+    if attachment is not None:
+        message_document["file"] = attachment
+    PERSISTENCE.submit(message_document)
+
+# --- State ---
+# Connected clients and their rooms, shared by both engines.
+HUB = hub.ChatHub(save_message)
+# Heartbeats and read timeouts for every connection.
+MONITOR = session.SessionMonitor()
+# Connection caps and rate limits, and the thread that turns refused clients away.
+ADMISSION = admission.Admission()
+REJECTOR = admission.Rejector()
+# Where reader and accept threads stop while a reload hands them over.
+GATE = handoff.Gate()
+
+# --- Metrics ---
+# Gauges are read when /metrics is scraped, never on the message path.
+def _outbox_depths():
+    with HUB.clients_lock:
+        return [len(conn.outbox) for conn in HUB.clients]
+
+metrics.gauge('chat_connections', "Clients currently connected.", lambda: len(HUB.clients))
+metrics.gauge('chat_outbox_depth_total', "Frames queued across all client send queues.",
+              lambda: sum(_outbox_depths()))
+metrics.gauge('chat_outbox_depth_max', "Deepest client send queue.", lambda: max(_outbox_depths(), default=0))
+metrics.gauge('chat_persist_queue_depth', "Messages waiting for the write-behind flush.",
+              lambda: PERSISTENCE.queue_depth() if PERSISTENCE is not None else 0)
+metrics.gauge('chat_sessions_watched', "Connections under heartbeat and timeout watch.",
+              lambda: MONITOR.stats()['watched'])
+metrics.gauge('chat_admission_addresses', "Remote addresses with open connections or draining rate buckets.",
+              lambda: ADMISSION.stats()['addresses'])
+metrics.gauge('chat_rejections_pending', "Refused connections waiting to be sent their rejection (threaded engine).",
+              lambda: REJECTOR.stats()['pending'])
+metrics.gauge('chat_listen_overflows', "Connections the kernel dropped on a full listen queue (cumulative).",
+              admission.listen_overflows)
+metrics.gauge('chat_search_segments', "Segment files in this process's search index.",
+              lambda: SEARCH.stats()['segments'] if SEARCH is not None else 0)
+metrics.gauge('chat_search_index_bytes', "Size of this process's search segments on disk.",
+              lambda: SEARCH.stats()['bytes'] if SEARCH is not None else 0)
+metrics.gauge('chat_archive_segments', "Segment files in the history archive.",
+              lambda: ARCHIVE.stats()['segments'] if ARCHIVE is not None else 0)
+metrics.gauge('chat_archive_messages', "Messages moved from the history store into the archive.",
+              lambda: ARCHIVE.stats()['messages'] if ARCHIVE is not None else 0)
+metrics.gauge('chat_log_queue_depth', "Log records waiting for the log writer.", log.LOGGER.queue_depth)
+metrics.gauge('chat_persist_degraded', "1 while history writes are being journaled instead of stored.",
+              lambda: int(PERSISTENCE is not None and PERSISTENCE.stats()['degraded']))
+
+def flush_persistence(timeout):
+    """Writes out the queued history before a handoff; False if that took too long."""
+    return PERSISTENCE is None or PERSISTENCE.flush(timeout)
 
+class ThreadedEngine:
+    """The threaded engine's side of a reload (see handoff.Handoff)."""
+
+    def __init__(self, listener):
+        self.listener = listener
+        self._conns = ()
+
+    def quiesce(self, deadline):
+        MONITOR.paused = True
+        tracked = GATE.close(deadline)
+        if tracked is None:
+            return False
+        self._conns = [(client, reader) for client, reader in tracked.items() if reader is not None]
+        return True
+
+    def drain(self, deadline):
+        for client, _ in self._conns:
+            if client.outbox is not None:
+                HUB.cancel_uploads(client, "The server is restarting; send the file again.")
+        departures = []
+        for client, reader in self._conns:
+            if client.outbox is None or client.outbox.hold(deadline):
+                departures.append(handoff.departure(HUB, client, reader, client.sock))
+        return departures
+
+    def resume(self):
+        for client, _ in self._conns:
+            if client.outbox is not None:
+                client.outbox.release()
+        self._conns = ()
+        GATE.open(False)
+        MONITOR.paused = False
+
+    def finish(self, clients):
+        for client in clients:
+            HUB.detach(client)
+            # A closed outbox drops what is still sent to it, so nothing
+            # here shuts down a socket the new process now serves.
+            if client.outbox is not None:
+                client.outbox.close()
+        GATE.open(True)
+
+def handle_client(client, reader):
+    conn, limits = client.sock, client.limits
+    ip, port = client.addr
+    MONITOR.watch(client)
+    try:
         while True:
-            message = conn.recv(1024)
-            if not message:
+            if GATE.requested and GATE.park():
+                # Handed over to a new process (handoff.py).
+                return
+            try:
+                nbytes = reader.decoder.recv_into(conn)
+            except BlockingIOError:
+                # The reload poll (handoff.poll_reads) ran out.
+                continue
+            if not nbytes:
                 break
+            received_at = time.perf_counter()
+            upload_bytes = 0
+            for kind, value in reader.events():
+                if kind == protocol.HELLO:
+                    client.start(reader)
+                    refusal = HUB.claim(client)
+                    if refusal is not None:
+                        log.warning('REFUSED', "{ip}:{port}: {reason}", ip=ip, port=port, reason=refusal)
+                        first_byte = protocol.PROTOCOL_VERSION if client.framed else None
+                        client.outbox.put(admission.rejection(first_byte, refusal))
+                        return
+                    if client.framed:
+                        heartbeat = MONITOR.interval if client.heartbeat else None
+                        client.outbox.put(protocol.welcome_frame(reader.compression, heartbeat, client.token))
+                    HUB.join(client)
+                elif kind == protocol.PING:
+                    client.outbox.put(protocol.PONG_FRAME)
+                elif kind == protocol.CHUNK:
+                    if HUB.upload_chunk(client, *value):
+                        upload_bytes += len(value[1])
+                elif kind == protocol.UPLOAD:
+                    HUB.begin_upload(client, value)
+                elif kind == protocol.CREDIT:
+                    client.outbox.credit(*value)
+                else:
+                    HUB.handle_message(client, value, received_at)
+            now = time.monotonic()
+            client.received(nbytes, len(reader.decoder), now)
+            # Over its byte rate: stop reading for a while and let TCP push back.
+            # Upload chunks are paced by their credit window instead.
+            pause = limits.read(max(0, nbytes - upload_bytes), now) if limits is not None else 0.0
+            if pause:
+                time.sleep(pause)
 
-            decoded_message = message.decode('utf-8')
-            save_message(name, decoded_message)
-            broadcast_message = f"[{name}]: ".encode('utf-8') + message
-            print(f"Broadcasting from {name}: {decoded_message}")
-            broadcast(broadcast_message, conn)
-
-    except (ConnectionResetError, ConnectionError):
+    except protocol.ProtocolError as e:
+        log.warning('PROTOCOL ERROR', "{ip}:{port}: {error}", ip=ip, port=port, error=str(e))
+        if client.outbox is not None:
+            client.send(protocol.Outgoing.error(str(e)))
+        elif reader.framed:
+            try:
+                conn.sendall(protocol.Outgoing.error(str(e)).framed())
+            except OSError:
+                pass
+    except OSError:
+        # Resets, and sockets shut down by a slow-consumer disconnect or a timeout.
         pass
     finally:
-        with clients_lock:
-            if conn in clients:
-                name = clients.pop(conn)
-                departure_message = f"[SERVER] {name} has left the chat.".encode('utf-8')
-                broadcast(departure_message, None)
-                print(f"[DISCONNECTED] {name} ({ip}:{port}) disconnected.")
+        client.closed = True
+        if client.outbox is not None:
+            HUB.leave(client)
+            client.outbox.close()
+        if limits is not None:
+            ADMISSION.release(limits)
+        GATE.untrack(client)
         conn.close()
 
-def start_server():
-    if not connect_to_mongo():
-        return
+def start_client(client, reader, reload=False):
+    """Runs a connection's reader on its own thread."""
+    if reload:
+        handoff.poll_reads(client.sock)
+    GATE.track(client, reader)
+    # Daemon threads: a client that never disconnects must not keep the process alive.
+    threading.Thread(target=handle_client, args=(client, reader), daemon=True).start()
 
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((HOST, PORT))
-    server.listen()
-    print(f"[LISTENING] Server is listening on {HOST}:{PORT}")
+def adopt_clients(inherited, reload=False):
+    """Carries on with the connections a previous process handed over (handoff.py)."""
+    adopted = []
+    for arrival in inherited.arrivals:
+        arrival.sock.setblocking(True)
+        client = ClientConn(arrival.sock, arrival.addr)
+        client.limits = ADMISSION.admit(arrival.addr[0], force=True)
+        reader = protocol.ClientReader.restore(arrival.state['reader'], arrival.input)
+        if reader.name is not None:
+            client.start(reader)
+        handoff.restore(HUB, client, arrival)
+        adopted.append((client, reader))
+    # Only once everyone is back in their rooms, or early messages would miss some.
+    for client, reader in adopted:
+        start_client(client, reader, reload)
+
+def serve_threaded(host=HOST, port=PORT, reuse_port=False, inherited=None, reload=None):
+    """Accepts connections, handling each one on its own thread, until handed over."""
+    if inherited is not None:
+        server = inherited.listener
+        server.setblocking(True)
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse_port:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server.bind((host, port))
+        server.listen(admission.LISTEN_BACKLOG)
+    log.info('LISTENING', f"Server is listening on {host}:{port} (threaded mode, {health.listening():.2f}s after start)")
+    MONITOR.run_forever()
+    if inherited is not None:
+        adopt_clients(inherited, reload is not None)
+        log.info('HANDOFF', "Serving {count} inherited connections {seconds:.3f}s after asking for them.",
+                 count=len(inherited.arrivals), seconds=time.perf_counter() - inherited.started)
+    if reload is not None:
+        handoff.poll_reads(server)
+        GATE.track(server)
+        reload.start(ThreadedEngine(server))
 
     while True:
-        conn, addr = server.accept()
-        thread = threading.Thread(target=handle_client, args=(conn, addr))
-        thread.start()
+        if GATE.requested and GATE.park():
+            server.close()
+            return
+        try:
+            conn, addr = server.accept()
+        except BlockingIOError:
+            # The reload poll ran out.
+            continue
+        metrics.CONNECTIONS_ACCEPTED.inc()
+        health.accepted()
+        try:
+            limits = ADMISSION.admit(addr[0])
+        except admission.Refused as refusal:
+            log.warning('REFUSED', "{ip}:{port}: {reason}", ip=addr[0], port=addr[1], reason=str(refusal))
+            REJECTOR.reject(conn, str(refusal))
+            continue
+        outbound.tune_socket(conn)
+        client = ClientConn(conn, addr)
+        client.limits = limits
+        start_client(client, protocol.ClientReader(), reload is not None)
+
+def serve(mode, host=HOST, port=PORT, bus_path=None, inherited=None):
+    """Runs the selected engine without touching the database connection.
+
+    With `bus_path` this process is one worker of a supervisor: it shares the
+    port with its siblings and relays room broadcasts over the bus. With
+    `inherited` (handoff.take_over()) it carries on serving the listener and
+    connections of the process it replaces. With RELOAD_SOCKET set a single
+    process can itself be replaced that way.
+    """
+    if mode not in SERVER_MODES:
+        raise ValueError(f"Unknown server mode {mode!r}; expected one of {SERVER_MODES}")
+    reuse_port = bus_path is not None
+    if metrics.METRICS_PORT:
+        metrics.serve_http(metrics.METRICS_HOST, metrics.METRICS_PORT + supervisor.WORKER_INDEX)
+    if files.FILES_ENABLED:
+        # Workers share one store: a file sent to any of them can be fetched from all.
+        HUB.blobs = files.BlobStore(files.BLOB_DIR)
+    if reuse_port:
+        # A worker whose supervisor is gone would be stranded; shut down cleanly.
+        HUB.relay = bus.BusClient(bus_path, HUB.deliver_remote,
+                                  on_lost=lambda: os.kill(os.getpid(), signal.SIGTERM))
+    if inherited is not None:
+        HUB.restore_state(inherited.hub_state)
+    reload = None
+    if handoff.RELOAD_SOCKET and not reuse_port:
+        reload = handoff.Handoff(handoff.RELOAD_SOCKET, HUB, flush_persistence)
+    if mode == 'asyncio':
+        import aio_server
+        aio_server.serve(host, port, HUB, reuse_port, MONITOR, ADMISSION, inherited, reload)
+    else:
+        serve_threaded(host, port, reuse_port, inherited, reload)
+
+def start_federation(port=PORT, federation_port=federation.FEDERATION_PORT,
+                     peers=federation.FEDERATION_PEERS, node_id=federation.NODE_ID):
+    """Links this server to its peers (see federation.py); relays room traffic through them."""
+    node_id = node_id or f"{socket.gethostname()}:{port}"
+    HUB.relay = federation.Federation(HUB.deliver_remote, federation_port,
+                                      federation.parse_peers(peers), node_id)
+    HUB.relay.start()
+
+def serve_workers(workers, mode, host=HOST, port=PORT):
+    """Runs `workers` database-less engine processes behind a supervisor."""
+    supervisor.run(workers, lambda bus_path: serve(mode, host, port, bus_path))
+
+def run_node(mode=SERVER_MODE, backend=STORAGE_BACKEND, bus_path=None, port=PORT, inherited=None):
+    """Serves until interrupted, connecting the history store in the background."""
+    global PERSISTENCE, SEARCH, ARCHIVE
+    if backend not in storage.BACKENDS:
+        log.error('DATABASE ERROR', f"Unknown storage backend {backend!r}; expected one of {sorted(storage.BACKENDS)}.")
+        return
+    if search.SEARCH_ENABLED:
+        # One index per worker; each searches its siblings' too, and the first
+        # one indexes what was stored while none was running.
+        SEARCH = search.SearchIndex(os.path.join(search.SEARCH_DIR, f"worker-{supervisor.WORKER_INDEX}"),
+                                    backfill=supervisor.WORKER_INDEX == 0)
+        HUB.search = SEARCH
+    retention = archive.HISTORY_RETENTION_DAYS > 0
+    if retention or os.path.exists(archive.ARCHIVE_DIR):
+        # Every worker reads the archive; the first one also keeps it.
+        ARCHIVE = archive.Archive(archive.ARCHIVE_DIR, writable=retention and supervisor.WORKER_INDEX == 0)
+    PERSISTENCE = persistence.WriteBehind(None, on_batch=SEARCH.add if SEARCH is not None else None)
+    threading.Thread(target=connect_store, args=(backend,), name='store-connect', daemon=True).start()
+    try:
+        serve(mode, port=port, bus_path=bus_path, inherited=inherited)
+    finally:
+        health.HEALTH.draining = True
+        with STORE_LOCK:
+            STOPPING.set()
+        log.info('SHUTDOWN', "Flushing queued messages to the database...")
+        PERSISTENCE.close()
+        if SEARCH is not None:
+            SEARCH.close()
+        if ARCHIVER is not None:
+            ARCHIVER.close()
+        if STORE is not None:
+            STORE.close()
+        log.info('SHUTDOWN', f"Persistence stats: {PERSISTENCE.stats()}")
+
+def start_server(mode=SERVER_MODE, backend=STORAGE_BACKEND, workers=SERVER_WORKERS, port=PORT,
+                 federation_port=federation.FEDERATION_PORT, peers=federation.FEDERATION_PEERS,
+                 node_id=federation.NODE_ID, takeover=False):
+    federated = bool(federation_port or peers)
+    inherited = None
+    if takeover:
+        if workers > 1 or not handoff.RELOAD_SOCKET:
+            log.error('HANDOFF ERROR', "A takeover needs RELOAD_SOCKET and --workers 1.")
+            return
+        if mode == 'asyncio':
+            # Loaded now rather than while the handed-over clients wait.
+            import aio_server  # noqa: F401
+        inherited = handoff.take_over(handoff.RELOAD_SOCKET)
+        if inherited is None:
+            return
+        # Its ports, history store and search index are ours once it has gone.
+        inherited.wait_released()
+    if workers > 1:
+        if federated:
+            log.error('FEDERATION ERROR', "Federation runs one process per node; use --workers 1.")
+            return
+        # Every worker opens its own store connection after the fork.
+        supervisor.run(workers, lambda bus_path: run_node(mode, backend, bus_path, port))
+    else:
+        if federated:
+            start_federation(port, federation_port, peers, node_id)
+        run_node(mode, backend, port=port, inherited=inherited)
+
+def _exit_on_sigterm(signum, frame):
+    # `docker stop` sends SIGTERM; turn it into SystemExit so the finally
+    # blocks above get to flush the write-behind queue. A second SIGTERM
+    # must not interrupt that flush.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Chat relay server.")
+    parser.add_argument('--mode', choices=SERVER_MODES, default=SERVER_MODE,
+                        help="connection engine (default: $SERVER_MODE or 'threaded')")
+    parser.add_argument('--storage', choices=sorted(storage.BACKENDS), default=STORAGE_BACKEND,
+                        help="history backend (default: $STORAGE_BACKEND or 'mongo')")
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS,
+                        help="server processes sharing the port (default: $SERVER_WORKERS or 1)")
+    parser.add_argument('--port', type=int, default=PORT,
+                        help="chat port (default: $SERVER_PORT or 65432)")
+    parser.add_argument('--federation-port', type=int, default=federation.FEDERATION_PORT,
+                        help="port other nodes link to (default: $FEDERATION_PORT, 0 = none)")
+    parser.add_argument('--peers', default=federation.FEDERATION_PEERS,
+                        help="comma-separated host:port of nodes to link to (default: $FEDERATION_PEERS)")
+    parser.add_argument('--node-id', default=federation.NODE_ID,
+                        help="unique name of this node (default: $NODE_ID or hostname:port)")
+    parser.add_argument('--takeover', action='store_true',
+                        help="take the port and connections over from the server on $RELOAD_SOCKET")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    start_server()
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    args = parse_args()
+    start_server(args.mode, args.storage, args.workers, args.port,
+                 args.federation_port, args.peers, args.node_id, args.takeover)
@@ -0,0 +1,181 @@
+# session.py
+# Per-connection state, and the monitor that pings quiet clients and drops
+# dead ones.
+#
+# Both engines' connection classes (server.ClientConn, aio_server.ChatProtocol)
+# derive from Session, whose __slots__ keep an idle connection to a few
+# hundred bytes with no per-instance __dict__.
+#
+# Clients that send "heartbeat": true in HELLO are sent a PING after
+# HEARTBEAT_INTERVAL seconds of silence and dropped after IDLE_TIMEOUT
+# seconds without a byte (a PONG counts), which clears half-open connections
+# out of every room. Everyone, old clients included, has READ_TIMEOUT
+# seconds to send HELLO and to finish a frame once its first byte has
+# arrived; old clients are otherwise left to TCP keepalive (outbound.py).
+
+import os
+import threading
+import time
+
+import health
+import log
+import metrics
+import timers
+
+# --- Configuration ---
+# 0 disables the respective check.
+HEARTBEAT_INTERVAL = float(os.environ.get('HEARTBEAT_INTERVAL', '30'))
+IDLE_TIMEOUT = float(os.environ.get('IDLE_TIMEOUT', '90'))
+READ_TIMEOUT = float(os.environ.get('READ_TIMEOUT', '30'))
+# Resolution of every deadline above.
+TIMER_TICK = float(os.environ.get('TIMER_TICK', '1.0'))
+
+
+class Session:
+    """Who a connection is and when it was last heard from.
+
+    Engines fill in `name`, `framed`, `codec`, `resume` and `outbox` at HELLO
+    and call received() after every read; the room index maintains `room`.
+    Subclasses implement send(), ping() and expire().
+    """
+
+    __slots__ = ('name', 'addr', 'framed', 'codec', 'resume', 'heartbeat', 'room', 'history_cursor',
+                 'outbox', 'limits', 'connected_at', 'last_seen', 'partial_since', 'ping_sent',
+                 'messages_in', 'bytes_in', 'uploads', 'token', 'replaced', 'closed')
+
+    def __init__(self, addr=None):
+        self.name = None
+        self.addr = addr
+        self.framed = None
+        # Negotiated compressors codec, or None.
+        self.codec = None
+        # Where a reconnecting client left off (protocol.parse_resume), or None.
+        self.resume = None
+        # True if the client answers PINGs.
+        self.heartbeat = False
+        self.room = None
+        # Timestamp /older pages back from; set when the client enters a room.
+        self.history_cursor = None
+        self.outbox = None
+        # admission.ClientLimits, when the engine admits connections.
+        self.limits = None
+        # time.monotonic() readings.
+        self.connected_at = self.last_seen = time.monotonic()
+        # When the unfinished frame in the receive buffer started arriving.
+        self.partial_since = None
+        self.ping_sent = 0.0
+        self.messages_in = 0
+        self.bytes_in = 0
+        # Transfer id -> files.BlobWriter of the uploads in progress, or None.
+        self.uploads = None
+        # Secret sent in WELCOME; a reconnect that presents it may take this session's name.
+        self.token = None
+        # Set once a reconnect has taken its name over; it then leaves unannounced.
+        self.replaced = False
+        self.closed = False
+
+    def received(self, nbytes, pending, now):
+        """Records a read of `nbytes`; `pending` is what is left of an unfinished frame."""
+        self.last_seen = now
+        self.bytes_in += nbytes
+        if not pending:
+            self.partial_since = None
+        elif self.partial_since is None:
+            self.partial_since = now
+
+    def send(self, outgoing):
+        raise NotImplementedError
+
+    def ping(self):
+        """Queues a PING frame."""
+        raise NotImplementedError
+
+    def expire(self, reason):
+        """Closes the connection; the engine's usual teardown then runs."""
+        raise NotImplementedError
+
+
+class SessionMonitor:
+    """Heartbeats and timeouts for every session, driven by a timer wheel.
+
+    A read only stores a timestamp on the session. Each session sits in the
+    wheel once, at its earliest possible deadline; when that fires the
+    monitor acts if it is really due, and otherwise re-arms it at the
+    deadline the session's activity has moved it to.
+    """
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL, idle_timeout=IDLE_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, tick=TIMER_TICK):
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.wheel = timers.TimerWheel(tick, now=time.monotonic())
+        # How often a session with nothing pending is looked at again, to
+        # notice a HELLO or a frame that has since started arriving.
+        self.recheck = max(tick, min(t for t in (read_timeout, interval, 60.0) if t))
+        # Set while connections are being handed to another process, which
+        # must not find them expired or pinged mid-way.
+        self.paused = False
+
+    def watch(self, session):
+        self.wheel.schedule(session, self._deadline(session, session.connected_at))
+
+    def check(self, now=None):
+        """Pings and expires whatever is due; call every tick."""
+        now = time.monotonic() if now is None else now
+        # The liveness probe watches this run on the engine's own loop.
+        health.tick()
+        if self.paused:
+            return
+        for session in self.wheel.advance(now):
+            if session.closed:
+                continue
+            reason = self._expired(session, now)
+            if reason is not None:
+                metrics.SESSIONS_EXPIRED.inc()
+                ip, port = session.addr[:2]
+                log.info('TIMEOUT', "Dropping {name} ({ip}:{port}): {reason}.",
+                         name=session.name or '(no HELLO yet)', ip=ip, port=port, reason=reason)
+                session.expire(reason)
+                continue
+            if (session.heartbeat and self.interval and session.ping_sent < session.last_seen
+                    and now - session.last_seen >= self.interval):
+                session.ping_sent = now
+                metrics.PINGS_SENT.inc()
+                session.ping()
+            self.wheel.schedule(session, self._deadline(session, now))
+
+    def _expired(self, session, now):
+        if self.read_timeout:
+            if session.name is None and now - session.connected_at >= self.read_timeout:
+                return f"no HELLO within {self.read_timeout:g}s"
+            if session.partial_since is not None and now - session.partial_since >= self.read_timeout:
+                return f"frame not completed within {self.read_timeout:g}s"
+        if session.heartbeat and self.idle_timeout and now - session.last_seen >= self.idle_timeout:
+            return f"silent for {self.idle_timeout:g}s"
+        return None
+
+    def _deadline(self, session, now):
+        deadline = now + self.recheck
+        if self.read_timeout:
+            if session.name is None:
+                deadline = min(deadline, session.connected_at + self.read_timeout)
+            if session.partial_since is not None:
+                deadline = min(deadline, session.partial_since + self.read_timeout)
+        if session.heartbeat:
+            if self.idle_timeout:
+                deadline = min(deadline, session.last_seen + self.idle_timeout)
+            if self.interval and session.ping_sent < session.last_seen:
+                deadline = min(deadline, session.last_seen + self.interval)
+        return deadline
+
+    def run_forever(self):
+        """Checks once a tick on a daemon thread (threaded engine)."""
+        def run():
+            while True:
+                time.sleep(self.wheel.tick)
+                self.check()
+        threading.Thread(target=run, name='session-monitor', daemon=True).start()
+
+    def stats(self):
+        return {'watched': len(self.wheel)}
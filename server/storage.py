@@ -0,0 +1,362 @@
+# storage.py
+# History storage backends behind save_message(). Every backend stores the
+# same plain documents:
+#
+#   {"_id": <24 hex chars>, "sender_name": str, "message": str,
+#    "room": str, "timestamp": naive UTC datetime}
+#
+# and insert_many() must be idempotent on _id, because the write-behind
+# journal can replay a batch the backend already partly stored. oldest() and
+# delete_many() serve the archiver (archive.py), which moves aged messages
+# out of the store; oldest() also pages the search index's backfill (search.py).
+#
+# Direct messages add "recipient": str and carry the room rooms.DIRECT;
+# history() leaves them out and direct_history() returns them.
+#
+# File announcements (files.py) add "file": {"blob", "name", "size"}, which
+# history() returns so the announcement still names the file after a
+# restart. The archive (archive.py) keeps only the text.
+
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+
+from rooms import DEFAULT_ROOM, DIRECT
+
+# --- Configuration ---
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'chat_history.db')
+MONGO_DATABASE = 'chat_application'
+MONGO_COLLECTION = 'chat_history'
+# How long a MongoDB operation waits for a reachable server before failing.
+MONGO_TIMEOUT_MS = int(os.environ.get('MONGO_TIMEOUT_MS', '5000'))
+
+DUPLICATE_KEY = 11000
+# Ids per delete statement in delete_many().
+DELETE_BATCH = 1000
+
+
+# --- Message ids ---
+# Same layout as a MongoDB ObjectId (4 byte timestamp, 5 random bytes per
+# process, 3 byte counter), so ids sort roughly by creation time and map
+# one-to-one onto ObjectIds, without needing bson for the other backends.
+_ID_PREFIX = os.urandom(5)
+_id_counter = int.from_bytes(os.urandom(3), 'big')
+_id_lock = threading.Lock()
+
+
+def new_message_id():
+    global _id_counter
+    with _id_lock:
+        _id_counter = (_id_counter + 1) & 0xFFFFFF
+        counter = _id_counter
+    return (struct.pack('>I', int(time.time())) + _ID_PREFIX + counter.to_bytes(3, 'big')).hex()
+
+
+def to_epoch(dt):
+    return dt.replace(tzinfo=timezone.utc).timestamp()
+
+
+def from_epoch(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+
+
+class HistoryStore:
+    """Interface every history backend implements."""
+
+    name = None
+
+    def insert_many(self, documents):
+        """Stores `documents`, silently skipping any _id that is already stored."""
+        raise NotImplementedError
+
+    def history(self, limit=50, before=None, room=None):
+        """Returns up to `limit` documents older than `before`, oldest first.
+
+        With `room`, only that room's messages are returned.
+        """
+        raise NotImplementedError
+
+    def direct_history(self, user, limit=50, before=None, peer=None):
+        """Returns up to `limit` direct messages to or from `user` older than `before`, oldest first.
+
+        With `peer`, only those exchanged with `peer` are returned.
+        """
+        raise NotImplementedError
+
+    def rooms(self):
+        """Returns the set of rooms with stored messages, direct messages aside."""
+        raise NotImplementedError
+
+    def oldest(self, before, limit, after=None):
+        """Returns up to `limit` documents of any room, direct messages included,
+        older than `before` and, with `after`, no older than that, oldest first."""
+        raise NotImplementedError
+
+    def delete_many(self, ids):
+        """Removes the documents with these _ids; ids not stored are ignored."""
+        raise NotImplementedError
+
+    def ping(self):
+        """Raises if the backend cannot currently serve requests."""
+
+    def ensure_indexes(self):
+        """Creates the indexes history queries rely on, if missing."""
+
+    def close(self):
+        pass
+
+
+class MongoStore(HistoryStore):
+    """The original MongoDB `chat_history` collection."""
+
+    name = 'mongo'
+
+    def __init__(self, uri):
+        # Imported here so the other backends work without pymongo installed.
+        from pymongo import MongoClient
+        self.client = MongoClient(uri, serverSelectionTimeoutMS=MONGO_TIMEOUT_MS)
+        self.db = self.client[MONGO_DATABASE]
+        self.collection = self.db[MONGO_COLLECTION]
+
+    def ping(self):
+        # The ismaster command is cheap and does not require auth.
+        self.client.admin.command('ismaster')
+
+    def ensure_indexes(self):
+        # Serves history(room=..., before=...) pages without scanning the collection.
+        self.collection.create_index([('room', 1), ('timestamp', -1)], name='room_timestamp')
+        # Serves oldest() for the archiver.
+        self.collection.create_index([('timestamp', 1)], name='timestamp')
+        # Serve direct_history(); only direct messages carry a recipient.
+        direct = {'recipient': {'$type': 'string'}}
+        self.collection.create_index([('recipient', 1), ('timestamp', -1)], name='recipient_timestamp',
+                                     partialFilterExpression=direct)
+        self.collection.create_index([('sender_name', 1), ('timestamp', -1)], name='direct_sender_timestamp',
+                                     partialFilterExpression=direct)
+
+    def insert_many(self, documents):
+        from bson import ObjectId
+        from pymongo.errors import BulkWriteError
+        docs = [dict(doc, _id=ObjectId(doc['_id'])) for doc in documents]
+        try:
+            self.collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(err.get('code') != DUPLICATE_KEY for err in errors) or e.details.get('writeConcernErrors'):
+                raise
+
+    def history(self, limit=50, before=None, room=None):
+        query = {}
+        if before is not None:
+            query['timestamp'] = {'$lt': before}
+        if room is not None:
+            # Pre-room documents have no field and count as the default room.
+            query['room'] = room if room != DEFAULT_ROOM else {'$in': [DEFAULT_ROOM, None]}
+        else:
+            query['room'] = {'$ne': DIRECT}
+        cursor = self.collection.find(query).sort('timestamp', -1).limit(limit)
+        docs = [dict(doc, _id=str(doc['_id']), room=doc.get('room') or DEFAULT_ROOM) for doc in cursor]
+        docs.reverse()
+        return docs
+
+    def direct_history(self, user, limit=50, before=None, peer=None):
+        # Each branch of the $or names the partial indexes' filter, so each is served by one of them.
+        def recipient(name):
+            return {'$eq': name, '$type': 'string'} if name is not None else {'$type': 'string'}
+        received = {'recipient': recipient(user)}
+        if peer is not None:
+            received['sender_name'] = peer
+        query = {'$or': [received, {'sender_name': user, 'recipient': recipient(peer)}]}
+        if before is not None:
+            query['timestamp'] = {'$lt': before}
+        cursor = self.collection.find(query).sort('timestamp', -1).limit(limit)
+        docs = [dict(doc, _id=str(doc['_id'])) for doc in cursor]
+        docs.reverse()
+        return docs
+
+    def rooms(self):
+        # Pre-room documents (a null room) count as the default room.
+        return {room or DEFAULT_ROOM for room in self.collection.distinct('room')} - {DIRECT}
+
+    def oldest(self, before, limit, after=None):
+        timestamp = {'$lt': before}
+        if after is not None:
+            timestamp['$gte'] = after
+        cursor = self.collection.find({'timestamp': timestamp}).sort('timestamp', 1).limit(limit)
+        return [dict(doc, _id=str(doc['_id']), room=doc.get('room') or DEFAULT_ROOM) for doc in cursor]
+
+    def delete_many(self, ids):
+        from bson import ObjectId
+        ids = list(ids)
+        for start in range(0, len(ids), DELETE_BATCH):
+            self.collection.delete_many({'_id': {'$in': [ObjectId(i) for i in ids[start:start + DELETE_BATCH]]}})
+
+    def close(self):
+        self.client.close()
+
+
+class SQLiteStore(HistoryStore):
+    """Embedded single-file store for edge relays and CI, no database service needed.
+
+    WAL mode lets history reads run alongside the write-behind flusher. Writes
+    share one connection under a lock; each reading thread gets its own.
+    """
+
+    name = 'sqlite'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id TEXT PRIMARY KEY,
+            sender_name TEXT NOT NULL,
+            message TEXT NOT NULL,
+            room TEXT NOT NULL DEFAULT 'lobby',
+            timestamp REAL NOT NULL,
+            recipient TEXT,
+            file TEXT
+        );
+        CREATE INDEX IF NOT EXISTS chat_history_timestamp ON chat_history (timestamp);
+    """
+    INDEXES = """
+        CREATE INDEX IF NOT EXISTS chat_history_room_timestamp ON chat_history (room, timestamp);
+        CREATE INDEX IF NOT EXISTS chat_history_recipient_timestamp ON chat_history (recipient, timestamp)
+            WHERE recipient IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS chat_history_direct_sender_timestamp ON chat_history (sender_name, timestamp)
+            WHERE recipient IS NOT NULL;
+    """
+    # Columns added after the first release, for databases created before them.
+    MIGRATIONS = {
+        'room': "ALTER TABLE chat_history ADD COLUMN room TEXT NOT NULL DEFAULT 'lobby'",
+        'recipient': "ALTER TABLE chat_history ADD COLUMN recipient TEXT",
+        'file': "ALTER TABLE chat_history ADD COLUMN file TEXT",
+    }
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        self._writer = self._connect()
+        self._writer.execute('PRAGMA journal_mode=WAL')
+        self._writer.executescript(self.SCHEMA)
+        self._migrate()
+        self.ensure_indexes()
+
+    def ensure_indexes(self):
+        self._writer.executescript(self.INDEXES)
+
+    def _migrate(self):
+        columns = {row[1] for row in self._writer.execute('PRAGMA table_info(chat_history)')}
+        with self._writer:
+            for column, statement in self.MIGRATIONS.items():
+                if column not in columns:
+                    self._writer.execute(statement)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        # With WAL, NORMAL only risks the last commits on power loss, never corruption.
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def ping(self):
+        self._reader().execute('SELECT 1')
+
+    def insert_many(self, documents):
+        rows = [(doc['_id'], doc['sender_name'], doc['message'], doc.get('room') or DEFAULT_ROOM,
+                 to_epoch(doc['timestamp']), doc.get('recipient'),
+                 json.dumps(doc['file']) if doc.get('file') is not None else None) for doc in documents]
+        with self._write_lock, self._writer:
+            self._writer.executemany(
+                'INSERT OR IGNORE INTO chat_history (id, sender_name, message, room, timestamp, recipient, file) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def history(self, limit=50, before=None, room=None):
+        sql = 'SELECT id, sender_name, message, room, timestamp, file FROM chat_history'
+        conditions, params = [], []
+        if room is not None:
+            conditions.append('room = ?')
+            params.append(room)
+        else:
+            conditions.append('room != ?')
+            params.append(DIRECT)
+        if before is not None:
+            conditions.append('timestamp < ?')
+            params.append(to_epoch(before))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY timestamp DESC LIMIT ?'
+        params.append(limit)
+        rows = self._reader().execute(sql, params).fetchall()
+        rows.reverse()
+        docs = []
+        for row in rows:
+            doc = {'_id': row[0], 'sender_name': row[1], 'message': row[2], 'room': row[3],
+                   'timestamp': from_epoch(row[4])}
+            if row[5] is not None:
+                doc['file'] = json.loads(row[5])
+            docs.append(doc)
+        return docs
+
+    def direct_history(self, user, limit=50, before=None, peer=None):
+        # One branch per partial index, each newest first and limited on its
+        # own, so neither reads more than `limit` index entries.
+        received = 'recipient = ?' + (' AND sender_name = ?' if peer is not None else '')
+        sent = 'sender_name = ? AND ' + ('recipient = ?' if peer is not None else 'recipient IS NOT NULL')
+        params = []
+        branches = []
+        for condition, values in ((received, [user, peer]), (sent, [user, peer])):
+            if before is not None:
+                condition += ' AND timestamp < ?'
+            branches.append('SELECT * FROM (SELECT id, sender_name, message, room, timestamp, recipient '
+                            f'FROM chat_history WHERE {condition} ORDER BY timestamp DESC LIMIT ?)')
+            params += [v for v in values if v is not None]
+            if before is not None:
+                params.append(to_epoch(before))
+            params.append(limit)
+        sql = ' UNION ALL '.join(branches) + ' ORDER BY timestamp DESC LIMIT ?'
+        rows = self._reader().execute(sql, params + [limit]).fetchall()
+        rows.reverse()
+        return [{'_id': row[0], 'sender_name': row[1], 'message': row[2], 'room': row[3],
+                 'timestamp': from_epoch(row[4]), 'recipient': row[5]} for row in rows]
+
+    def rooms(self):
+        rows = self._reader().execute('SELECT DISTINCT room FROM chat_history WHERE room != ?', (DIRECT,))
+        return {row[0] for row in rows}
+
+    def oldest(self, before, limit, after=None):
+        rows = self._reader().execute(
+            'SELECT id, sender_name, message, room, timestamp, recipient FROM chat_history '
+            'WHERE timestamp < ? AND timestamp >= ? ORDER BY timestamp LIMIT ?',
+            (to_epoch(before), to_epoch(after) if after is not None else float('-inf'), limit)).fetchall()
+        docs = []
+        for row in rows:
+            doc = {'_id': row[0], 'sender_name': row[1], 'message': row[2], 'room': row[3],
+                   'timestamp': from_epoch(row[4])}
+            if row[5] is not None:
+                doc['recipient'] = row[5]
+            docs.append(doc)
+        return docs
+
+    def delete_many(self, ids):
+        # Freed pages are reused by later inserts, so the file stops growing
+        # rather than shrinking.
+        with self._write_lock, self._writer:
+            self._writer.executemany('DELETE FROM chat_history WHERE id = ?', ((i,) for i in ids))
+
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+
+
+BACKENDS = {
+    MongoStore.name: MongoStore,
+    SQLiteStore.name: SQLiteStore,
+}
@@ -0,0 +1,76 @@
+# supervisor.py
+# Multi-process mode. The supervisor forks N workers that each bind the chat
+# port with SO_REUSEPORT, so the kernel spreads incoming connections across
+# them and every worker gets its own GIL and core. Room broadcasts cross
+# workers over the local bus in bus.py, brokered by the supervisor.
+
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+
+import log
+from bus import BusBroker
+
+# Seconds to wait before restarting a worker that died, so a worker that
+# crashes on startup does not spin.
+RESTART_DELAY = 1.0
+
+# Set in each worker process to its slot, 0..workers-1; stays 0 without a supervisor.
+WORKER_INDEX = 0
+
+
+def run(workers, worker_main, bus_path=None):
+    """Runs `worker_main(bus_path)` in `workers` processes until interrupted.
+
+    Workers that exit are restarted. SIGTERM/SIGINT on the supervisor are
+    passed on to the workers, which flush their persistence before exiting.
+    """
+    bus_dir = None
+    if bus_path is None:
+        bus_dir = tempfile.mkdtemp(prefix='chat-bus-')
+        bus_path = os.path.join(bus_dir, 'bus.sock')
+    broker = BusBroker(bus_path)
+    # Fork before the broker starts any threads.
+    ctx = multiprocessing.get_context('fork')
+    procs = [_spawn(ctx, worker_main, bus_path, i) for i in range(workers)]
+    broker.start()
+    log.info('SUPERVISOR', f"Started {workers} workers (pids {', '.join(str(p.pid) for p in procs)}).")
+
+    try:
+        while True:
+            time.sleep(RESTART_DELAY)
+            for i, proc in enumerate(procs):
+                if not proc.is_alive():
+                    log.warning('SUPERVISOR', f"Worker {i} (pid {proc.pid}) exited with {proc.exitcode}; restarting.")
+                    procs[i] = _spawn(ctx, worker_main, bus_path, i)
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGTERM)
+        for proc in procs:
+            proc.join(15)
+        broker.close()
+        if bus_dir is not None:
+            os.rmdir(bus_dir)
+        log.info('SUPERVISOR', "All workers stopped.")
+
+
+def _spawn(ctx, worker_main, bus_path, index):
+    proc = ctx.Process(target=_worker_entry, args=(worker_main, bus_path, index), name=f'chat-worker-{index}')
+    proc.start()
+    return proc
+
+
+def _worker_entry(worker_main, bus_path, index):
+    global WORKER_INDEX
+    WORKER_INDEX = index
+    # Ctrl+C in a terminal reaches the whole process group; let the
+    # supervisor decide when workers stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        worker_main(bus_path)
+    finally:
+        # multiprocessing ends the child with os._exit(), which skips atexit.
+        log.flush()
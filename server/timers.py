@@ -0,0 +1,57 @@
+# timers.py
+# Hashed timing wheel for per-session deadlines. Scheduling is an append to
+# one slot and a tick only looks at the slots whose time has come, so tens
+# of thousands of sessions cost nothing between their deadlines, unlike a
+# scan over every connection or a heap with log(n) pushes.
+#
+# The wheel never cancels: a deadline that moved (because the client was
+# heard from) is simply re-armed when its old one fires.
+
+import threading
+
+
+class TimerWheel:
+    """Items keyed by deadline, resolved to `tick` seconds.
+
+    Slot i holds the items due in any tick congruent to i modulo `slots`;
+    each entry remembers its absolute tick, so deadlines further away than
+    one revolution stay put until their turn comes round.
+    """
+
+    def __init__(self, tick=1.0, slots=512, now=0.0):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        # The next tick advance() has yet to process.
+        self._current = int(now / tick)
+        self._lock = threading.Lock()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def schedule(self, item, deadline):
+        """Arms `item` to be returned by the first advance() at or after `deadline`."""
+        with self._lock:
+            when = max(int(deadline / self.tick), self._current)
+            self._slots[when % len(self._slots)].append((when, item))
+            self._size += 1
+
+    def advance(self, now):
+        """Returns every item whose deadline is at or before `now`, forgetting them."""
+        due = []
+        target = int(now / self.tick)
+        with self._lock:
+            # A long stall visits each slot at most once.
+            last = min(target, self._current + len(self._slots) - 1)
+            while self._current <= last:
+                index = self._current % len(self._slots)
+                slot = self._slots[index]
+                if slot:
+                    keep = []
+                    for entry in slot:
+                        (due if entry[0] <= target else keep).append(entry)
+                    self._slots[index] = keep
+                self._current += 1
+            self._current = max(self._current, target + 1)
+            self._size -= len(due)
+        return [item for _, item in due]
@@ -0,0 +1,9 @@
+# conftest.py
+# The server modules import each other as top-level modules (they run from
+# server/), so the tests put that directory on the path the way the
+# benchmarks do (bench/benchutil.py).
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server'))
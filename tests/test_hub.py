@@ -0,0 +1,215 @@
+# test_hub.py
+# ChatHub with stand-in sessions: joining and leaving, room chat, the chat
+# commands, taking a name back on reconnect, and the recent-message rings
+# warmed from a store.
+
+from datetime import datetime
+
+import pytest
+
+import hub
+import protocol
+import session
+import storage
+from rooms import DIRECT
+
+
+class Outbox:
+    dropped = 0
+
+    def __init__(self):
+        self.frames = []
+
+    def put(self, frame):
+        self.frames.append(frame)
+
+
+class Conn(session.Session):
+    """A session that keeps what it is sent."""
+
+    __slots__ = ('sent', 'expired')
+
+    def __init__(self, name, port=1000):
+        super().__init__(('127.0.0.1', port))
+        self.name = name
+        self.framed = True
+        self.outbox = Outbox()
+        self.sent = []
+        self.expired = None
+
+    def send(self, outgoing):
+        self.sent.append(outgoing)
+
+    def expire(self, reason):
+        self.expired = reason
+
+    def texts(self):
+        texts, self.sent = [outgoing.text for outgoing in self.sent], []
+        return texts
+
+
+class Relay:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, room, message):
+        self.published.append((room, message))
+
+
+@pytest.fixture
+def chat():
+    saved = []
+    chat = hub.ChatHub(lambda *args, **fields: saved.append((args, fields)))
+    chat.saved = saved
+    return chat
+
+
+def connect(chat, name, port=1000, resume=None):
+    conn = Conn(name, port)
+    conn.resume = resume
+    assert chat.claim(conn) is None
+    chat.join(conn)
+    return conn
+
+
+def test_join_chat_and_leave(chat):
+    ann = connect(chat, 'ann')
+    bob = connect(chat, 'bob', 1001)
+    assert ann.texts() == ["[SERVER] bob has joined the chat."]
+    chat.handle_message(bob, "hello")
+    [message] = ann.sent
+    assert (message.ftype, message.sender, message.text, message.room) == (protocol.MESSAGE, 'bob', 'hello', 'lobby')
+    assert bob.sent == []
+    assert chat.recent.snapshot('lobby') == [message]
+    [(args, _)] = chat.saved
+    assert args[:3] == ('bob', 'hello', 'lobby')
+    ann.sent = []
+    chat.leave(bob)
+    assert ann.texts() == ["[SERVER] bob has left the chat."]
+    assert chat.names.get('bob') is None
+    # A newcomer is shown the ring.
+    cid = connect(chat, 'cid', 1002)
+    assert cid.texts() == ["[SERVER] Last 1 messages in #lobby:", "hello"]
+
+
+def test_name_taken(chat):
+    connect(chat, 'ann')
+    assert chat.claim(Conn('ANN', 1001)) == "The name ANN is taken."
+
+
+def test_reconnect_with_token_replaces_the_session(chat):
+    bob = connect(chat, 'bob', 1001)
+    old = connect(chat, 'ann')
+    bob.sent = []
+    new = connect(chat, 'ann', 1002, resume={'room': 'lobby', 'after': None, 'token': old.token})
+    assert old.replaced and old.expired == 'replaced by a reconnect'
+    assert chat.names.get('ann') is new
+    assert new.token != old.token
+    # The old session's teardown neither frees the name nor announces a departure.
+    chat.leave(old)
+    assert chat.names.get('ann') is new
+    assert bob.texts() == ["[SERVER] ann has joined the chat."]
+
+
+def test_reconnect_with_a_wrong_token_is_refused(chat):
+    old = connect(chat, 'ann')
+    thief = Conn('ann', 1002)
+    thief.resume = {'room': 'lobby', 'after': None, 'token': 'guess'}
+    assert chat.claim(thief) == "The name ann is taken."
+    assert not old.replaced and old.expired is None
+
+
+def test_closed_holder_gives_up_its_name(chat):
+    old = connect(chat, 'ann')
+    old.closed = True
+    assert chat.claim(Conn('ann', 1002)) is None
+    assert old.replaced
+
+
+def test_join_and_leave_rooms(chat):
+    ann = connect(chat, 'ann')
+    bob = connect(chat, 'bob', 1001)
+    ann.sent = []
+    chat.handle_message(bob, "/join Dev")
+    assert bob.texts() == ["[SERVER] You are now in #dev (1 members)."]
+    assert ann.texts() == ["[SERVER] bob has left #lobby."]
+    chat.handle_message(bob, "/join dev")
+    assert bob.texts() == ["[SERVER] You are already in #dev."]
+    chat.handle_message(bob, "/join no spaces")
+    assert bob.texts()[0].startswith("[SERVER] Usage: /join")
+    chat.handle_message(ann, "/rooms")
+    assert ann.texts() == ["[SERVER] Rooms: #dev (1), #lobby (1)"]
+    chat.handle_message(bob, "/leave")
+    assert bob.texts() == ["[SERVER] You are now in #lobby (2 members)."]
+    assert ann.texts() == ["[SERVER] bob has joined #lobby."]
+
+
+def test_msg(chat):
+    ann = connect(chat, 'ann')
+    bob = connect(chat, 'Bob', 1001)
+    cid = connect(chat, 'cid', 1002)
+    for conn in (ann, bob, cid):
+        conn.sent = []
+    chat.handle_message(ann, "/msg bob  see you at 5")
+    [message] = bob.sent
+    assert ann.sent == [message] and cid.sent == []
+    assert (message.sender, message.recipient, message.text) == ('ann', 'Bob', 'see you at 5')
+    [(args, _)] = chat.saved[-1:]
+    assert args[2] == DIRECT and args[5] == 'Bob'
+    ann.sent = []
+    chat.handle_message(ann, "/msg ann hi")
+    chat.handle_message(ann, "/msg dan hi")
+    chat.handle_message(ann, "/msg bob")
+    assert ann.texts() == ["[SERVER] That is you.", "[SERVER] No one called dan is online.",
+                           "[SERVER] Usage: /msg <name> <message>"]
+
+
+def test_msg_stays_on_this_server(chat):
+    chat.relay = Relay()
+    ann = connect(chat, 'ann')
+    ann.sent = []
+    chat.handle_message(ann, "/msg dan hi")
+    assert ann.texts() == ["[SERVER] No one called dan is on this server."]
+    assert all(room != DIRECT for room, _ in chat.relay.published)
+
+
+def test_who(chat):
+    ann = connect(chat, 'ann')
+    connect(chat, 'Bob', 1001)
+    cid = connect(chat, 'cid', 1002)
+    chat.handle_message(cid, "/join dev")
+    ann.sent = []
+    chat.handle_message(ann, "/who")
+    chat.handle_message(ann, "/who lobby")
+    chat.handle_message(ann, "/who empty")
+    assert ann.texts() == ["[SERVER] 3 online: ann, Bob, cid", "[SERVER] 2 in #lobby: ann, Bob",
+                           "[SERVER] No one is in #empty."]
+    chat.relay = Relay()
+    chat.handle_message(ann, "/who")
+    assert ann.texts() == ["[SERVER] 3 online on this server: ann, Bob, cid"]
+
+
+def test_unknown_command(chat):
+    ann = connect(chat, 'ann')
+    ann.sent = []
+    chat.handle_message(ann, "/frobnicate now")
+    assert ann.texts() == ["[SERVER] Unknown command /frobnicate. Try /help."]
+
+
+def test_warm_recent_keeps_file_attachments(chat, tmp_path):
+    store = storage.SQLiteStore(str(tmp_path / 'history.db'))
+    attachment = {'blob': 'ab' * 32, 'name': 'report.pdf', 'size': 300000}
+    store.insert_many([
+        {'_id': storage.new_message_id(), 'sender_name': 'ann', 'message': 'hi', 'room': 'lobby',
+         'timestamp': datetime(2024, 5, 1, 12, 0, 0)},
+        {'_id': storage.new_message_id(), 'sender_name': 'ann', 'message': 'shared report.pdf', 'room': 'dev',
+         'timestamp': datetime(2024, 5, 1, 12, 0, 1), 'file': attachment},
+    ])
+    chat.store = store
+    chat.warm_recent()
+    [hi] = chat.recent.snapshot('lobby')
+    [share] = chat.recent.snapshot('dev')
+    assert hi.text == 'hi' and hi.attachment is None
+    assert share.attachment == attachment
+    assert share.to_dict()['file'] == attachment
+    store.close()
@@ -0,0 +1,48 @@
+# test_names.py
+# NameIndex: case-insensitive claims, handing a name to a reconnect, and
+# releases that must not free a name someone else has taken since.
+
+from names import NameIndex
+
+
+class Member:
+    def __init__(self, name):
+        self.name = name
+
+
+def test_claim_is_case_insensitive():
+    index = NameIndex()
+    ann = Member('Ann')
+    assert index.claim(ann)
+    assert not index.claim(Member('aNN'))
+    assert index.get('ANN') is ann
+    assert len(index) == 1
+
+
+def test_replace_hands_the_name_over():
+    index = NameIndex()
+    old, new = Member('ann'), Member('Ann')
+    index.claim(old)
+    assert index.replace(old, new)
+    assert index.get('ann') is new
+    # Only the current holder can be replaced.
+    assert not index.replace(old, Member('ann'))
+    # The old session leaving afterwards does not free the name.
+    index.release(old)
+    assert index.get('ann') is new
+
+
+def test_release_frees_the_name():
+    index = NameIndex()
+    ann = Member('ann')
+    index.claim(ann)
+    index.release(ann)
+    assert index.get('ann') is None
+    assert index.claim(Member('ann'))
+
+
+def test_names_sorted_case_insensitively():
+    index = NameIndex()
+    for name in ('bob', 'Ann', 'cid', 'al'):
+        index.claim(Member(name))
+    assert index.names() == ['al', 'Ann', 'bob', 'cid']
@@ -0,0 +1,68 @@
+# test_persistence.py
+# The write-behind journal: replay after a crash tore its last line, replay
+# after a failed insert, and attach() replaying before it returns.
+
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+import persistence
+import storage
+
+
+def document(i, **fields):
+    return dict({'_id': storage.new_message_id(), 'sender_name': 'ann', 'message': f"line {i}",
+                 'room': 'lobby', 'timestamp': datetime(2024, 5, 1, 12, 0, i)}, **fields)
+
+
+def test_replay_skips_a_torn_last_line(tmp_path):
+    journal = persistence.Journal(str(tmp_path / 'journal.jsonl'))
+    docs = [document(i) for i in range(5)]
+    journal.append(docs)
+    with open(journal.path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(document(9), default=persistence._encode_value)[:40])
+    batches = []
+    assert journal.replay(batches.append, batch_size=2) == 5
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert [doc for batch in batches for doc in batch] == docs
+    # Timestamps come back as datetimes, and the journal is gone.
+    assert batches[0][0]['timestamp'] == datetime(2024, 5, 1, 12, 0, 0)
+    assert not journal.has_entries()
+    assert os.listdir(tmp_path) == []
+
+
+def test_replay_keeps_the_journal_when_insert_fails(tmp_path):
+    journal = persistence.Journal(str(tmp_path / 'journal.jsonl'))
+    docs = [document(i) for i in range(3)]
+    journal.append(docs)
+
+    def fail(batch):
+        raise ConnectionError("down")
+
+    with pytest.raises(ConnectionError):
+        journal.replay(fail, batch_size=10)
+    # Spilled while the replay was failing: appended to a new journal.
+    late = document(5)
+    journal.append([late])
+    stored = []
+    assert journal.replay(stored.extend, batch_size=10) == 4
+    assert stored == docs + [late]
+
+
+def test_attach_replays_before_returning(tmp_path):
+    writer = persistence.WriteBehind(None, journal_path=str(tmp_path / 'journal.jsonl'), flush_interval=0.01)
+    try:
+        docs = [document(i) for i in range(3)]
+        for doc in docs:
+            writer.submit(dict(doc))
+        # Without a store the flusher journals what it is given.
+        assert writer.flush()
+        assert writer.journal.has_entries()
+        store = storage.SQLiteStore(str(tmp_path / 'history.db'))
+        writer.attach(store)
+        assert [doc['_id'] for doc in store.history(room='lobby')] == [doc['_id'] for doc in docs]
+        assert writer.stats()['replayed'] == 3
+    finally:
+        writer.close()
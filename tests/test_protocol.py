@@ -0,0 +1,114 @@
+# test_protocol.py
+# FrameDecoder and ClientReader: frames split across reads, torn frames,
+# oversized and foreign frames, and the legacy raw-text fallback.
+
+import pytest
+
+import protocol
+
+
+def frames(decoder):
+    return [(ftype, bytes(payload)) for ftype, payload in decoder.frames()]
+
+
+def test_frames_in_one_read():
+    decoder = protocol.FrameDecoder()
+    decoder.feed(protocol.encode_frame(protocol.CHAT, b'one') + protocol.encode_frame(protocol.PING)
+                 + protocol.encode_frame(protocol.CHAT, b'two'))
+    assert frames(decoder) == [(protocol.CHAT, b'one'), (protocol.PING, b''), (protocol.CHAT, b'two')]
+
+
+def test_frame_split_byte_by_byte():
+    data = protocol.encode_frame(protocol.CHAT, 'héllo'.encode('utf-8')) * 2
+    decoder = protocol.FrameDecoder()
+    seen = []
+    for i in range(len(data)):
+        decoder.feed(data[i:i + 1])
+        seen += frames(decoder)
+    assert seen == [(protocol.CHAT, 'héllo'.encode('utf-8'))] * 2
+    assert len(decoder) == 0
+
+
+def test_torn_frame_waits_for_the_rest():
+    frame = protocol.encode_frame(protocol.CHAT, b'x' * 100)
+    decoder = protocol.FrameDecoder()
+    # Half a header, then a header and part of the payload.
+    decoder.feed(frame[:3])
+    assert decoder.next_frame() is None
+    decoder.feed(frame[3:50])
+    assert decoder.next_frame() is None
+    assert decoder.pending() == frame[:50]
+    decoder.feed(frame[50:])
+    assert frames(decoder) == [(protocol.CHAT, b'x' * 100)]
+
+
+def test_frame_larger_than_the_buffer():
+    payload = bytes(range(256)) * 100
+    decoder = protocol.FrameDecoder(size=64)
+    frame = protocol.encode_frame(protocol.CHAT, payload)
+    for i in range(0, len(frame), 1000):
+        decoder.feed(frame[i:i + 1000])
+    assert frames(decoder) == [(protocol.CHAT, payload)]
+    # Drained: the grown buffer is given back.
+    assert decoder.pending() == b''
+
+
+def test_oversized_frame_is_refused():
+    decoder = protocol.FrameDecoder()
+    decoder.feed(protocol.HEADER.pack(protocol.PROTOCOL_VERSION, protocol.CHAT, protocol.MAX_PAYLOAD + 1))
+    with pytest.raises(protocol.ProtocolError):
+        decoder.next_frame()
+
+
+def test_unknown_version_is_refused():
+    decoder = protocol.FrameDecoder()
+    decoder.feed(protocol.HEADER.pack(protocol.PROTOCOL_VERSION + 1, protocol.CHAT, 0))
+    with pytest.raises(protocol.ProtocolError):
+        decoder.next_frame()
+
+
+def test_compressed_frame_without_a_codec_is_refused():
+    decoder = protocol.FrameDecoder()
+    decoder.feed(protocol.encode_frame(protocol.CHAT | protocol.FLAG_COMPRESSED, b'abc'))
+    with pytest.raises(protocol.ProtocolError):
+        decoder.next_frame()
+
+
+def test_reader_framed_client():
+    reader = protocol.ClientReader()
+    data = (protocol.encode_json(protocol.HELLO, {'name': 'ann', 'version': 1})
+            + protocol.encode_frame(protocol.CHAT, b'hi') + protocol.encode_frame(protocol.PING)
+            + protocol.encode_frame(99, b'from a newer client'))
+    # Split mid-HELLO.
+    reader.decoder.feed(data[:10])
+    assert list(reader.events()) == []
+    assert reader.framed is True
+    reader.decoder.feed(data[10:])
+    assert list(reader.events()) == [(protocol.HELLO, 'ann'), (protocol.CHAT, 'hi'), (protocol.PING, None)]
+
+
+def test_reader_requires_hello_first():
+    reader = protocol.ClientReader()
+    reader.decoder.feed(protocol.encode_frame(protocol.CHAT, b'hi'))
+    with pytest.raises(protocol.ProtocolError):
+        list(reader.events())
+
+
+def test_reader_legacy_client():
+    reader = protocol.ClientReader()
+    reader.decoder.feed(b'bob\n')
+    assert list(reader.events()) == [(protocol.HELLO, 'bob')]
+    assert reader.framed is False
+    # A multibyte character split across two reads comes out whole.
+    text = 'café'.encode('utf-8')
+    reader.decoder.feed(text[:-1])
+    first = list(reader.events())
+    reader.decoder.feed(text[-1:])
+    assert first + list(reader.events()) == [(protocol.CHAT, 'caf'), (protocol.CHAT, 'é')]
+
+
+def test_reader_refuses_other_versions():
+    reader = protocol.ClientReader()
+    reader.decoder.feed(bytes([2]) + b'\0' * 5)
+    with pytest.raises(protocol.ProtocolError):
+        list(reader.events())
@@ -0,0 +1,159 @@
+# test_search.py
+# Search segments: a written or merged segment answers like the memory
+# segment it came from, queries come back newest first with their filters
+# applied, and SearchIndex merges tiers and survives a reopen.
+
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import search
+import storage
+
+START = datetime(2024, 5, 1, 12, 0, 0)
+ROOMS = ('lobby', 'dev', 'ops')
+SENDERS = ('ann', 'bob', 'cid')
+
+
+def document(i):
+    return {'_id': storage.new_message_id(), 'sender_name': SENDERS[i % 3], 'room': ROOMS[i % 2 * 2 if i % 5 else 1],
+            'message': f"message {i} {'deploy' if i % 4 == 0 else 'chat'} {'urgent' if i % 6 == 0 else ''}",
+            'timestamp': START + timedelta(seconds=i)}
+
+
+def expected(docs, query, limit=search.SEARCH_RESULTS):
+    """What a query should return, by scanning the documents."""
+    found = []
+    for doc in docs:
+        ts = storage.to_epoch(doc['timestamp'])
+        if (query.words <= search.tokenize(doc['message'])
+                and (query.room is None or doc['room'] == query.room)
+                and (query.sender is None or doc['sender_name'] == query.sender)
+                and query.matches_time(ts)):
+            found.append(doc['_id'])
+    return found[::-1][:limit]
+
+
+def ids(hits):
+    return [hit.message_id for hit in hits]
+
+
+QUERIES = [
+    search.Query({'deploy'}),
+    search.Query({'deploy', 'urgent'}),
+    search.Query({'chat'}, room='dev'),
+    search.Query(room='ops', sender='bob'),
+    search.Query({'message'}, since=storage.to_epoch(START + timedelta(seconds=30)),
+                 until=storage.to_epoch(START + timedelta(seconds=45))),
+    search.Query({'nothing'}),
+]
+
+
+def memory_segment(docs, base=0):
+    mem = search.MemorySegment(base)
+    for doc in docs:
+        mem.add(doc)
+    return mem
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_memory_and_file_segments_agree(tmp_path, query):
+    docs = [document(i) for i in range(100)]
+    mem = memory_segment(docs)
+    segment = search.write_memory_segment(str(tmp_path / 'seg'), mem)
+    assert segment.ndocs == 100 and segment.ordered
+    assert ids(search.search_segments([mem], query, 10)) == expected(docs, query, 10)
+    assert ids(search.search_segments([segment], query, 10)) == expected(docs, query, 10)
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_merged_segment_matches_its_parts(tmp_path, query):
+    docs = [document(i) for i in range(90)]
+    parts = [search.write_memory_segment(str(tmp_path / f"seg-{n}"), memory_segment(docs[n * 30:n * 30 + 30], n * 30))
+             for n in range(3)]
+    merged = search.merge_segments(str(tmp_path / 'merged'), parts)
+    assert (merged.base, merged.ndocs, merged.ordered) == (0, 90, True)
+    assert merged.min_ts == parts[0].min_ts and merged.max_ts == parts[-1].max_ts
+    assert ids(search.search_segments([merged], query, 50)) == expected(docs, query, 50)
+    assert ids(search.search_segments(parts, query, 50)) == expected(docs, query, 50)
+
+
+def test_hit_fields(tmp_path):
+    doc = document(0)
+    segment = search.write_memory_segment(str(tmp_path / 'seg'), memory_segment([doc]))
+    [hit] = search.search_segments([segment], search.Query({'deploy'}), 5)
+    assert (hit.message_id, hit.sender, hit.room, hit.text) == (doc['_id'], 'ann', 'dev', doc['message'])
+    assert hit.timestamp == storage.to_epoch(doc['timestamp'])
+
+
+def test_parse_query():
+    now = datetime(2024, 5, 8)
+    query = search.parse_query('Deploy in:#Dev from:bob since:7d until:2024-05-07', now)
+    assert query.words == {'deploy'}
+    assert (query.room, query.sender) == ('dev', 'bob')
+    assert query.since == storage.to_epoch(datetime(2024, 5, 1))
+    assert query.until == storage.to_epoch(datetime(2024, 5, 7))
+    with pytest.raises(ValueError):
+        search.parse_query('since:7d', now)
+
+
+def test_index_merges_and_reopens(tmp_path):
+    path = str(tmp_path / 'worker-0')
+    docs = [document(i) for i in range(100)]
+    index = search.SearchIndex(path, segment_docs=10, flush_interval=60, merge_factor=2)
+    index.add(docs)
+    index.close()
+    # 10 full segments, carried into tiers of 20, 40 and 80 documents.
+    assert index.stats()['indexed'] == 100
+    assert index.merges > 0
+    assert sorted(s.ndocs for s in index.segments) == [20, 80]
+    assert os.path.basename(index.segments[0].path) in os.listdir(path)
+
+    reopened = search.SearchIndex(path, segment_docs=10, flush_interval=60, merge_factor=2)
+    try:
+        for query in QUERIES:
+            assert ids(reopened.search(query, 15)) == expected(docs, query, 15)
+        # New messages number on from the last segment.
+        later = document(100)
+        reopened.add([later])
+        reopened.close()
+        assert ids(reopened.search(search.Query({'message', '100'}))) == [later['_id']]
+    finally:
+        reopened.close()
+
+
+def test_index_leaves_out_direct_messages(tmp_path):
+    index = search.SearchIndex(str(tmp_path / 'worker-0'), flush_interval=60)
+    index.add([dict(document(4), recipient='bob'), document(8)])
+    index.close()
+    assert len(index.search(search.Query({'deploy'}))) == 1
+
+
+def test_backfill_starts_where_the_most_behind_index_stopped(tmp_path):
+    stored = [document(i) for i in range(40)]
+    own = search.SearchIndex(str(tmp_path / 'worker-0'), flush_interval=60)
+    own.add(stored[:20])
+    own.close()
+    sibling = search.SearchIndex(str(tmp_path / 'worker-1'), flush_interval=60)
+    sibling.add(stored[:25])
+    sibling.close()
+
+    class Store:
+        def oldest(self, before, limit, after=None):
+            docs = [doc for doc in stored if doc['timestamp'] < before and (after is None or doc['timestamp'] >= after)]
+            return docs[:limit]
+
+    index = search.SearchIndex(str(tmp_path / 'worker-0'), flush_interval=60, backfill=True)
+    try:
+        index.backfill_from(Store())
+        deadline = time.monotonic() + 5
+        while index.backfilled < 20 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        index.close()
+    assert index.backfilled == 20
+    # Messages both indexes hold are returned once.
+    query = search.Query({'message'})
+    assert ids(index.search(query, 40)) == expected(stored, query, 40)